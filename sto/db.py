@@ -1,33 +1,176 @@
 import os
 
-from sqlalchemy import create_engine
+import sqlalchemy as sa
+from sqlalchemy import create_engine, inspect, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session
-from typing import Tuple
+from typing import Tuple, Optional, List
 
-from .models.implementation import Base
+from .models.implementation import Base, NumericBase, DatabaseOption, uses_numeric_token_models
+from .models.utils import HexBinary
 
 
-def setup_database(logger, db_filename) -> Tuple[Session, bool]:
-    """Create new SQLite daabase and set up connection"""
+#: SQLite tuning for concurrent scanners and readers, applied to every new connection
+SQLITE_PRAGMAS = (
+    # Readers do not block the writer and the writer does not block readers
+    "PRAGMA journal_mode=WAL",
+    # Safe with WAL, only the last transactions may be lost on a power loss
+    "PRAGMA synchronous=NORMAL",
+    # Read the database file through memory mapping, 256 MB
+    "PRAGMA mmap_size=268435456",
+)
 
-    # https://docs.sqlalchemy.org/en/latest/dialects/sqlite.html
-    url = "sqlite+pysqlite:///" + db_filename
 
-    engine = create_engine(url, echo=False)
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
 
-    if not os.path.exists(db_filename):
-        logger.info("Initializing new database %s", db_filename)
-        init_db(engine)
-        new = True
+
+def create_database_engine(url: str, pool_size: Optional[int]=None, pool_pre_ping=False, statement_timeout: Optional[float]=None):
+    """Create SQLAlchemy engine with our connection settings.
+
+    :param pool_size: How many connections to keep open. Not applicable to SQLite.
+    :param pool_pre_ping: Test connections before using them, to survive database restarts
+    :param statement_timeout: Seconds. For PostgreSQL and MySQL cancel statements running longer than this.
+        For SQLite wait this long for other writers to release the database lock.
+    """
+
+    backend = make_url(url).get_backend_name()
+    kwargs = dict(echo=False, pool_pre_ping=pool_pre_ping)
+    connect_args = {}
+
+    if backend == "sqlite":
+        if statement_timeout:
+            connect_args["timeout"] = statement_timeout
+    else:
+        if pool_size:
+            kwargs["pool_size"] = pool_size
+
+        if statement_timeout:
+            if backend == "postgresql":
+                connect_args["options"] = "-c statement_timeout={:d}".format(int(statement_timeout * 1000))
+            elif backend == "mysql":
+                connect_args["init_command"] = "SET SESSION max_execution_time={:d}".format(int(statement_timeout * 1000))
+
+    engine = create_engine(url, connect_args=connect_args, **kwargs)
+
+    if backend == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+
+    return engine
+
+
+def setup_database(logger, db_filename: Optional[str]=None, database_url: Optional[str]=None, pool_size: Optional[int]=None, pool_pre_ping=False, statement_timeout: Optional[float]=None, compact_storage=False) -> Tuple[Session, bool]:
+    """Create new SQLite daabase and set up connection
+
+    :param db_filename: SQLite database file
+    :param database_url: Any SQLAlchemy database URL instead of a SQLite file. PostgreSQL databases get token balance models with native uint256 columns.
+    :param pool_size: See :py:func:`create_database_engine`
+    :param pool_pre_ping: See :py:func:`create_database_engine`
+    :param statement_timeout: See :py:func:`create_database_engine`
+    :param compact_storage: Store addresses and transaction hashes as raw bytes when creating a new database.
+        Existing databases keep the storage format they were created or converted with.
+    """
+
+    if database_url:
+        url = database_url
     else:
-        new = False
+        # https://docs.sqlalchemy.org/en/latest/dialects/sqlite.html
+        url = "sqlite+pysqlite:///" + db_filename
+
+    engine = create_database_engine(url, pool_size=pool_size, pool_pre_ping=pool_pre_ping, statement_timeout=statement_timeout)
+
+    if database_url:
+        new = not engine.has_table("broadcast_account")
+    else:
+        new = not os.path.exists(db_filename)
+
+    if new:
+        logger.info("Initializing new database %s", repr(engine.url))
+        engine.dialect.sto_compact_storage = compact_storage
+    else:
+        engine.dialect.sto_compact_storage = read_compact_storage_option(engine)
+
+    # Existing databases are changed only by sto db-upgrade, see sto.migrations
+    from .migrations import mark_migrations_applied, get_pending_migrations
+    if new:
+        init_db(engine)
+        # Tables were just created using the latest models
+        mark_migrations_applied(engine)
+    elif get_pending_migrations(engine):
+        logger.warning("Database schema is out of date, please run sto db-upgrade")
+
+    if new and compact_storage:
+        write_compact_storage_option(engine)
 
     Session = sessionmaker(bind=engine)
     session = Session()
     return session, new
 
 
+def get_tables(engine) -> List:
+    """Get the tables of the model set used with this database."""
+    if uses_numeric_token_models(engine.dialect.name):
+        numeric = NumericBase.metadata.sorted_tables
+        replaced = set(t.name for t in numeric)
+        return [t for t in Base.metadata.sorted_tables if t.name not in replaced] + numeric
+    return Base.metadata.sorted_tables
+
+
 def init_db(engine):
-    Base.metadata.create_all(engine)
+    """Create tables that do not exist yet."""
+    tables = get_tables(engine)
+    Base.metadata.create_all(engine, tables=[t for t in tables if t.metadata is Base.metadata])
+    NumericBase.metadata.create_all(engine, tables=[t for t in tables if t.metadata is NumericBase.metadata])
+
+
+def get_column(engine, table_name: str, column_name: str) -> sa.Column:
+    """Get a column definition from the model set used with this database."""
+    for table in get_tables(engine):
+        if table.name == table_name:
+            return table.columns[column_name]
+    raise KeyError("No table {}".format(table_name))
+
+
+def get_missing_indexes(engine) -> List[sa.Index]:
+    """Get indexes defined in the models but not yet in the database."""
+    inspector = inspect(engine)
+    missing = []
+    for table in get_tables(engine):
+        existing = set(i["name"] for i in inspector.get_indexes(table.name))
+        missing += [index for index in table.indexes if index.name not in existing]
+    return missing
+
+
+def read_compact_storage_option(engine) -> bool:
+    if not engine.has_table(DatabaseOption.__tablename__):
+        return False
+    q = sa.select([DatabaseOption.value]).where(DatabaseOption.name == DatabaseOption.COMPACT_STORAGE)
+    return engine.execute(q).scalar() == "true"
+
+
+def write_compact_storage_option(connectable):
+    """Mark the database as compact.
+
+    :param connectable: Engine, or a connection to write the option as a part of its ongoing transaction
+    """
+    session = Session(bind=connectable)
+    DatabaseOption.set(session, DatabaseOption.COMPACT_STORAGE, "true")
+    session.commit()
+    session.close()
+
+
+def get_compactable_columns(engine) -> List[Tuple[str, List[str]]]:
+    """Get hex string columns that compact storage keeps as raw bytes.
 
+    :return: List of (table name, column names)
+    """
+    result = []
+    for table in get_tables(engine):
+        columns = [c.name for c in table.columns if isinstance(c.type, HexBinary)]
+        if columns:
+            result.append((table.name, columns))
+    return result
@@ -0,0 +1,152 @@
+"""Block header lookups shared by the scanners."""
+import datetime
+from collections import namedtuple, OrderedDict
+
+from hexbytes import HexBytes
+from sqlalchemy.orm import Session
+from typing import Iterable, Dict, Optional, List, Tuple
+from web3 import Web3
+
+from sto.ethereum.utils import batch_rpc_call, to_int_quantity
+
+
+#: What we need to know about a block: number, hash as 0x hex string, UTC timestamp
+BlockHeader = namedtuple("BlockHeader", ["block_num", "block_hash", "timestamp"])
+
+
+class BlockUnavailable(Exception):
+    """The node could not give us a block we asked for."""
+
+
+class BlockHeaderResolver:
+    """Resolve block hashes and timestamps in batches.
+
+    Callers first tell all the block numbers they are going to need with :py:meth:`fetch_headers`,
+    so that the headers can be fetched with JSON-RPC batch requests instead of one ``eth_getBlockByNumber`` per block.
+
+    Lookups are read-through: an in-memory LRU cache first, then the persistent ``block_header`` table
+    if a database session is given, and only then the node. Headers fetched from the node are written to the table,
+    so scans of other tokens and later runs do not need to download them again.
+    """
+
+    def __init__(self, web3: Web3, batch_size: int=100, dbsession: Optional[Session]=None, network: Optional[str]=None, BlockHeaderModel: Optional[type]=None, cache_size: int=10000):
+        """
+        :param BlockHeaderModel: SQLAlchemy model for persistent headers, see :py:class:`sto.models.tokenscan._BlockHeader`
+        :param cache_size: How many headers we keep in memory
+        """
+        assert isinstance(web3, Web3)
+        self.web3 = web3
+        self.batch_size = batch_size
+
+        self.dbsession = dbsession
+        self.network = network
+        self.BlockHeaderModel = BlockHeaderModel
+
+        if BlockHeaderModel:
+            assert dbsession is not None
+            assert network
+
+        #: block num -> BlockHeader, least recently used first
+        self.headers = OrderedDict()
+        self.cache_size = cache_size
+
+    def remember(self, header: BlockHeader):
+        """Put a header to the in-memory cache."""
+        self.headers[header.block_num] = header
+        self.headers.move_to_end(header.block_num)
+        while len(self.headers) > self.cache_size:
+            self.headers.popitem(last=False)
+
+    def forget_after(self, block_num: int):
+        """Drop headers above a block from all cache layers, so they get fetched again from the node."""
+        for n in [n for n in self.headers if n > block_num]:
+            del self.headers[n]
+
+        if self.BlockHeaderModel:
+            self.BlockHeaderModel.delete_headers_after(self.dbsession, self.network, block_num)
+
+    def find_fork_point(self, scanned_hashes: List[Tuple[int, str]]) -> Optional[int]:
+        """Check block hashes recorded by a scan against the canonical chain of the node.
+
+        The hashes must be the ones the scan itself saw. The shared header cache cannot be trusted here:
+        a scan of another token may have stored a header from after a reorganisation,
+        which matches the node even though this scan processed the block of the old chain.
+
+        Because each block hash commits to its parent, once we find a recorded block whose hash is still canonical,
+        all blocks before it are canonical too. Cached headers above it are forgotten if any later block got forked away.
+
+        :param scanned_hashes: List of (block num, block hash) pairs recorded by the scan, oldest first
+        :return: The first block that needs to be (re)scanned, the block after the last recorded block when there was no reorg,
+            or None if even the oldest recorded block got forked away
+        """
+
+        head = self.web3.eth.blockNumber
+        newest_first = sorted(scanned_hashes, reverse=True)
+        forked = False
+
+        for i in range(0, len(newest_first), self.batch_size):
+            batch = newest_first[i:i + self.batch_size]
+            canonical = self.fetch_headers_from_node([block_num for block_num, block_hash in batch if block_num <= head])
+
+            for block_num, block_hash in batch:
+                header = canonical.get(block_num)
+                if header and header.block_hash == block_hash:
+                    if forked:
+                        self.forget_after(block_num)
+                    return block_num + 1
+                forked = True
+
+        if newest_first:
+            self.forget_after(newest_first[-1][0] - 1)
+        return None
+
+    def fetch_headers(self, block_nums: Iterable[int]) -> Dict[int, BlockHeader]:
+        """Make sure we have headers for all given blocks, fetching missing ones from the database or the node.
+
+        :return: Block num -> BlockHeader mapping for the asked blocks
+        """
+        block_nums = set(block_nums)
+        result = {}
+        for n in block_nums:
+            if n in self.headers:
+                self.headers.move_to_end(n)
+                result[n] = self.headers[n]
+
+        missing = sorted(n for n in block_nums if n not in result)
+
+        if missing and self.BlockHeaderModel:
+            for block_num, (block_hash, timestamp) in self.BlockHeaderModel.get_headers(self.dbsession, self.network, missing).items():
+                result[block_num] = BlockHeader(block_num, block_hash, timestamp)
+            missing = [n for n in missing if n not in result]
+
+        if missing:
+            fetched = self.fetch_headers_from_node(missing)
+            result.update(fetched)
+            if self.BlockHeaderModel:
+                self.BlockHeaderModel.store_headers(self.dbsession, self.network, fetched.values())
+
+        for header in result.values():
+            self.remember(header)
+
+        return result
+
+    def fetch_headers_from_node(self, block_nums: list) -> Dict[int, BlockHeader]:
+        """Fetch block headers using JSON-RPC batch requests."""
+
+        result = {}
+        replies = batch_rpc_call(self.web3, "eth_getBlockByNumber", [[n, False] for n in block_nums], self.batch_size)
+        for block_num, reply in zip(block_nums, replies):
+            block = reply.get("result")
+            if not block:
+                raise BlockUnavailable("Could not get block {}: {}".format(block_num, reply.get("error")))
+
+            timestamp = datetime.datetime.fromtimestamp(to_int_quantity(block["timestamp"]), datetime.timezone.utc)
+            result[block_num] = BlockHeader(block_num, HexBytes(block["hash"]).hex(), timestamp)
+
+        return result
+
+    def get_header(self, block_num: int) -> BlockHeader:
+        return self.fetch_headers([block_num])[block_num]
+
+    def get_block_timestamp(self, block_num: int) -> datetime.datetime:
+        return self.get_header(block_num).timestamp
@@ -7,7 +7,7 @@ from sto.models.implementation import BroadcastAccount, PreparedTransaction
 from eth_account import Account
 from eth_utils import to_bytes, from_wei
 from sqlalchemy.orm import Session
-from typing import Union, Optional
+from typing import Union, Optional, List
 from web3 import Web3, HTTPProvider
 
 
@@ -19,8 +19,16 @@ def broadcast(logger: Logger,
               ethereum_gas_limit: Optional[str],
               ethereum_gas_price: Optional[str],
               commit=True,
+              bulk=False,
+              batch_size=100,
+              signing_workers: Optional[int]=None,
 ):
-    """Issue out a new Ethereum token."""
+    """Issue out a new Ethereum token.
+
+    :param bulk: Sign all pending transactions first, store their txids with one commit
+        and then send them with JSON-RPC batches of ``batch_size``, see :py:func:`bulk_broadcast`
+    :param signing_workers: Number of processes signing transactions in bulk mode, defaults to the number of CPU cores
+    """
 
     check_good_private_key(ethereum_private_key)
 
@@ -44,6 +52,10 @@ def broadcast(logger: Logger,
     logger.info("Our address %s has ETH balance of %f for operations", account.address, from_wei(balance, "ether"))
 
     txs = list(pending_broadcasts)
+
+    if bulk:
+        return bulk_broadcast(logger, dbsession, service, txs, batch_size, commit, signing_workers)
+
     # https://stackoverflow.com/questions/41985993/tqdm-show-progress-for-a-generator-i-know-the-length-of
     for tx in tqdm(txs, total=pending_broadcasts.count()):
         try:
@@ -58,3 +70,34 @@ def broadcast(logger: Logger,
             dbsession.commit()  # Try to minimise file system sync issues
 
     return txs
+
+
+def bulk_broadcast(logger: Logger, dbsession: Session, service: EthereumStoredTXService, txs: List[PreparedTransaction], batch_size=100, commit=True, signing_workers: Optional[int]=None) -> List[PreparedTransaction]:
+    """Broadcast many transactions with two database commits in total.
+
+    All transactions are signed in nonce order and their txids written to the database before anything is sent,
+    so a crash can never leave a transaction in the network we do not know the txid of.
+    Then the signed transactions are pushed with JSON-RPC batches and all outcomes are written in one go.
+    """
+
+    logger.info("Signing %d transactions", len(txs))
+    raw_txs = service.sign_many(txs, signing_workers)
+
+    if commit:
+        dbsession.commit()
+    else:
+        dbsession.flush()
+
+    errors = service.send_signed(txs, raw_txs, batch_size)
+
+    if commit:
+        dbsession.commit()
+
+    failed = [(tx, error) for tx, error in zip(txs, errors) if error]
+    for tx, error in failed:
+        logger.error("Failed to broadcast transaction %s nonce %d: %s: %s", tx.txid, tx.nonce, tx.human_readable_description, error)
+
+    if failed:
+        raise RuntimeError("Failed to broadcast {} out of {} transactions".format(len(failed), len(txs)))
+
+    return txs
@@ -0,0 +1,101 @@
+"""Decide how many blocks we ask per eth_getLogs call."""
+import requests
+
+
+#: Substrings of node error messages telling the asked block range was too heavy to serve
+OVERLOAD_ERROR_MESSAGES = (
+    "more than 10000 results",
+    "query returned more than",
+    "response size exceeded",
+    "timeout",
+    "timed out",
+)
+
+
+def is_range_overload_error(e: Exception) -> bool:
+    """Did the node fail because we asked too many blocks or logs at once.
+
+    Infura and friends refuse eth_getLogs queries that match too many logs,
+    and large ranges may also simply time out.
+    """
+    if isinstance(e, requests.exceptions.Timeout):
+        return True
+
+    msg = str(e).lower()
+    return any(m in msg for m in OVERLOAD_ERROR_MESSAGES)
+
+
+class ChunkSizeController:
+    """Pluggable chunk size policy for the token scanner.
+
+    The scanner asks :py:meth:`get_chunk_size` before each eth_getLogs request
+    and reports back what happened. The state is a plain dict so it can be stored in the database
+    and the next run starts where the previous one left.
+    """
+
+    def __init__(self, min_chunk_size=10, max_chunk_size=100000, initial_chunk_size=20):
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.chunk_size = initial_chunk_size
+
+    def clamp(self, chunk_size) -> int:
+        return int(min(self.max_chunk_size, max(self.min_chunk_size, chunk_size)))
+
+    def get_chunk_size(self) -> int:
+        return self.clamp(self.chunk_size)
+
+    def record_success(self, block_count: int, log_count: int, duration: float):
+        """A block range was fetched.
+
+        :param block_count: How many blocks the range had
+        :param log_count: How many logs the node returned
+        :param duration: Seconds the request took
+        """
+
+    def record_failure(self, block_count: int):
+        """The node refused a block range of this size and we had to split it."""
+        self.chunk_size = self.clamp(block_count // 2)
+
+    def get_state(self) -> dict:
+        return {"chunk_size": self.get_chunk_size()}
+
+    def load_state(self, state: dict):
+        if state and state.get("chunk_size"):
+            self.chunk_size = self.clamp(state["chunk_size"])
+
+
+class AIMDChunkSizeController(ChunkSizeController):
+    """Grow the chunk size while the node keeps up, cut it fast when it does not.
+
+    The goal is to get about ``target_logs`` logs per request within ``latency_budget`` seconds.
+    Empty and light ranges grow the chunk size by ``increase_step`` blocks, but never past the size
+    the observed log density says would hit the log target. Going over either target multiplies
+    the chunk size by ``decrease_factor``.
+    """
+
+    def __init__(self, min_chunk_size=10, max_chunk_size=100000, initial_chunk_size=20, target_logs=500, latency_budget=10.0, increase_step=1000, decrease_factor=0.5):
+        super().__init__(min_chunk_size, max_chunk_size, initial_chunk_size)
+        self.target_logs = target_logs
+        self.latency_budget = latency_budget
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+    def record_success(self, block_count: int, log_count: int, duration: float):
+
+        if log_count > self.target_logs or duration > self.latency_budget:
+            self.chunk_size = self.clamp(block_count * self.decrease_factor)
+            return
+
+        if block_count < self.chunk_size and not log_count:
+            # The range was cut short by the end of the scan, this tells nothing new
+            return
+
+        chunk_size = block_count + self.increase_step
+        if log_count:
+            # Do not overshoot the log target when we already know how dense the range is
+            chunk_size = min(chunk_size, max(block_count, block_count * self.target_logs / log_count))
+
+        self.chunk_size = self.clamp(chunk_size)
+
+    def record_failure(self, block_count: int):
+        self.chunk_size = self.clamp(block_count * self.decrease_factor)
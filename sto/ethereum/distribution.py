@@ -3,7 +3,6 @@ from decimal import Decimal
 from logging import Logger
 
 import colorama
-from tqdm import tqdm
 
 from sto.distribution import DistributionEntry
 from sto.ethereum.txservice import EthereumStoredTXService
@@ -52,18 +51,21 @@ def distribute_tokens(logger: Logger,
     if total > available:
         raise NotEnoughTokens("Not enough tokens for distribution. Account {} has {} raw token balance, needed {}".format(service.get_or_create_broadcast_account().address, available, total))
 
-    new_distributes = old_distributes = 0
-
-    for d in tqdm(dists):
-        if not service.is_distributed(d.external_id, token_address):
-            # Going to tx queue
-            raw_amount = int(d.amount * 10**18)
-            note = "Distributing tokens, raw amount: {}".format(raw_amount)
-            service.distribute_tokens(d.external_id, d.address, raw_amount, token_address, abi, note)
-            new_distributes += 1
-        else:
-            # CSV reimports
-            old_distributes += 1
+    # CSV reimports
+    distributed = service.get_distributed_external_ids([d.external_id for d in dists], token_address)
+
+    transfers = []
+    for d in dists:
+        if d.external_id in distributed:
+            continue
+        # Going to tx queue
+        raw_amount = int(d.amount * 10**18)
+        note = "Distributing tokens, raw amount: {}".format(raw_amount)
+        transfers.append((d.external_id, d.address, raw_amount, note))
+        distributed.add(d.external_id)
+
+    new_distributes = service.distribute_tokens_bulk(transfers, token_address, abi)
+    old_distributes = len(dists) - new_distributes
 
     logger.info("Prepared transactions for broadcasting for network %s", network)
     return new_distributes, old_distributes
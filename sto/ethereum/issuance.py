@@ -198,3 +198,10 @@ def past_issuances(logger: Logger, dbsession: Session) -> Iterable[PreparedTrans
         if tx.is_token_contract_deployment():
             yield tx
 
+
+def deployed_token_addresses(dbsession: Session, network: str) -> List[str]:
+    """Get addresses of all successfully deployed token contracts in a network."""
+    q = dbsession.query(PreparedTransaction).join(BroadcastAccount).filter(BroadcastAccount.network == network)
+    q = q.filter(PreparedTransaction.contract_deployment == True, PreparedTransaction.result_transaction_success == True)
+    return [tx.contract_address for tx in q if tx.is_token_contract_deployment()]
+
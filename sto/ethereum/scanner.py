@@ -1,25 +1,111 @@
+import collections
 import datetime
 import time
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
 
 from decimal import Decimal
 from eth_utils import to_checksum_address
 from sqlalchemy.orm import Session
-from typing import Set, Dict, Tuple, Optional, Callable
+from typing import Set, Dict, Tuple, Optional, Callable, List, Iterable
 from web3 import Web3
 from web3.contract import Contract
 
-from sto.ethereum.utils import getLogs
+from sto.ethereum.blocks import BlockHeaderResolver
+from sto.ethereum.chunksize import ChunkSizeController, AIMDChunkSizeController, is_range_overload_error
+from sto.ethereum.utils import getMultipleEventLogs
 from sto.models.tokenscan import _TokenHolderAccount, _TokenScanStatus
 
 
+def fetch_logs_splitting(logger: Logger, fetch_logs: Callable, start_block: int, end_block: int) -> Tuple[list, float, List[int]]:
+    """Read logs for certain blocks, splitting the range if the node cannot serve it at once.
+
+    :param fetch_logs: Function (start block, end block) -> list of logs doing the actual JSON-RPC
+    :return: Tuple (logs, seconds the last successful request took, sizes of the block ranges that failed)
+    """
+    failed_ranges = []
+    pending = [(start_block, end_block)]
+    logs = []
+    duration = 0
+
+    while pending:
+        range_start, range_end = pending.pop()
+        started = time.time()
+        try:
+            logs += fetch_logs(range_start, range_end)
+        except Exception as e:
+            if range_start == range_end or not is_range_overload_error(e):
+                raise
+            block_count = range_end - range_start + 1
+            logger.info("Node could not serve logs for blocks %d - %d, splitting: %s", range_start, range_end, e)
+            failed_ranges.append(block_count)
+            middle = range_start + block_count // 2
+            # Pop the first half first, so logs stay in block order
+            pending.append((middle, range_end))
+            pending.append((range_start, middle - 1))
+            continue
+        duration = time.time() - started
+
+    return logs, duration, failed_ranges
+
+
+def iterate_log_ranges(logger: Logger, fetch_logs: Callable, start_block: int, end_block: int, controller: ChunkSizeController, prefetch_depth=0) -> Iterable[Tuple[int, int, list]]:
+    """Walk a block range in chunks sized by the chunk size controller.
+
+    :param fetch_logs: Function (start block, end block) -> list of logs. Must be thread-safe when prefetching.
+    :param prefetch_depth: How many upcoming block ranges we fetch in worker threads while the caller processes the current range.
+        Ranges are still yielded strictly in block order. Zero disables the pipeline.
+    :return: Iterable of (range start block, range end block, logs) tuples
+    """
+
+    # (start block, end block, future) of block ranges being fetched ahead, in block order
+    prefetched = collections.deque()
+    current_block = next_prefetch_block = start_block
+    executor = ThreadPoolExecutor(max_workers=prefetch_depth) if prefetch_depth > 0 else None
+
+    try:
+        while current_block <= end_block:
+
+            chunk_size = controller.get_chunk_size()
+
+            if executor:
+                # Keep the workers busy with upcoming ranges using the latest chunk size estimate
+                while len(prefetched) < prefetch_depth and next_prefetch_block <= end_block:
+                    prefetch_end = min(next_prefetch_block + chunk_size - 1, end_block)
+                    prefetched.append((next_prefetch_block, prefetch_end, executor.submit(fetch_logs_splitting, logger, fetch_logs, next_prefetch_block, prefetch_end)))
+                    next_prefetch_block = prefetch_end + 1
+
+                current_block, current_end, future = prefetched.popleft()
+                logs, fetch_duration, failed_ranges = future.result()
+            else:
+                # Where does our current chunk scan ends - are we out of chain yet?
+                current_end = min(current_block + chunk_size - 1, end_block)
+                logs, fetch_duration, failed_ranges = fetch_logs_splitting(logger, fetch_logs, current_block, current_end)
+
+            # Tell the chunk size controller how the node coped
+            for block_count in failed_ranges:
+                controller.record_failure(block_count)
+            if not failed_ranges:
+                controller.record_success(current_end - current_block + 1, len(logs), fetch_duration)
+
+            yield current_block, current_end, logs
+
+            # Set where the next chunk starts
+            current_block = current_end + 1
+    finally:
+        if executor:
+            for _, _, future in prefetched:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
 class TokenScanner:
     """Scan blockchain for token transfer events and build a database of balances at certain timepoints (blocks)."""
 
     #: How far back in the past we jump to detect works in incremental rescans
     NUM_BLOCKS_RESCAN_FOR_FORKS = 10
 
-    def __init__(self, logger: Logger, network: str, dbsession: Session, web3: Web3, abi: dict, token_address: str, TokenScanStatus: type, TokenHolderDelta: type, TokenHolderAccount: type):
+    def __init__(self, logger: Logger, network: str, dbsession: Session, web3: Web3, abi: dict, token_address: str, TokenScanStatus: type, TokenHolderDelta: type, TokenHolderAccount: type, BlockHeader: Optional[type]=None, block_header_batch_size: int=100, chunk_size_controller: Optional[ChunkSizeController]=None, snapshot_interval: Optional[int]=None, snapshot_retention: Optional[int]=None):
 
         assert isinstance(web3, Web3)
 
@@ -34,24 +120,26 @@ class TokenScanner:
         self.TokenScanStatus = TokenScanStatus  #: type sto.models.implementation.TokenScanStatus
         self.TokenHolderDelta = TokenHolderDelta #: type sto.models.implementation.TokenHolderDelta
         self.TokenHolderAccount = TokenHolderAccount #: type sto.models.implementation.TokenHolderAccount]
+        self.BlockHeader = BlockHeader #: type sto.models.implementation.BlockHeader
+
+        # How many blocks we ask per eth_getLogs request.
+        # The tuning state is loaded from and saved to the scan status, so later runs start warm.
+        self.chunk_size_controller = chunk_size_controller or AIMDChunkSizeController()
 
-        # What is the minimim
-        self.min_scan_chunk_size = 10 # 12 s/block = 120 seconds period
+        # Materialise balance snapshots every this many blocks and keep this many of them
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_retention = snapshot_retention
 
-        # This should not exceed the reply size where Infura timeouts when it tries to dump
-        # Tranfer events over this many blocks
-        if network == "kovan":
-            # Hack to speed up test token scans
-            self.max_scan_chunk_size = 500000
-        else:
-            self.max_scan_chunk_size = 10000
+        # Write each chunk with bulk SQL statements instead of going through ORM object by object
+        self.bulk_ingest = True
 
-        # Factor how fast we increase the chunk size if results are found
-        # # (slow down scan after starting to get hits)
-        self.chunk_size_decrease = 0.5
+        # Holder address -> account id of this token, filled as the scan meets addresses.
+        # Repeated holders like exchanges do not need a database lookup for every transfer.
+        self.account_ids = {}
 
-        # Factor how was we increase chunk size if no results found
-        self.chunk_size_increase = 5.0
+        # Block timestamps are resolved with JSON-RPC batches of this many blocks,
+        # going through the persistent header cache when we have one
+        self.block_headers = BlockHeaderResolver(web3, batch_size=block_header_batch_size, dbsession=dbsession, network=network, BlockHeaderModel=BlockHeader)
 
     @property
     def address(self):
@@ -101,21 +189,35 @@ class TokenScanner:
 
     def get_block_timestamp(self, block_num) -> datetime.datetime:
         """Get Ethereum block timestamp"""
-        block_info = self.web3.eth.getBlock(block_num)
-        last_time = block_info["timestamp"]
-        return datetime.datetime.utcfromtimestamp(last_time)
+        return self.block_headers.get_block_timestamp(block_num)
 
     def get_suggested_scan_start_block(self):
         """Get where we should start to scan for new token events.
 
         If there are no prior scans start from block 1.
-        Otherwise start from the last end block minus ten blocks.
+
+        Otherwise compare the hashes this token recorded for the blocks it has scanned against the canonical chain
+        and continue right after the last block that is still canonical.
+        When there has been no reorg this is the block after the last end block and no data needs to be purged.
+        If even the oldest recorded block got forked away, the token is scanned again from its first block.
+
+        Without recorded block hashes (a database from an older version)
+        start from the last end block minus ten blocks.
         We rescan the last ten scanned blocks in the case there were forks to avoid
         misaccounting due to minor single block works (happens once in a hour in Ethereum).
-        These heurestics could be made more robust, but this is for the sake of simple reference implementation.
         """
         status = self.get_or_create_status()
         if status.end_block:
+
+            if status.scanned_block_hashes:
+                fork_point = self.block_headers.find_fork_point(status.scanned_block_hashes)
+                if fork_point is None:
+                    self.logger.warning("Chain reorganisation deeper than the recorded block hashes, rescanning token from block %d", status.start_block or 1)
+                    return max(1, status.start_block or 1)
+                if fork_point <= status.end_block:
+                    self.logger.info("Chain reorganisation detected, rescanning from block %d", fork_point)
+                return max(1, fork_point)
+
             return max(1, status.end_block - TokenScanner.NUM_BLOCKS_RESCAN_FOR_FORKS)
         return 1
 
@@ -131,6 +233,14 @@ class TokenScanner:
         """Purge old data in the case of a rescan."""
         status = self.get_or_create_status()
         self.TokenHolderDelta.delete_potentially_forked_block_data(status, after_block)
+        status.delete_balance_snapshots_after(after_block)
+        status.delete_scanned_block_hashes_after(after_block)
+
+    def update_balance_snapshots(self):
+        """Create periodic balance snapshots for the scanned blocks, if enabled."""
+        if self.snapshot_interval:
+            status = self.get_or_create_status()
+            status.create_periodic_balance_snapshots(self.snapshot_interval, self.snapshot_retention)
 
     def get_or_create_account(self, token_holder: str) -> _TokenHolderAccount:
         """Denormalize the token balance.
@@ -139,7 +249,7 @@ class TokenScanner:
         """
         assert token_holder.startswith("0x")
         status = self.get_or_create_status()
-        return status.get_or_create_account(token_holder)
+        return status.get_or_create_account(token_holder, self.account_ids)
 
     def create_deltas(self, block_num: int, block_when: datetime, txid: str, idx: int, from_: str, to_: str, value: int):
         """Creates token balance change events in the database.
@@ -147,88 +257,101 @@ class TokenScanner:
         For each token transfer we create debit and credit events, so that we can nicely sum the total balance of the account.
         """
         status = self.get_or_create_status()
-        status.create_deltas(block_num, block_when, txid, idx, from_, to_, value, self.TokenHolderDelta)
+        status.create_deltas(block_num, block_when, txid, idx, from_, to_, value, self.TokenHolderDelta, self.account_ids)
         self.dbsession.flush()
 
-    def scan_chunk(self, start_block, end_block) -> Set[str]:
-        """Populate TokenHolderStatus for certain blocks.
+    def fetch_logs(self, start_block, end_block) -> list:
+        """Read token events for certain blocks from the node.
 
-        :return: Set of addresses where balance changes between scans.
+        Only does JSON-RPC and no database access, so this can be run in a worker thread.
+
+        :return: Decoded events in (block number, log index) order
         """
 
-        mutated_addresses = set()
         token = self.get_token_contract(self.address)
 
         # Discriminate between ERC-20 transfer and ERC-667
         # The latter is not used anywhere yet AFAIK
         Transfer = token.events.Transfer("from", "to", "value")
         Issued = token.events.Issued("to", "value")
-        block_timestamps = {}
-        get_block_timestamp = self.get_block_timestamp
 
-        # Cache block timestamps to reduce some RPC overhead
-        # Real solution would be smarter models around block
-        def get_block_when(block_num):
-            if not block_num in block_timestamps:
-                block_timestamps[block_num] = get_block_timestamp(block_num)
-            return block_timestamps[block_num]
+        # Both event types with one eth_getLogs round trip
+        return getMultipleEventLogs([Issued, Transfer], fromBlock=start_block, toBlock=end_block)
 
-        for event_type in [Issued, Transfer]:
+    def fetch_logs_splitting(self, start_block, end_block) -> Tuple[list, float, List[int]]:
+        """Read token events for certain blocks, splitting the range if the node cannot serve it at once.
 
-            # events = event_type.createFilter(fromBlock=start_block, toBlock=end_block).get_all_entries()
+        :return: Tuple (logs, seconds the last successful request took, sizes of the block ranges that failed)
+        """
+        return fetch_logs_splitting(self.logger, self.fetch_logs, start_block, end_block)
 
-            events = getLogs(event_type, fromBlock=start_block, toBlock=end_block)
+    def decode_chunk(self, start_block, end_block) -> List[tuple]:
+        """Read token events for certain blocks and decode them to plain tuples.
 
-            # AttributeDict({'args': AttributeDict({'from': '0xDE5bC059aA433D72F25846bdFfe96434b406FA85', 'to': '0x0bdcc26C4B8077374ba9DB82164B77d6885b92a6', 'value': 300000000000000000000}), 'event': 'Transfer', 'logIndex': 0, 'transactionIndex': 0, 'transactionHash': HexBytes('0x973eb270e311c23dd6173a9092c9ad4ee8f3fe24627b43c7ad75dc2dadfcbdf9'), 'address': '0x890042E3d93aC10A426c7ac9e96ED6416B0cC616', 'blockHash': HexBytes('0x779f55173414a7c0df0d9fc0ab3fec461a66ceeee0b4058e495d98830c92abf8'), 'blockNumber': 7})
-            for e in events:
-                idx = e["logIndex"]  # nteger of the log index position in the block. null when its pending log.
-                if idx is None:
-                    raise RuntimeError("Somehow tried to scan a pending block")
+        :return: List of (block_num, block_when, txid, idx, from_, to_, value) tuples as consumed by :py:meth:`ingest_events`
+        """
+        logs, duration, failed_ranges = self.fetch_logs_splitting(start_block, end_block)
+        return self.decode_logs(logs)
 
-                if e["event"] == "Issued":
-                    # New issuances pop up from empty air - mark this specially in the database.
-                    # Also some ERC-20 tokens use Transfer from null address to symbolise issuance.
-                    from_ = self.TokenScanStatus.NULL_ADDRESS
-                else:
-                    from_ = e["args"]["from"]
-                    mutated_addresses.add(e["args"]["from"])
+    def decode_logs(self, logs: list) -> List[tuple]:
+        """Resolve block timestamps for fetched logs and decode them to plain tuples."""
 
-                block_when = get_block_when(e["blockNumber"])
+        events = []
 
-                self.create_deltas(e["blockNumber"], block_when, e["transactionHash"].hex(), idx, from_, e["args"]["to"], e["args"]["value"])
-                self.logger.debug("Imported %s, token:%s block:%d from:%s to:%s value:%s", e["event"], self.address, e["blockNumber"], from_, e["args"]["to"], e["args"]["value"])
+        # Get timestamps for all blocks in one go
+        headers = self.block_headers.fetch_headers(set(e["blockNumber"] for e in logs))
 
-                mutated_addresses.add(e["args"]["to"])
+        # AttributeDict({'args': AttributeDict({'from': '0xDE5bC059aA433D72F25846bdFfe96434b406FA85', 'to': '0x0bdcc26C4B8077374ba9DB82164B77d6885b92a6', 'value': 300000000000000000000}), 'event': 'Transfer', 'logIndex': 0, 'transactionIndex': 0, 'transactionHash': HexBytes('0x973eb270e311c23dd6173a9092c9ad4ee8f3fe24627b43c7ad75dc2dadfcbdf9'), 'address': '0x890042E3d93aC10A426c7ac9e96ED6416B0cC616', 'blockHash': HexBytes('0x779f55173414a7c0df0d9fc0ab3fec461a66ceeee0b4058e495d98830c92abf8'), 'blockNumber': 7})
+        for e in logs:
+            idx = e["logIndex"]  # nteger of the log index position in the block. null when its pending log.
+            if idx is None:
+                raise RuntimeError("Somehow tried to scan a pending block")
 
-        return mutated_addresses
+            if e["event"] == "Issued":
+                # New issuances pop up from empty air - mark this specially in the database.
+                # Also some ERC-20 tokens use Transfer from null address to symbolise issuance.
+                from_ = self.TokenScanStatus.NULL_ADDRESS
+            else:
+                from_ = e["args"]["from"]
 
-    def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int):
-        """Try to figure out optimal chunk size
+            block_when = headers[e["blockNumber"]].timestamp
 
-        Our scanner might need to scan the whole blockchain for all events
+            events.append((e["blockNumber"], block_when, e["transactionHash"].hex(), idx, from_, e["args"]["to"], e["args"]["value"]))
 
-        * We want to minimize API calls over empty blocks
+        return events
 
-        * We want to make sure that one scan chunk does not try to process too many entries once, as we try to control commit buffer size and potentially asynchronous busy loop
+    def ingest_events(self, events: List[tuple]) -> Set[str]:
+        """Write decoded token events to the database.
 
-        * Do not overload node serving JSON-RPC API
+        :return: Set of addresses where balance changes between scans.
+        """
 
-        TODO: eth_getLogs does not provide meaningful way to get the block number when events start. Make a feature request. Somewhere.
+        mutated_addresses = set()
 
-        This heurestics exponentially increases and the scan chunk size depending on if we are seeing events or not.
-        When any transfers are encountered we are back to scan only few blocks at the time.
-        It does not make sense to do a full chain scan starting from block 1, doing one JSON-RPC call per 20 blocks.
-        """
+        if self.bulk_ingest:
+            status = self.get_or_create_status()
+            status.bulk_create_deltas(events, self.TokenHolderDelta, self.account_ids)
 
-        if event_found_count > 0:
-            # When we encounter first events then reset the chunk size window
-            current_chuck_size = self.min_scan_chunk_size
-        else:
-            current_chuck_size *= self.chunk_size_increase
+        for block_num, block_when, txid, idx, from_, to_, value in events:
 
-        current_chuck_size = max(self.min_scan_chunk_size, current_chuck_size)
-        current_chuck_size = min(self.max_scan_chunk_size, current_chuck_size)
-        return int(current_chuck_size)
+            if not self.bulk_ingest:
+                self.create_deltas(block_num, block_when, txid, idx, from_, to_, value)
+
+            self.logger.debug("Imported transfer, token:%s block:%d from:%s to:%s value:%s", self.address, block_num, from_, to_, value)
+
+            if from_ != self.TokenScanStatus.NULL_ADDRESS:
+                mutated_addresses.add(from_)
+            mutated_addresses.add(to_)
+
+        return mutated_addresses
+
+    def scan_chunk(self, start_block, end_block) -> Set[str]:
+        """Populate TokenHolderStatus for certain blocks.
+
+        :return: Set of addresses where balance changes between scans.
+        """
+        events = self.decode_chunk(start_block, end_block)
+        return self.ingest_events(events)
 
     def update_scan_status(self, start_block, end_block):
         # Update token scan status
@@ -236,18 +359,27 @@ class TokenScanner:
         if not status.start_block:
             status.start_block = start_block
 
+        header = self.block_headers.get_header(end_block)
         status.end_block = end_block
-        status.end_block_timestamp = self.get_block_timestamp(status.end_block)
+        status.end_block_timestamp = header.timestamp
+        status.record_scanned_block_hash(header.block_num, header.block_hash)
 
-    def scan(self, start_block, end_block, start_chunk_size=20, progress_callback=Optional[Callable]) -> dict:
+    def scan(self, start_block, end_block, start_chunk_size: Optional[int]=None, progress_callback: Optional[Callable]=None, prefetch_depth=0) -> dict:
         """Perform a token balances scan.
 
         Assumes all balances in the database are valid before start_block (no forks sneaked in).
 
+        Each block range is committed together with the scan status, so an interrupted scan continues after the last committed range.
+
         :param start_block: The first block included in the scan
 
         :param end_block: The last block included in the scan
 
+        :param start_chunk_size: How many blocks to ask in the first eth_getLogs request. If not given continue with the chunk size tuning from the last scan.
+
+        :param prefetch_depth: How many upcoming block ranges we fetch with ``eth_getLogs`` in worker threads while the current range is written to the database.
+            Ranges are still written and the scan status advanced strictly in block order. Zero disables the pipeline.
+
         :return: Address -> last balance mapping for all address balances that changed during those blocks
         """
 
@@ -256,52 +388,172 @@ class TokenScanner:
         self.delete_potentially_forked_block_data(start_block)
         self.update_token_info()
 
-        current_block = start_block
         updated_token_holders = set()  # Token holders that get updates
 
         # Scan in chunks, commit between
-        chunk_size = start_chunk_size
-        mutated_addresses = set()
-        last_scan_duration = last_logs_found = 0
         status = self.get_or_create_status()
+        controller = self.chunk_size_controller
+        controller.load_state(status.chunk_size_tuning)
+        if start_chunk_size:
+            controller.chunk_size = start_chunk_size
+        last_scan_duration = last_logs_found = 0
+        start = time.time()
 
-        while current_block <= end_block:
+        for current_block, current_end, logs in iterate_log_ranges(self.logger, self.fetch_logs, start_block, end_block, controller, prefetch_depth):
 
-            # Where does our current chunk scan ends - are we out of chain yet?
-            current_end = min(current_block + chunk_size, end_block)
+            # Resolve timestamps for the event blocks and the end block of the scan status in a single batch
+            self.block_headers.fetch_headers(set(e["blockNumber"] for e in logs) | {current_end})
 
             # Print some diagnostics to logs to try to fiddle with real world JSON-RPC API performance
-            self.logger.debug("Scanning token transfers for blocks: %d - %d, chunk size %d, last chunk scan took %f, last logs found %d", current_block, current_end, chunk_size, last_scan_duration, last_logs_found)
-            start = time.time()
+            self.logger.debug("Scanning token transfers for blocks: %d - %d, last chunk scan took %f, last logs found %d", current_block, current_end, last_scan_duration, last_logs_found)
 
             # Process blocks for this token over eth_getLogs
-            mutated_addresses = self.scan_chunk(current_block, current_end)
+            mutated_addresses = self.ingest_events(self.decode_logs(logs))
             last_scan_duration = time.time() - start
-            last_logs_found = len(mutated_addresses)
+            last_logs_found = len(logs)
+            start = time.time()
 
             # Manage the list of what addresses our scan has touched
             updated_token_holders.update(mutated_addresses)
 
             # Persistent the state how are along we are in the scan
             self.update_scan_status(start_block, current_end)
+            status.chunk_size_tuning = controller.get_state()
 
-            # Update database on the disk
-            self.dbsession.flush()
+            # Update database on the disk, range by range in block order
+            self.dbsession.commit()
 
             # Print progress bar
             if progress_callback:
-                progress_callback(start_block, end_block, current_block, chunk_size)
-
-            # Try to guess who many blocks we try to fetch over eth_getLogs API next time
-            chunk_size = self.estimate_next_chunk_size(chunk_size, len(mutated_addresses))
-
-            # Set where the next chunk starts
-            current_block = current_end + 1
+                progress_callback(start_block, end_block, current_block, current_end - current_block + 1)
 
         # Calculate balances to all accounts that have not seen new total since the last scan
         status.update_denormalised_balances()
-        self.dbsession.flush()  # Write latest balances
+        self.update_balance_snapshots()
+        self.dbsession.commit()  # Write latest balances
 
-        result = status.get_raw_balances(mutated_addresses)
+        result = status.get_raw_balances(updated_token_holders, self.account_ids)
         return result
 
+
+class MultiTokenScanner:
+    """Scan several tokens in a single pass over the chain.
+
+    One ``eth_getLogs`` request covers all tokens using an address array.
+    The logs are demultiplexed by the emitting contract to per token :py:class:`TokenScanner` instances,
+    and the scan status cursors of all tokens advance together.
+    Block headers and chunk size tuning are shared between the tokens.
+    """
+
+    def __init__(self, logger: Logger, network: str, dbsession: Session, web3: Web3, abi: dict, token_addresses: List[str], TokenScanStatus: type, TokenHolderDelta: type, TokenHolderAccount: type, BlockHeader: Optional[type]=None, block_header_batch_size: int=100, chunk_size_controller: Optional[ChunkSizeController]=None, snapshot_interval: Optional[int]=None, snapshot_retention: Optional[int]=None):
+
+        assert token_addresses, "No tokens to scan"
+
+        self.logger = logger
+        self.network = network
+        self.dbsession = dbsession
+        self.web3 = web3
+        self.chunk_size_controller = chunk_size_controller or AIMDChunkSizeController()
+        self.block_headers = BlockHeaderResolver(web3, batch_size=block_header_batch_size, dbsession=dbsession, network=network, BlockHeaderModel=BlockHeader)
+
+        #: Lowercased token address -> scanner of that token
+        self.scanners = collections.OrderedDict()
+        for token_address in token_addresses:
+            scanner = TokenScanner(logger, network, dbsession, web3, abi, token_address, TokenScanStatus, TokenHolderDelta, TokenHolderAccount, BlockHeader, block_header_batch_size, self.chunk_size_controller, snapshot_interval, snapshot_retention)
+            scanner.block_headers = self.block_headers
+            self.scanners[token_address.lower()] = scanner
+
+    def get_suggested_scan_start_blocks(self) -> Dict[str, int]:
+        """Get where each token should continue scanning, see :py:meth:`TokenScanner.get_suggested_scan_start_block`.
+
+        :return: Lowercased token address -> start block
+        """
+        return {address: scanner.get_suggested_scan_start_block() for address, scanner in self.scanners.items()}
+
+    def get_suggested_scan_end_block(self):
+        """Get the last mined block."""
+        return self.web3.eth.blockNumber
+
+    def fetch_logs(self, start_block, end_block) -> list:
+        """Read events of all tokens for certain blocks from the node.
+
+        Only does JSON-RPC and no database access, so this can be run in a worker thread.
+        """
+        scanners = list(self.scanners.values())
+
+        # All tokens share the same ABI, so any of them can decode the events
+        token = scanners[0].get_token_contract(scanners[0].address)
+        Transfer = token.events.Transfer("from", "to", "value")
+        Issued = token.events.Issued("to", "value")
+
+        return getMultipleEventLogs([Issued, Transfer], fromBlock=start_block, toBlock=end_block, address=[to_checksum_address(s.address) for s in scanners])
+
+    def scan(self, start_blocks: Dict[str, int], end_block: int, start_chunk_size: Optional[int]=None, progress_callback: Optional[Callable]=None, prefetch_depth=0) -> Dict[str, dict]:
+        """Perform a token balances scan for all tokens.
+
+        The scan starts from the earliest start block. Events of a token before its own start block
+        have already been processed and are ignored.
+
+        :param start_blocks: Lowercased token address -> the first block included in the scan of that token
+        :param end_block: The last block included in the scan
+        :param start_chunk_size: How many blocks to ask in the first eth_getLogs request
+        :param prefetch_depth: How many upcoming block ranges we fetch in worker threads, see :py:meth:`TokenScanner.scan`
+        :return: Lowercased token address -> address -> last balance mapping for balances that changed during the scan
+        """
+
+        # Tokens that are already up to date are left alone
+        scanners = {address: scanner for address, scanner in self.scanners.items() if start_blocks[address] <= end_block}
+        if not scanners:
+            return {}
+
+        start_block = min(start_blocks[address] for address in scanners)
+
+        for address, scanner in scanners.items():
+            scanner.delete_potentially_forked_block_data(start_blocks[address])
+            scanner.update_token_info()
+
+        statuses = {address: scanner.get_or_create_status() for address, scanner in scanners.items()}
+        updated_token_holders = {address: set() for address in scanners}
+
+        controller = self.chunk_size_controller
+        controller.load_state(next(iter(statuses.values())).chunk_size_tuning)
+        if start_chunk_size:
+            controller.chunk_size = start_chunk_size
+
+        for current_block, current_end, logs in iterate_log_ranges(self.logger, self.fetch_logs, start_block, end_block, controller, prefetch_depth):
+
+            # Resolve timestamps for the event blocks and the end block of the scan status in a single batch
+            self.block_headers.fetch_headers(set(e["blockNumber"] for e in logs) | {current_end})
+
+            logs_by_token = collections.defaultdict(list)
+            for e in logs:
+                address = e["address"].lower()
+                if address in scanners and e["blockNumber"] >= start_blocks[address]:
+                    logs_by_token[address].append(e)
+
+            self.logger.debug("Scanning token transfers for blocks: %d - %d, logs found %d", current_block, current_end, len(logs))
+
+            for address, scanner in scanners.items():
+                if current_end < start_blocks[address]:
+                    continue
+
+                mutated_addresses = scanner.ingest_events(scanner.decode_logs(logs_by_token[address]))
+                updated_token_holders[address].update(mutated_addresses)
+
+                scanner.update_scan_status(start_blocks[address], current_end)
+                statuses[address].chunk_size_tuning = controller.get_state()
+
+            # Commit ranges in block order, see TokenScanner.scan
+            self.dbsession.commit()
+
+            if progress_callback:
+                progress_callback(start_block, end_block, current_block, current_end - current_block + 1)
+
+        result = {}
+        for address, status in statuses.items():
+            status.update_denormalised_balances()
+            scanners[address].update_balance_snapshots()
+            result[address] = status.get_raw_balances(updated_token_holders[address], scanners[address].account_ids)
+
+        self.dbsession.commit()
+        return result
@@ -1,13 +1,14 @@
+import time
 from logging import Logger
-from tqdm import tqdm
 
+from sto.ethereum.blocks import BlockHeaderResolver
 from sto.ethereum.txservice import EthereumStoredTXService
 from sto.ethereum.utils import check_good_private_key, create_web3
 from sto.models.implementation import BroadcastAccount, PreparedTransaction
 from eth_account import Account
 from eth_utils import to_bytes, from_wei
 from sqlalchemy.orm import Session
-from typing import Union
+from typing import Union, Optional, List
 from web3 import Web3, HTTPProvider
 
 
@@ -19,8 +20,13 @@ def update_status(logger: Logger,
               ethereum_gas_limit: str,
               ethereum_gas_price: str,
               commit=True,
+              batch_size=100,
 ):
-    """Issue out a new Ethereum token."""
+    """Update the status of broadcasted transactions.
+
+    Receipts are polled with JSON-RPC batches of ``batch_size`` and all results are written with a single commit.
+    Transactions that cannot be mined yet because of their nonce are left out of polling.
+    """
 
     check_good_private_key(ethereum_private_key)
 
@@ -38,10 +44,101 @@ def update_status(logger: Logger,
 
     unfinished_txs = list(unfinished_txs)
 
-    # https://stackoverflow.com/questions/41985993/tqdm-show-progress-for-a-generator-i-know-the-length-of
-    for tx in tqdm(unfinished_txs):
-        service.update_status(tx)
-        if commit:
-            dbsession.commit()  # Try to minimise file system sync issues
+    polled = service.update_statuses(unfinished_txs, batch_size)
+    logger.info("Polled receipts for %d transactions, %d wait for earlier nonces", len(polled), len(unfinished_txs) - len(polled))
+
+    if commit:
+        dbsession.commit()
 
     return unfinished_txs
+
+
+def watch_status(logger: Logger,
+              dbsession: Session,
+              network: str,
+              ethereum_node_url: Union[str, Web3],
+              ethereum_private_key: str,
+              ethereum_gas_limit: str,
+              ethereum_gas_price: str,
+              confirmations=12,
+              poll_interval=15.0,
+              batch_size=100,
+              max_blocks_per_poll=1000,
+              max_polls: Optional[int]=None,
+              commit=True,
+) -> List[PreparedTransaction]:
+    """Follow new blocks until all broadcasted transactions are mined and confirmed.
+
+    Each poll reads only the blocks added since the last poll and matches their transaction hashes
+    against our unmined transactions, see :py:meth:`EthereumStoredTXService.match_blocks`.
+    The last watched block is stored with the broadcast account, so the next run continues from there.
+    Its hash is recorded too, and when a chain reorganisation replaces watched blocks
+    we rewind to the last block that is still canonical and match the new blocks again.
+    On the first run, after a reorganisation deeper than the recorded hashes and after a reorganisation dropped one of our transactions,
+    we catch up once by polling receipts of all unmined transactions.
+
+    :param confirmations: How many blocks deep a transaction must be to be final
+    :param poll_interval: Seconds to sleep between polls
+    :param max_polls: Stop after this many polls even if transactions are still waiting
+    :return: Transactions that got mined while watching
+    """
+
+    check_good_private_key(ethereum_private_key)
+
+    web3 = create_web3(ethereum_node_url)
+
+    service = EthereumStoredTXService(network, dbsession, web3, ethereum_private_key, ethereum_gas_price, ethereum_gas_limit, BroadcastAccount, PreparedTransaction)
+
+    account = service.get_or_create_broadcast_account()
+
+    block_headers = BlockHeaderResolver(web3, batch_size=batch_size)
+
+    mined = {}
+    polls = 0
+    while True:
+        head_block = web3.eth.blockNumber
+
+        if account.watched_block_num is not None and account.watched_block_hashes:
+            fork_point = block_headers.find_fork_point(account.watched_block_hashes)
+            if fork_point is None:
+                logger.warning("Chain reorganisation deeper than the watched block hashes, polling all receipts again")
+                account.watched_block_num = account.watched_block_hashes = None
+            elif fork_point <= account.watched_block_num:
+                logger.warning("Chain reorganisation detected, watching again from block %d", fork_point)
+                account.watched_block_num = fork_point - 1
+                account.delete_watched_block_hashes_after(fork_point)
+
+        if account.watched_block_num is None:
+            unfinished_txs = list(service.get_unmined_txs())
+            polled = service.update_statuses(unfinished_txs, batch_size)
+            mined.update({tx.id: tx for tx in polled if tx.result_block_num is not None})
+            account.watched_block_num = head_block
+        elif head_block > account.watched_block_num:
+            end_block = min(head_block, account.watched_block_num + max_blocks_per_poll)
+            for tx in service.match_blocks(account.watched_block_num + 1, end_block, batch_size):
+                logger.info("Transaction %s with nonce %d mined in block %d", tx.txid, tx.nonce, tx.result_block_num)
+                mined[tx.id] = tx
+            account.watched_block_num = end_block
+
+        header = block_headers.get_header(account.watched_block_num)
+        account.record_watched_block_hash(header.block_num, header.block_hash)
+
+        dropped = service.update_confirmations(account.watched_block_num, confirmations, batch_size)
+        if dropped:
+            logger.warning("%d transactions dropped out of the chain in a reorganisation, polling all receipts again", len(dropped))
+            account.watched_block_num = account.watched_block_hashes = None
+
+        if commit:
+            dbsession.commit()
+
+        waiting = service.get_unmined_txs().filter(PreparedTransaction.broadcasted_at != None).count()
+        unconfirmed = service.get_unconfirmed_txs(confirmations).count()
+        logger.info("Watched up to block %s, %d transactions waiting to be mined, %d waiting for %d confirmations", account.watched_block_num, waiting, unconfirmed, confirmations)
+
+        polls += 1
+        if not (waiting or unconfirmed or dropped) or (max_polls and polls >= max_polls):
+            break
+
+        time.sleep(poll_interval)
+
+    return list(mined.values())
@@ -2,14 +2,14 @@ from logging import Logger
 
 import colorama
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import Optional, List, Dict
 
 from tqdm import tqdm
 
-from sto.ethereum.scanner import TokenScanner
+from sto.ethereum.scanner import TokenScanner, MultiTokenScanner
 from sto.ethereum.utils import get_abi, create_web3
 
-from sto.models.implementation import TokenScanStatus, TokenHolderDelta,TokenHolderAccount
+from sto.models.implementation import BlockHeader, get_token_models
 
 
 def token_scan(logger: Logger,
@@ -19,13 +19,19 @@ def token_scan(logger: Logger,
               ethereum_abi_file: Optional[str],
               token_address: str,
               start_block: Optional[int]=None,
-              end_block: Optional[int]=None) -> dict:
+              end_block: Optional[int]=None,
+              prefetch_depth: int=0,
+              snapshot_interval: Optional[int]=None,
+              snapshot_retention: Optional[int]=None) -> dict:
     """Command line entry point to scan token network for events.
 
     By giving a block range in the middle of existing scanned range you can potentially screw up internal accounting.
 
-    :param start_block: Block from where start scanning. If not given start from the first block or minus then of the last scanned block minus ten blocks.
+    :param start_block: Block from where start scanning. If not given start from the first block or continue after the last scanned block, rewinding over any chain reorganisation.
     :param end_block: Block to where stop scanning. If not given scan to the latest mined block.
+    :param prefetch_depth: How many block ranges to fetch from the node ahead of the database writes
+    :param snapshot_interval: Materialise balance snapshots every this many blocks
+    :param snapshot_retention: How many periodic balance snapshots to keep
     :return: Mapping of address -> final amount of all addresses that were touched during the block range
     """
 
@@ -33,7 +39,9 @@ def token_scan(logger: Logger,
 
     web3 = create_web3(ethereum_node_url)
 
-    scanner = TokenScanner(logger, network, dbsession, web3, abi, token_address, TokenScanStatus, TokenHolderDelta, TokenHolderAccount)
+    models = get_token_models(dbsession)
+
+    scanner = TokenScanner(logger, network, dbsession, web3, abi, token_address, models.TokenScanStatus, models.TokenHolderDelta, models.TokenHolderAccount, BlockHeader, snapshot_interval=snapshot_interval, snapshot_retention=snapshot_retention)
 
     if start_block is None:
         start_block = scanner.get_suggested_scan_start_block()
@@ -54,11 +62,71 @@ def token_scan(logger: Logger,
     if last_scanned_block:
         logger.info("Last scan ended at block: %s%d%s", colorama.Fore.LIGHTGREEN_EX, last_scanned_block, colorama.Fore.RESET)
 
+    if start_block > end_block:
+        logger.info("No new blocks to scan")
+        return {}
+
     total = end_block - start_block
     with tqdm(total=total) as progress_bar:
         def _update_progress(start, end, current, chunk_size):
             progress_bar.set_description("Scanning block: {}, batch size: {}".format(current, chunk_size))
             progress_bar.update(chunk_size)
 
-        result = scanner.scan(start_block, end_block, progress_callback=_update_progress)
-    return result
\ No newline at end of file
+        result = scanner.scan(start_block, end_block, progress_callback=_update_progress, prefetch_depth=prefetch_depth)
+    return result
+
+
+def multi_token_scan(logger: Logger,
+              dbsession: Session,
+              network: str,
+              ethereum_node_url: str,
+              ethereum_abi_file: Optional[str],
+              token_addresses: List[str],
+              start_block: Optional[int]=None,
+              end_block: Optional[int]=None,
+              prefetch_depth: int=0,
+              snapshot_interval: Optional[int]=None,
+              snapshot_retention: Optional[int]=None) -> Dict[str, dict]:
+    """Command line entry point to scan several tokens with a single pass over the chain.
+
+    :param start_block: Block from where start scanning all tokens. If not given each token continues after its own last scanned block.
+    :param end_block: Block to where stop scanning. If not given scan to the latest mined block.
+    :param prefetch_depth: How many block ranges to fetch from the node ahead of the database writes
+    :param snapshot_interval: Materialise balance snapshots every this many blocks
+    :param snapshot_retention: How many periodic balance snapshots to keep
+    :return: Mapping of lowercased token address -> address -> final amount of all addresses that were touched during the block range
+    """
+
+    abi = get_abi(ethereum_abi_file)
+
+    web3 = create_web3(ethereum_node_url)
+
+    models = get_token_models(dbsession)
+
+    scanner = MultiTokenScanner(logger, network, dbsession, web3, abi, token_addresses, models.TokenScanStatus, models.TokenHolderDelta, models.TokenHolderAccount, BlockHeader, snapshot_interval=snapshot_interval, snapshot_retention=snapshot_retention)
+
+    if start_block is None:
+        start_blocks = scanner.get_suggested_scan_start_blocks()
+    else:
+        start_blocks = {address: start_block for address in scanner.scanners}
+
+    if end_block is None:
+        end_block = scanner.get_suggested_scan_end_block()
+
+    logger.info("Scanning %s%d%s tokens in network %s", colorama.Fore.LIGHTGREEN_EX, len(token_addresses), colorama.Fore.RESET, network)
+
+    first_block = min(start_blocks.values())
+    if first_block > end_block:
+        logger.info("No new blocks to scan")
+        return {}
+
+    logger.info("Scanning blocks: %s%d%s - %s%d%s", colorama.Fore.LIGHTGREEN_EX, first_block, colorama.Fore.RESET, colorama.Fore.LIGHTGREEN_EX, end_block, colorama.Fore.RESET)
+
+    total = end_block - first_block
+    with tqdm(total=total) as progress_bar:
+        def _update_progress(start, end, current, chunk_size):
+            progress_bar.set_description("Scanning block: {}, batch size: {}".format(current, chunk_size))
+            progress_bar.update(chunk_size)
+
+        result = scanner.scan(start_blocks, end_block, progress_callback=_update_progress, prefetch_depth=prefetch_depth)
+    return result
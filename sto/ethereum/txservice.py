@@ -1,3 +1,6 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
 from logging import Logger
 
 import requests
@@ -9,14 +12,18 @@ except ImportError:
     # web3 5.0
     from eth_account._utils.transactions import assert_valid_fields
 
-from sto.ethereum.utils import mk_contract_address, get_constructor_arguments
+from sto.ethereum.utils import mk_contract_address, get_constructor_arguments, batch_rpc_call, to_int_quantity
 from sto.models.broadcastaccount import _BroadcastAccount, _PreparedTransaction
-from sto.models.utils import now
+from sto.models.tokenscan import IN_QUERY_CHUNK_SIZE
+from sto.models.utils import now, chunked
+from eth_abi import encode_abi
 from eth_account import Account
-from eth_utils import to_checksum_address
+from eth_utils import to_checksum_address, function_abi_to_4byte_selector
+from hexbytes import HexBytes
 
+import sqlalchemy as sa
 from sqlalchemy.orm import Session, Query
-from typing import Optional, Iterable
+from typing import Optional, Iterable, List, Tuple, Set
 from web3 import Web3
 from web3.contract import Contract
 
@@ -36,6 +43,36 @@ class CouldNotVerifyOnEtherScan(Exception):
     pass
 
 
+#: Substrings of eth_sendRawTransaction errors telling the node already has the exact same transaction
+ALREADY_KNOWN_ERROR_MESSAGES = (
+    "already known",
+    "known transaction",
+    "already imported",
+)
+
+
+#: Below this many transactions starting worker processes costs more than signing in the current process
+MIN_PARALLEL_SIGNING_BATCH = 64
+
+
+def sign_transaction(unsigned_payload: dict, private_key_hex: str) -> Tuple[str, str]:
+    """Sign a transaction payload.
+
+    A module level function, so that it can be run in worker processes.
+
+    :return: Tuple (txid, raw signed transaction) as hex
+    """
+    signed = Account.signTransaction(unsigned_payload, private_key_hex)
+    return signed.hash.hex(), HexBytes(signed.rawTransaction).hex()
+
+
+def get_rpc_error_message(error) -> str:
+    """JSON-RPC error objects come as dicts over HTTP and as plain messages from some providers."""
+    if isinstance(error, dict):
+        return error.get("message", str(error))
+    return str(error)
+
+
 class EthereumStoredTXService:
     """A transaction service that writes entries to a local database before trying to broadcast them to the blockchain."""
 
@@ -306,6 +343,84 @@ class EthereumStoredTXService:
         self.dbsession.flush()
         return tx
 
+    def get_distributed_external_ids(self, external_ids: Iterable[str], contract_address: str) -> Set[str]:
+        """Which of the external ids already have a transaction against a contract.
+
+        Bulk counterpart of :py:meth:`is_distributed`, asks with IN queries.
+        """
+        found = set()
+        for chunk in chunked(list(external_ids), IN_QUERY_CHUNK_SIZE):
+            q = self.dbsession.query(self.prepared_tx_model.external_id).filter(self.prepared_tx_model.contract_address == contract_address, self.prepared_tx_model.external_id.in_(chunk))
+            found.update(external_id for external_id, in q)
+        return found
+
+    def distribute_tokens_bulk(self, transfers: List[Tuple[str, str, int, str]], token_address: str, abi: dict, contract_name="ERC20", func_name="transfer") -> int:
+        """Send out tokens to many receivers at once.
+
+        Bulk counterpart of :py:meth:`distribute_tokens`. Only the first transfer is built through web3.
+        The rest reuse its fields with their own nonce and calldata encoded straight from the function ABI.
+        Nonces are allocated as one contiguous range and all transactions are written with a single ``executemany`` insert.
+
+        :param transfers: List of (external_id, receiver address, raw amount, note) tuples
+        :return: The number of prepared transactions
+        """
+
+        if not transfers:
+            return 0
+
+        assert token_address.startswith("0x")
+
+        external_ids = [t[0] for t in transfers]
+        if len(set(external_ids)) != len(external_ids):
+            raise RuntimeError("Duplicate external ids in the distribution batch for token:{}".format(token_address))
+
+        already = self.get_distributed_external_ids(external_ids, token_address)
+        if already:
+            raise RuntimeError("Already distributed token:{} ids:{}".format(token_address, ", ".join(sorted(already))))
+
+        contract = self.get_contract_proxy(contract_name, abi, token_address)
+        broadcast_account = self.get_or_create_broadcast_account()
+        first_nonce = broadcast_account.current_nonce
+
+        # Fills in chain id, value and such the same way as distribute_tokens
+        external_id, receiver_address, raw_amount, note = transfers[0]
+        func = getattr(contract.functions, func_name)(receiver_address, raw_amount)
+        template = func.buildTransaction(self.generate_tx_data(first_nonce))
+        assert_valid_fields(template)
+
+        selector = function_abi_to_4byte_selector(func.abi)
+        arg_types = [i["type"] for i in func.abi["inputs"]]
+
+        rows = []
+        for nonce, (external_id, receiver_address, raw_amount, note) in enumerate(transfers, start=first_nonce):
+            assert receiver_address.startswith("0x")
+            assert type(raw_amount) == int
+            assert raw_amount >= 1
+
+            unsigned_payload = dict(template)
+            unsigned_payload["nonce"] = nonce
+            unsigned_payload["data"] = "0x" + (selector + encode_abi(arg_types, [receiver_address, raw_amount])).hex()
+
+            rows.append(dict(
+                broadcast_account_id=broadcast_account.id,
+                nonce=nonce,
+                human_readable_description=note,
+                receiver=receiver_address,
+                contract_address=token_address,
+                contract_deployment=False,
+                unsigned_payload=unsigned_payload,
+                external_id=external_id,
+                other_data={},
+            ))
+
+        assert rows[0]["unsigned_payload"]["data"] == template["data"], "Calldata encoding differs from web3"
+
+        self.dbsession.bulk_insert_mappings(self.prepared_tx_model, rows)
+        broadcast_account.current_nonce = first_nonce + len(rows)
+        self.dbsession.expire(broadcast_account, ["txs"])
+        self.dbsession.flush()
+        return len(rows)
+
     def get_raw_token_balance(self, token_address: str, abi: dict, contract_name="ERC20Basic", func_name="balanceOf") -> int:
         """Check that we have enough token balance for distribute operations."""
 
@@ -334,26 +449,97 @@ class EthereumStoredTXService:
         """All transactions that do not yet have a block assigned."""
         return self.dbsession.query(self.prepared_tx_model).filter(self.prepared_tx_model.txid != None).filter_by(result_block_num=None).join(self.broadcast_account_model).filter_by(network=self.network)
 
+    def get_unconfirmed_txs(self, confirmations: int) -> Query:
+        """Mined transactions that are not yet this many blocks deep."""
+        q = self.dbsession.query(self.prepared_tx_model).filter(self.prepared_tx_model.result_block_num != None).join(self.broadcast_account_model).filter_by(network=self.network)
+        return q.filter(sa.or_(self.prepared_tx_model.result_confirmations == None, self.prepared_tx_model.result_confirmations < confirmations))
+
     def get_last_transactions(self, limit: int) -> Query:
         """Fetch latest transactions."""
         assert type(limit) == int
         return self.dbsession.query(self.prepared_tx_model).order_by(self.prepared_tx_model.created_at.desc()).limit(limit)
 
-    def broadcast(self, tx: _PreparedTransaction):
-        """Push transactions to Ethereum network."""
-
+    def check_broadcast_account(self, tx: _PreparedTransaction):
         if tx.broadcast_account.address != self.address:
             raise AddressConfigurationMismatch("Could not broadcast {} due to address mismatch. A pendign transaction was created for account {}, but we are using configured account {}".format(tx.human_readable_description, tx.broadcast_account.address, self.address))
 
-        tx_data = tx.unsigned_payload
-        signed = self.web3.eth.account.signTransaction(tx_data, self.private_key_hex)
-        tx.txid = signed.hash.hex()
+    def sign(self, tx: _PreparedTransaction) -> str:
+        """Sign a transaction and store its txid.
+
+        :return: Raw signed transaction as hex
+        """
+        self.check_broadcast_account(tx)
+        tx.txid, raw_tx = sign_transaction(tx.unsigned_payload, self.private_key_hex)
+        return raw_tx
+
+    def sign_many(self, txs: List[_PreparedTransaction], workers: Optional[int]=None, min_parallel_batch: int=MIN_PARALLEL_SIGNING_BATCH) -> List[str]:
+        """Sign many transactions using a pool of worker processes and store their txids.
+
+        Signing is CPU bound pure Python, so processes, not threads, make it scale with CPU cores.
+        Results come back in the order of ``txs``, so nonce order is kept.
+
+        :param workers: Number of worker processes, defaults to the number of CPU cores
+        :param min_parallel_batch: Sign fewer transactions than this in the current process
+        :return: Raw signed transactions as hex, in the same order as ``txs``
+        """
+        for tx in txs:
+            self.check_broadcast_account(tx)
+
+        workers = workers or os.cpu_count() or 1
+        payloads = [tx.unsigned_payload for tx in txs]
+
+        if workers == 1 or len(txs) < min_parallel_batch:
+            results = [sign_transaction(payload, self.private_key_hex) for payload in payloads]
+        else:
+            chunksize = max(1, len(payloads) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(sign_transaction, payloads, itertools.repeat(self.private_key_hex), chunksize=chunksize))
 
-        self.web3.eth.sendRawTransaction(signed.rawTransaction)
+        raw_txs = []
+        for tx, (txid, raw_tx) in zip(txs, results):
+            tx.txid = txid
+            raw_txs.append(raw_tx)
+        return raw_txs
+
+    def broadcast(self, tx: _PreparedTransaction):
+        """Push transactions to Ethereum network."""
+
+        raw_tx = self.sign(tx)
+
+        self.web3.eth.sendRawTransaction(raw_tx)
 
         tx.broadcasted_at = now()
         return tx
 
+    def send_signed(self, txs: List[_PreparedTransaction], raw_txs: List[str], batch_size=100) -> List[Optional[str]]:
+        """Push already signed transactions to Ethereum network using JSON-RPC batches.
+
+        Transactions the node accepted, or already had, are marked broadcasted.
+        Rejected transactions get the node error message in :py:attr:`_PreparedTransaction.broadcast_error`
+        and stay pending for the next broadcast.
+
+        :param raw_txs: Signed transactions from :py:meth:`sign`, in the same order as ``txs``
+        :return: Error message for each transaction, None for accepted ones
+        """
+        assert len(txs) == len(raw_txs)
+
+        replies = batch_rpc_call(self.web3, "eth_sendRawTransaction", [[raw_tx] for raw_tx in raw_txs], batch_size)
+
+        errors = []
+        for tx, reply in zip(txs, replies):
+            error = reply.get("error")
+            message = get_rpc_error_message(error) if error else None
+
+            if message and not any(m in message.lower() for m in ALREADY_KNOWN_ERROR_MESSAGES):
+                tx.broadcast_error = message
+                errors.append(message)
+            else:
+                tx.broadcast_error = None
+                tx.broadcasted_at = now()
+                errors.append(None)
+
+        return errors
+
     def update_status(self, tx: _PreparedTransaction):
         """Update tx status from Etheruem network."""
 
@@ -361,18 +547,116 @@ class EthereumStoredTXService:
 
         # https://web3py.readthedocs.io/en/stable/web3.eth.html#web3.eth.Eth.getTransactionReceipt
         receipt = self.web3.eth.getTransactionReceipt(tx.txid)
+        self.apply_receipt(tx, receipt)
+        return tx
+
+    def apply_receipt(self, tx: _PreparedTransaction, receipt: Optional[dict]):
+        """Store the outcome of a transaction receipt.
+
+        :param receipt: Web3 formatted or raw JSON-RPC receipt, None if the transaction is not mined yet
+        """
         if receipt:
-            tx.result_block_num = receipt["blockNumber"]
+            tx.result_block_num = to_int_quantity(receipt["blockNumber"])
 
             # https://ethereum.stackexchange.com/a/6003/620
-            if receipt["status"] == 0:
+            if to_int_quantity(receipt["status"]) == 0:
                 tx.result_transaction_success = False
                 tx.result_transaction_reason = "Transaction failed"  # TODO: Need some logic to separate failure modes
             else:
                 tx.result_transaction_success = True
 
         tx.result_fetched_at = now()
-        return tx
+
+    def get_receipts(self, txs: List[_PreparedTransaction], batch_size=100) -> List[Optional[dict]]:
+        """Get receipts of many transactions using JSON-RPC batches.
+
+        :return: Receipt for each transaction, None for transactions not in the chain
+        """
+        receipts = []
+        replies = batch_rpc_call(self.web3, "eth_getTransactionReceipt", [[tx.txid] for tx in txs], batch_size)
+        for tx, reply in zip(txs, replies):
+            if reply.get("error"):
+                raise RuntimeError("Could not get receipt for {}: {}".format(tx.txid, get_rpc_error_message(reply["error"])))
+            receipts.append(reply.get("result"))
+        return receipts
+
+    def fetch_receipts(self, txs: List[_PreparedTransaction], batch_size=100):
+        """Store receipts of many transactions using JSON-RPC batches."""
+        for tx, receipt in zip(txs, self.get_receipts(txs, batch_size)):
+            self.apply_receipt(tx, receipt)
+
+    def update_statuses(self, txs: List[_PreparedTransaction], batch_size=100) -> List[_PreparedTransaction]:
+        """Update the status of many transactions with JSON-RPC batches of receipt requests.
+
+        A transaction cannot be mined before all lower nonces of its account are.
+        Transactions at or above the mined transaction count of their account are not polled.
+
+        :return: Transactions whose receipts were polled
+        """
+
+        mined_counts = {}
+        for address in set(tx.get_from() for tx in txs):
+            mined_counts[address] = self.web3.eth.getTransactionCount(address)
+
+        polled = [tx for tx in txs if tx.nonce < mined_counts[tx.get_from()]]
+        self.fetch_receipts(polled, batch_size)
+        return polled
+
+    def match_blocks(self, start_block: int, end_block: int, batch_size=100) -> List[_PreparedTransaction]:
+        """Find our unmined transactions included in a block range.
+
+        Transaction hashes of the blocks are matched against an in-memory index of our unmined txids
+        and receipts are fetched only for the matches, so the cost follows the chain, not our backlog.
+
+        :return: Transactions that were included in the blocks
+        """
+        from sto.ethereum.blocks import BlockUnavailable
+
+        index = {tx.txid.lower(): tx for tx in self.get_unmined_txs().filter(self.prepared_tx_model.broadcasted_at != None)}
+        if not index:
+            return []
+
+        matched = []
+        block_nums = list(range(start_block, end_block + 1))
+        replies = batch_rpc_call(self.web3, "eth_getBlockByNumber", [[n, False] for n in block_nums], batch_size)
+        for block_num, reply in zip(block_nums, replies):
+            block = reply.get("result")
+            if not block:
+                raise BlockUnavailable("Could not get block {}: {}".format(block_num, reply.get("error")))
+
+            for txid in block["transactions"]:
+                tx = index.pop(HexBytes(txid).hex().lower(), None)
+                if tx:
+                    matched.append(tx)
+
+        self.fetch_receipts(matched, batch_size)
+        return matched
+
+    def update_confirmations(self, head_block: int, confirmations: int, batch_size=100) -> List[_PreparedTransaction]:
+        """Update the confirmation depth of mined transactions that are not final yet.
+
+        Reaching ``confirmations`` blocks the receipt is checked once more, in case a chain reorganisation moved the transaction.
+        Transactions that are no longer in the chain go back to unmined.
+
+        :return: Transactions that dropped out of the chain
+        """
+
+        final = []
+        for tx in self.get_unconfirmed_txs(confirmations):
+            tx.result_confirmations = max(0, head_block - tx.result_block_num + 1)
+            if tx.result_confirmations >= confirmations:
+                final.append(tx)
+
+        dropped = []
+        for tx, receipt in zip(final, self.get_receipts(final, batch_size)):
+            if receipt:
+                self.apply_receipt(tx, receipt)
+                tx.result_confirmations = max(0, head_block - tx.result_block_num + 1)
+            else:
+                tx.result_block_num = tx.result_transaction_success = tx.result_transaction_reason = tx.result_confirmations = None
+                dropped.append(tx)
+
+        return dropped
 
     @classmethod
     def print_transactions(self, txs: Iterable[_PreparedTransaction]):
@@ -1,12 +1,14 @@
 import json
 import os
 
-from typing import Optional
+from typing import Optional, List
+
+import requests
 
 import colorama
 import rlp
 from eth_abi import encode_abi
-from web3 import Web3, HTTPProvider
+from web3 import Web3, HTTPProvider, EthereumTesterProvider
 from web3.contract import Contract
 
 try:
@@ -26,8 +28,11 @@ from eth_utils import (
     to_bytes,
     is_hex_address,
     is_checksum_address,
-    to_hex
+    to_hex,
+    encode_hex,
+    event_abi_to_log_topic,
 )
+from hexbytes import HexBytes
 
 from sqlalchemy import and_
 
@@ -42,6 +47,10 @@ class NeedPrivateKey(Exception):
     pass
 
 
+class BatchRequestFailed(Exception):
+    """The node did not answer a JSON-RPC batch request with a reply for each call."""
+
+
 def check_good_node_url(node_url: str):
     if not node_url:
         raise NoNodeConfigured("You need to give --ethereum-node-url command line option or set it up in a config file")
@@ -189,6 +198,121 @@ def getLogs(self,
         yield get_event_data(abi, entry)
 
 
+def getMultipleEventLogs(events: list,
+    fromBlock=None,
+    toBlock="latest",
+    address=None) -> list:
+    """Get events of several types using a single eth_getLogs call.
+
+    All event signatures are put to the first topic position as an OR filter
+    and the returned logs are decoded based on their topic0.
+
+    :param events: Event classes of the same contract, like ``contract.events.Transfer``
+    :param address: Contract address or a list of addresses. Defaults to the address of the event contract.
+    :return: Decoded events in the canonical (block number, log index) order
+    """
+
+    if fromBlock is None:
+        raise TypeError("Missing mandatory keyword argument to getMultipleEventLogs: fromBlock")
+
+    assert events, "No event types given"
+
+    # topic0 -> event ABI
+    abis = {}
+    for event in events:
+        abi = event._get_event_abi()
+        abis[event_abi_to_log_topic(abi)] = abi
+
+    web3 = events[0].web3
+
+    event_filter_params = {
+        "fromBlock": fromBlock,
+        "toBlock": toBlock,
+        "address": address or events[0].address,
+    }
+
+    # eth-tester reads nested topic lists as alternative topic arrays instead of per position OR,
+    # so there we filter by the address only and let the topic0 dispatch below drop other events
+    if not any(isinstance(p, EthereumTesterProvider) for p in web3.providers):
+        event_filter_params["topics"] = [[encode_hex(topic) for topic in abis.keys()]]
+
+    # Call JSON-RPC API
+    logs = web3.eth.getLogs(event_filter_params)
+
+    # Convert raw binary data to Python proxy objects as described by ABI
+    result = []
+    for entry in logs:
+        abi = abis.get(bytes(HexBytes(entry["topics"][0])))
+        if abi:
+            result.append(get_event_data(abi, entry))
+
+    result.sort(key=lambda e: (e["blockNumber"], e["logIndex"]))
+    return result
+
+
+def batch_rpc_call(web3: Web3, method: str, params_list: List[list], batch_size: int=100) -> List[dict]:
+    """Call the same JSON-RPC method with many parameter sets using JSON-RPC batch requests.
+
+    Against HTTP providers ``batch_size`` calls are packed to a single HTTP POST.
+    Other providers, like eth-tester, fall back to one request per call.
+
+    Results are raw JSON-RPC responses over HTTP and web3 formatted values otherwise,
+    so callers need to accept both hex quantities and Python values.
+
+    :param params_list: List of parameter lists, integer parameters are passed as JSON-RPC quantities
+    :return: Response objects with either ``result`` or ``error`` key, in the same order as ``params_list``
+    :raise BatchRequestFailed: If the node rejects a whole batch or leaves calls without a reply
+    """
+
+    provider = web3.providers[0]
+    responses = []
+
+    if not isinstance(provider, HTTPProvider):
+        for params in params_list:
+            try:
+                responses.append({"result": web3.manager.request_blocking(method, params)})
+            except ValueError as e:
+                responses.append({"error": e.args[0] if e.args else str(e)})
+        return responses
+
+    for start in range(0, len(params_list), batch_size):
+        batch = params_list[start:start + batch_size]
+        payload = []
+        for request_id, params in enumerate(batch):
+            params = [hex(p) if type(p) == int else p for p in params]
+            payload.append({"jsonrpc": "2.0", "method": method, "params": params, "id": request_id})
+
+        resp = requests.post(provider.endpoint_uri, data=json.dumps(payload), **provider.get_request_kwargs())
+        resp.raise_for_status()
+        data = resp.json()
+
+        # Nodes that reject or rate limit the whole batch reply with a single error object
+        if not isinstance(data, list):
+            error = data.get("error", data) if isinstance(data, dict) else data
+            raise BatchRequestFailed("Node rejected a batch of {} {} calls: {}".format(len(batch), method, error))
+
+        replies = {}
+        for reply in data:
+            if not isinstance(reply, dict) or reply.get("id") is None:
+                raise BatchRequestFailed("Node replied to a batch of {} calls without a request id: {}".format(method, reply))
+            replies[reply["id"]] = reply
+
+        missing = [request_id for request_id in range(len(batch)) if request_id not in replies]
+        if missing:
+            raise BatchRequestFailed("Node did not reply to {} of {} {} calls in a batch".format(len(missing), len(batch), method))
+
+        responses += [replies[request_id] for request_id in range(len(batch))]
+
+    return responses
+
+
+def to_int_quantity(value) -> int:
+    """Read a JSON-RPC quantity that can be either a hex string or already formatted integer."""
+    if isinstance(value, int):
+        return value
+    return int(value, 16)
+
+
 def priv_key_to_address(private_key):
     from eth_account import Account
     acc = Account.privateKeyToAccount(private_key)
@@ -276,7 +400,7 @@ def deploy_contract(config, contract_name, constructor_args=()):
     broadcast(config)
 
 
-def broadcast(config):
+def broadcast(config, bulk=False, batch_size=100, signing_workers=None):
     # extracted this out as a separate method so that
     # this code can be re used elsewhere
     assert is_ethereum_network(config.network)
@@ -294,7 +418,10 @@ def broadcast(config):
         ethereum_node_url=config.ethereum_node_url,
         ethereum_private_key=config.ethereum_private_key,
         ethereum_gas_limit=config.ethereum_gas_limit,
-        ethereum_gas_price=config.ethereum_gas_price
+        ethereum_gas_price=config.ethereum_gas_price,
+        bulk=bulk,
+        batch_size=batch_size,
+        signing_workers=signing_workers,
     )
 
     if txs:
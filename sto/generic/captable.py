@@ -1,11 +1,13 @@
 import datetime
+import heapq
+import itertools
 from logging import Logger
 
 from decimal import Decimal
 
 import colorama
 from sqlalchemy.orm import Session, Query
-from typing import Optional, List
+from typing import Optional, List, Union, Callable, Iterable
 
 from sto.identityprovider import IdentityProvider
 from sto.models.tokenscan import _TokenScanStatus
@@ -40,29 +42,44 @@ class CapTableInfo:
     For command line and web UIs to use.
     """
 
-    def __init__(self, token_status: _TokenScanStatus, last_token_transfer_at, total_balance, entries):
+    def __init__(self, token_status: _TokenScanStatus, last_token_transfer_at, total_balance, entries, at=None, holder_count=None, offset=0):
         self.token_status = token_status
         self.last_token_transfer_at = last_token_transfer_at
+
+        #: List of :py:class:`CapTableEntry`, or an iterator of them from :py:func:`stream_cap_table`
         self.entries = entries
         self.total_balance = total_balance
 
+        #: Block number or point of time of a historical cap table, None for the latest
+        self.at = at
 
-def sort_entries(entries: List[CapTableEntry], order_by: str, order_direction: str):
-    """Sort constructed cap table in place.
+        #: Number of holders in the whole cap table, not only in the returned page
+        self.holder_count = len(entries) if holder_count is None else holder_count
 
-    Match friendly sort order to its underlying SQLite query.
-    """
+        #: How many entries were skipped before the first returned entry
+        self.offset = offset
+
+
+def get_sort_key(order_by: str) -> Callable:
     if order_by == "balance":
-        key = lambda entry: entry.balance
+        return lambda entry: entry.balance
     elif order_by == "name":
-        key = lambda entry: entry.name
+        return lambda entry: entry.name
     elif order_by == "updated":
-        key = lambda entry: entry.updated_at
+        return lambda entry: entry.updated_at
     elif order_by == "address":
-        key = lambda entry: entry.address
+        return lambda entry: entry.address
     else:
         raise TypeError("Unknown sort order")
 
+
+def sort_entries(entries: List[CapTableEntry], order_by: str, order_direction: str):
+    """Sort constructed cap table in place.
+
+    Match friendly sort order to its underlying SQLite query.
+    """
+    key = get_sort_key(order_by)
+
     if order_direction == "asc":
         entries.sort(key=key)
     elif order_direction == "desc":
@@ -71,7 +88,46 @@ def sort_entries(entries: List[CapTableEntry], order_by: str, order_direction: s
         raise TypeError("Unknown sort direction")
 
 
-def generate_cap_table(logger: Logger,
+def get_sort_column(TokenHolderAccount: type, order_by: str):
+    """Get the account column the database can order the cap table by.
+
+    :return: Column or None if the entries must be sorted in Python
+    """
+    if order_by == "balance":
+        return TokenHolderAccount.get_balance_sort_column() if TokenHolderAccount.EXACT_BALANCE_SORT else None
+    elif order_by == "updated":
+        return TokenHolderAccount.last_block_updated_at
+    elif order_by == "address":
+        return TokenHolderAccount.address
+    elif order_by == "name":
+        # Names come from the identity provider
+        return None
+    else:
+        raise TypeError("Unknown sort order")
+
+
+def select_entries(entries: Iterable[CapTableEntry], order_by: str, order_direction: str, limit: Optional[int], offset: int) -> List[CapTableEntry]:
+    """Sort entries in Python and return a page of them.
+
+    With a limit only ``offset + limit`` entries are kept in memory at a time.
+    """
+    if order_direction not in ("asc", "desc"):
+        raise TypeError("Unknown sort direction")
+
+    key = get_sort_key(order_by)
+
+    if limit is None:
+        entries = list(entries)
+        sort_entries(entries, order_by, order_direction)
+        return entries[offset:]
+
+    if order_direction == "asc":
+        return heapq.nsmallest(offset + limit, entries, key=key)[offset:]
+    else:
+        return heapq.nlargest(offset + limit, entries, key=key)[offset:]
+
+
+def stream_cap_table(logger: Logger,
               dbsession: Session,
               token_address: str,
               order_by: str,
@@ -80,58 +136,115 @@ def generate_cap_table(logger: Logger,
               include_empty: bool,
               TokenScanStatus: type,
               TokenHolderAccount: type,
-              no_name="<Unknown>") -> CapTableInfo:
-    """Print out cap table.
+              no_name="<Unknown>",
+              at: Optional[Union[int, datetime.datetime]]=None,
+              limit: Optional[int]=None,
+              offset: int=0) -> CapTableInfo:
+    """Build a cap table, or a page of it, with lazily created entries.
 
-    :param sort_order: "balance", "name", "updated", "address"
-    :param include_empty: Include accounts that hold balance in the past
-    :param TokenScanStatus: Token scan model used
-    :param TokenHolderAccount: Token balance model used
-    :return: List of CapTable entries
+    Totals and the holder count come from an aggregate over balance columns before any entry is created.
+    When the database can order by the asked column, ordering, ``limit`` and ``offset`` are done in SQL
+    and entries are created one by one as the caller iterates :py:attr:`CapTableInfo.entries`.
+    Otherwise rows are streamed through a bounded heap in Python.
+
+    See :py:func:`generate_cap_table` for the other parameters.
+
+    :param limit: Return at most this many entries
+    :param offset: Skip this many entries first
     """
 
     status = dbsession.query(TokenScanStatus).filter_by(address=token_address).one_or_none()  # type: TokenScanStatus
     if not status or status.end_block is None:
         raise NeedsTokenScan("No token {} balances available in the local database. Please run sto token-scan first.".format(token_address))
 
-    q = status.get_accounts(include_empty)
-
-    results = []
-    total_balance = Decimal(0)
-    last_token_transfer_at = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
-    for holder in q:
-
-        id_check = identity_provider.get_identity(holder.address)
+    if at is None:
+        holder_count, total_raw_balance, last_token_transfer_at = status.get_balance_totals(include_empty)
+    else:
+        if isinstance(at, int) and at > status.end_block:
+            raise NeedsTokenScan("Token {} has been scanned only up to block {}. Please run sto token-scan first.".format(token_address, status.end_block))
+        if isinstance(at, datetime.datetime) and at > status.end_block_timestamp:
+            raise NeedsTokenScan("Token {} has been scanned only up to {}. Please run sto token-scan first.".format(token_address, status.end_block_timestamp))
+        holdings = status.get_holdings_at(at)
+        holder_count = len(holdings)
+        total_raw_balance = sum(balance for balance, updated_at in holdings.values() if balance > 0)
+        last_token_transfer_at = max((updated_at for balance, updated_at in holdings.values()), default=None)
+
+    divider = Decimal(10) ** Decimal(status.decimals)
+    total_balance = Decimal(total_raw_balance) / divider
+
+    def _create_entry(address, raw_balance, updated_at) -> CapTableEntry:
+        id_check = identity_provider.get_identity(address)
         if id_check:
             name = id_check.name
         else:
             name = no_name
 
-        decimal_balance = holder.get_decimal_balance()
-
-        entry = CapTableEntry(name, holder.address, decimal_balance, holder.last_block_updated_at)
+        entry = CapTableEntry(name, address, Decimal(raw_balance) / divider, updated_at)
+        if total_balance > 0:
+            entry.percent = entry.balance / total_balance
+        return entry
+
+    if at is None:
+        q = dbsession.query(TokenHolderAccount.address, TokenHolderAccount.raw_balance, TokenHolderAccount.sign, TokenHolderAccount.last_block_updated_at)
+        q = q.filter(TokenHolderAccount.token_id == status.id)
+        if not include_empty:
+            q = q.filter(TokenHolderAccount.empty == False)
+
+        sort_column = get_sort_column(TokenHolderAccount, order_by)
+        if sort_column is not None:
+            if order_direction == "asc":
+                q = q.order_by(sort_column.asc(), TokenHolderAccount.id.asc())
+            elif order_direction == "desc":
+                q = q.order_by(sort_column.desc(), TokenHolderAccount.id.desc())
+            else:
+                raise TypeError("Unknown sort direction")
+            q = q.offset(offset).limit(limit)
+
+        holders = ((address, TokenHolderAccount.decode_balance(raw_balance, sign), updated_at) for address, raw_balance, sign, updated_at in q.yield_per(1000))
+    else:
+        sort_column = None
+        holders = ((address, balance, updated_at) for address, (balance, updated_at) in holdings.items())
 
-        if entry.updated_at > last_token_transfer_at:
-            last_token_transfer_at = entry.updated_at
-        results.append(entry)
+    entries = (_create_entry(*holder) for holder in holders)
+    if sort_column is None:
+        entries = iter(select_entries(entries, order_by, order_direction, limit, offset))
 
-        if  decimal_balance > 0:  # Ignore cases where we cannot detect mint transaction
-            total_balance += decimal_balance
+    if not last_token_transfer_at:
+        last_token_transfer_at = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
 
-    sort_entries(results, order_by, order_direction)
+    return CapTableInfo(status, last_token_transfer_at, total_balance, entries, at, holder_count=holder_count, offset=offset)
 
-    # Retrofit decimal balances after we know the total sum
-    if total_balance > 0:
-        for r in results:
-            r.percent = r.balance / total_balance
 
-    info = CapTableInfo(status, last_token_transfer_at, total_balance, results)
+def generate_cap_table(logger: Logger,
+              dbsession: Session,
+              token_address: str,
+              order_by: str,
+              order_direction: str,
+              identity_provider: IdentityProvider,
+              include_empty: bool,
+              TokenScanStatus: type,
+              TokenHolderAccount: type,
+              no_name="<Unknown>",
+              at: Optional[Union[int, datetime.datetime]]=None) -> CapTableInfo:
+    """Print out cap table.
 
+    :param sort_order: "balance", "name", "updated", "address"
+    :param include_empty: Include accounts that hold balance in the past. Not supported for historical cap tables.
+    :param TokenScanStatus: Token scan model used
+    :param TokenHolderAccount: Token balance model used
+    :param at: Block number or point of time for a historical cap table. If not given use the latest scanned balances.
+    :return: List of CapTable entries
+    """
+    info = stream_cap_table(logger, dbsession, token_address, order_by, order_direction, identity_provider, include_empty, TokenScanStatus, TokenHolderAccount, no_name, at)
+    info.entries = list(info.entries)
     return info
 
 
 def print_cap_table(info: CapTableInfo, max_entries: int, accuracy: int):
-    """Console cap table printer"""
+    """Console cap table printer
+
+    :param max_entries: Print at most this many entries. Entries are consumed from :py:attr:`CapTableInfo.entries` only up to this.
+    """
 
     if not info.token_status.end_block_timestamp:
         print("{}Token address {} not scanned. Please run sto token-scan first.{}".format(colorama.Fore.RED, info.token_status.address, colorama.Fore.RESET))
@@ -139,14 +252,16 @@ def print_cap_table(info: CapTableInfo, max_entries: int, accuracy: int):
 
     print("Token address: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, info.token_status.address, colorama.Fore.RESET))
     print("Name: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, info.token_status.name, colorama.Fore.RESET))
+    if info.at is not None:
+        print("Balances at: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, info.at, colorama.Fore.RESET))
     print("Symbol: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, info.token_status.symbol, colorama.Fore.RESET))
     print("Total supply: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, info.token_status.total_supply, colorama.Fore.RESET))
     print("Accounted supply: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, info.total_balance, colorama.Fore.RESET))
-    print("Holder count: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, len(info.entries), colorama.Fore.RESET))
+    print("Holder count: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, info.holder_count, colorama.Fore.RESET))
     print("Cap table database updated at: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, friendly_time(info.token_status.end_block_timestamp), colorama.Fore.RESET))
     print("Last token transfer at at: {}{}{}".format(colorama.Fore.LIGHTCYAN_EX, friendly_time(info.last_token_transfer_at), colorama.Fore.RESET))
 
-    print_entries = info.entries[0:max_entries]
+    print_entries = itertools.islice(info.entries, max_entries)
 
     table = []
 
@@ -154,7 +269,7 @@ def print_cap_table(info: CapTableInfo, max_entries: int, accuracy: int):
     percent_q = Decimal("0.01")
 
     # Tuplify
-    for idx, entry in enumerate(print_entries, start=1):
+    for idx, entry in enumerate(print_entries, start=info.offset + 1):
         table.append((
             idx,
             entry.name,
@@ -0,0 +1,204 @@
+"""Versioned schema migrations for existing databases.
+
+New databases are created from the latest models and all migrations are marked applied right away.
+Existing databases are not touched when opened. They are brought up to date with ``sto db-upgrade``,
+which runs the migrations not yet listed in the ``schema_version`` table. Each migration must be safe to run again
+on a database that already has its changes, as databases created before this module
+do not know which of them they already have.
+"""
+from collections import namedtuple
+from typing import List, Optional, Callable, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+
+from sto.db import init_db, get_column, get_missing_indexes, get_compactable_columns, write_compact_storage_option
+from sto.models.implementation import SchemaVersion
+from sto.models.utils import hex_to_bytes
+
+
+#: One schema change. ``apply`` is called with (logger, engine, batch_size).
+Migration = namedtuple("Migration", ["version", "description", "apply"])
+
+
+def find_duplicate_rows(engine, index: sa.Index) -> Optional[tuple]:
+    """Return one set of column values that appears more than once for a would be unique index."""
+    columns = list(index.columns)
+    q = sa.select(columns).group_by(*columns).having(sa.func.count() > 1).limit(1)
+    return engine.execute(q).first()
+
+
+def add_columns(logger, engine, columns: List[Tuple[str, str]]):
+    """Add nullable columns defined in the models to existing tables, unless already there.
+
+    :param columns: List of (table name, column name)
+    """
+    inspector = inspect(engine)
+    for table_name, column_name in columns:
+        existing = set(c["name"] for c in inspector.get_columns(table_name))
+        if column_name in existing:
+            continue
+        column = get_column(engine, table_name, column_name)
+        assert column.nullable, "Cannot add NOT NULL column {}.{} to an existing table".format(table_name, column_name)
+        logger.info("Adding column %s.%s", table_name, column_name)
+        ddl = CreateColumn(column).compile(dialect=engine.dialect)
+        engine.execute("ALTER TABLE {} ADD COLUMN {}".format(table_name, ddl))
+
+
+def create_missing_indexes(logger, engine):
+    """Create indexes defined in the models.
+
+    Unique indexes are checked against duplicate rows first, so we fail before spending time on the rest.
+    """
+    missing = get_missing_indexes(engine)
+
+    for index in missing:
+        if index.unique:
+            duplicate = find_duplicate_rows(engine, index)
+            if duplicate:
+                raise RuntimeError("Cannot create unique index {}, table {} has duplicate rows for {}".format(index.name, index.table.name, tuple(duplicate)))
+
+    for index in missing:
+        logger.info("Creating index %s", index.name)
+        index.create(engine)
+
+
+def update_in_batches(logger, conn, table_name: str, columns: List[str], convert: Callable, batch_size: int):
+    """Rewrite column values of a table in primary key order.
+
+    Only ``batch_size`` rows are held in memory at a time.
+
+    :param convert: Called with an old column value, returns the new value
+    """
+    select = sa.text("SELECT id, {} FROM {} WHERE id > :last_id ORDER BY id LIMIT :limit".format(", ".join(columns), table_name))
+    update = sa.text("UPDATE {} SET {} WHERE id = :id".format(table_name, ", ".join("{0} = :{0}".format(c) for c in columns)))
+
+    last_id = 0
+    converted = 0
+    while True:
+        rows = conn.execute(select, last_id=last_id, limit=batch_size).fetchall()
+        if not rows:
+            break
+
+        conn.execute(update, [dict(id=row[0], **{c: convert(value) for c, value in zip(columns, row[1:])}) for row in rows])
+        last_id = rows[-1][0]
+        converted += len(rows)
+
+    logger.info("Converted %d rows in %s", converted, table_name)
+
+
+def migrate_initial(logger, engine, batch_size):
+    """Create tables added after the first release, like block headers and balance snapshots."""
+    init_db(engine)
+
+
+def migrate_scan_tuning(logger, engine, batch_size):
+    add_columns(logger, engine, [
+        ("token_scan_status", "chunk_size_tuning"),
+    ])
+
+
+def migrate_indexes(logger, engine, batch_size):
+    create_missing_indexes(logger, engine)
+
+
+def migrate_confirmation_tracking(logger, engine, batch_size):
+    add_columns(logger, engine, [
+        ("broadcast_account", "watched_block_num"),
+        ("prepared_transaction", "result_confirmations"),
+    ])
+
+
+def migrate_fork_detection(logger, engine, batch_size):
+    add_columns(logger, engine, [
+        ("token_scan_status", "scanned_block_hashes"),
+    ])
+
+
+def migrate_watch_fork_detection(logger, engine, batch_size):
+    add_columns(logger, engine, [
+        ("broadcast_account", "watched_block_hashes"),
+    ])
+
+
+#: All migrations in the order they must be applied. Append only.
+MIGRATIONS = [
+    Migration(1, "Initial schema", migrate_initial),
+    Migration(2, "Column for eth_getLogs chunk size tuning state", migrate_scan_tuning),
+    Migration(3, "Indexes for token holder and transaction lookups", migrate_indexes),
+    Migration(4, "Columns for block driven transaction confirmation tracking", migrate_confirmation_tracking),
+    Migration(5, "Per token block hashes for chain reorganisation detection", migrate_fork_detection),
+    Migration(6, "Watched block hashes for chain reorganisation detection in tx-watch", migrate_watch_fork_detection),
+]
+
+
+def get_schema_version(engine) -> int:
+    """The latest applied migration, 0 for databases that predate migrations."""
+    if not engine.has_table(SchemaVersion.__tablename__):
+        return 0
+    session = Session(bind=engine)
+    try:
+        return SchemaVersion.get_current(session)
+    finally:
+        session.close()
+
+
+def get_pending_migrations(engine) -> List[Migration]:
+    current = get_schema_version(engine)
+    return [m for m in MIGRATIONS if m.version > current]
+
+
+def record_migration(engine, migration: Migration):
+    session = Session(bind=engine)
+    SchemaVersion.record(session, migration.version, migration.description)
+    session.commit()
+    session.close()
+
+
+def mark_migrations_applied(engine):
+    """A database created from the latest models needs no migrations."""
+    for migration in get_pending_migrations(engine):
+        record_migration(engine, migration)
+
+
+def upgrade_database(logger, engine, batch_size=10000) -> int:
+    """Run pending migrations.
+
+    Each migration is recorded as soon as it has been applied,
+    so an interrupted upgrade continues from the failed migration.
+
+    :return: The number of applied migrations
+    """
+    pending = get_pending_migrations(engine)
+    for migration in pending:
+        logger.info("Applying migration %d: %s", migration.version, migration.description)
+        migration.apply(logger, engine, batch_size)
+        record_migration(engine, migration)
+    return len(pending)
+
+
+def compact_sqlite_database(logger, engine, batch_size=10000):
+    """Convert an existing SQLite database to compact storage in place.
+
+    SQLite columns accept any value type, so hex strings are simply replaced with their raw bytes.
+    Indexes are updated along the rows and the freed space is returned with VACUUM.
+    The rows and the compact storage option are written in the same transaction, so a crash leaves the database as it was.
+    """
+
+    assert engine.dialect.name == "sqlite", "Only SQLite databases can be converted"
+
+    if engine.dialect.sto_compact_storage:
+        logger.info("Database already uses compact storage")
+        return
+
+    with engine.begin() as conn:
+        for table_name, columns in get_compactable_columns(engine):
+            update_in_batches(logger, conn, table_name, columns, hex_to_bytes, batch_size)
+        write_compact_storage_option(conn)
+
+    engine.dialect.sto_compact_storage = True
+
+    logger.info("Reclaiming free space")
+    engine.execute("VACUUM")
@@ -4,7 +4,7 @@ import sqlalchemy as sa
 from sqlalchemy.orm import Session
 from sqlalchemy.orm.attributes import flag_modified
 
-from sto.models.utils import TimeStampedBaseModel, UTCDateTime
+from sto.models.utils import TimeStampedBaseModel, UTCDateTime, Address, TransactionHash
 
 
 class _BroadcastAccount(TimeStampedBaseModel):
@@ -21,11 +21,31 @@ class _BroadcastAccount(TimeStampedBaseModel):
     #: Currently available nonce to be allocated for the next transaction
     current_nonce = sa.Column(sa.Integer, default=0)
 
+    #: The last block tx-watch has matched against our unmined transactions
+    watched_block_num = sa.Column(sa.Integer, nullable=True)
+
+    #: Hashes of the last watched blocks of tx-watch polls as [block num, block hash] pairs, oldest first.
+    #: Compared against the node to detect chain reorganisations, see :py:meth:`sto.ethereum.blocks.BlockHeaderResolver.find_fork_point`
+    watched_block_hashes = sa.Column(sa.JSON, nullable=True)
+
+    #: How many watched block hashes we keep, reorganisations deeper than this many polls trigger a full receipt catch-up
+    MAX_WATCHED_BLOCK_HASHES = 100
+
     @classmethod
     def get_transactions_for_network(cls, dbsession: Session, network: str):
         account = dbsession.query(cls).filter_by(network=network).one()
         return account.txs
 
+    def record_watched_block_hash(self, block_num: int, block_hash: str):
+        """Remember the hash of the last watched block."""
+        hashes = [h for h in (self.watched_block_hashes or []) if h[0] < block_num]
+        hashes.append([block_num, block_hash])
+        self.watched_block_hashes = hashes[-self.MAX_WATCHED_BLOCK_HASHES:]
+
+    def delete_watched_block_hashes_after(self, after_block: int):
+        """Forget hashes of blocks being watched again."""
+        self.watched_block_hashes = [h for h in (self.watched_block_hashes or []) if h[0] < after_block]
+
 
 
 class _PreparedTransaction(TimeStampedBaseModel):
@@ -49,16 +69,16 @@ class _PreparedTransaction(TimeStampedBaseModel):
     human_readable_description = sa.Column(sa.Text, nullable=False)
 
     #: Address of the upcoming deployed contract or token contract address interacted with
-    contract_address = sa.Column(sa.String(256), nullable=True)
+    contract_address = sa.Column(Address(), nullable=True)
 
     #: Address of the account, like 0x000000, for benefactor who receives the tokens. Not applicable for contract deployments.
-    receiver = sa.Column(sa.String(256), nullable=True)
+    receiver = sa.Column(Address(), nullable=True)
 
     #: Raw payload of the transaction to be broadcasted
     unsigned_payload = sa.Column(sa.JSON, nullable=False)
 
     #: Precalculated transaction id
-    txid = sa.Column(sa.String(256), nullable=True)
+    txid = sa.Column(TransactionHash(), nullable=True)
 
     #: Value transferred in Ethereum transaction
     # value = sa.Column(sa.Numeric(60, 20), nullable=False, default=0)
@@ -88,6 +108,9 @@ class _PreparedTransaction(TimeStampedBaseModel):
     #: Human readable failure reason
     result_transaction_reason = sa.Column(sa.String(256), default=None)
 
+    #: How many blocks deep the transaction was when tx-watch last looked, counting its own block
+    result_confirmations = sa.Column(sa.Integer, default=None)
+
     #: When a contract deployment was verified at EtherScan
     verified_at = sa.Column(UTCDateTime, default=None)
 
@@ -149,6 +172,19 @@ class _PreparedTransaction(TimeStampedBaseModel):
         self.other_data["verification_info"] = val
         flag_modified(self, "other_data")
 
+    @property
+    def broadcast_error(self) -> Optional[str]:
+        """Node error message from the last failed broadcast attempt."""
+        return self.other_data.get("broadcast_error")
+
+    @broadcast_error.setter
+    def broadcast_error(self, val: Optional[str]):
+        if val is None:
+            self.other_data.pop("broadcast_error", None)
+        else:
+            self.other_data["broadcast_error"] = val
+        flag_modified(self, "other_data")
+
     @property
     def flattened_source_code(self) -> Optional["str"]:
         """Source code used for a deployment transaction for contract verification."""
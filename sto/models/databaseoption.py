@@ -0,0 +1,31 @@
+"""Persistent settings of a database."""
+import sqlalchemy as sa
+from typing import Optional
+
+from sto.models.utils import TimeStampedBaseModel
+
+
+class _DatabaseOption(TimeStampedBaseModel):
+    """Key-value settings that tell how this database was created or converted."""
+
+    __tablename__ = "database_option"
+
+    #: Addresses and hashes are stored as raw bytes, see :py:class:`sto.models.utils.HexBinary`
+    COMPACT_STORAGE = "compact_storage"
+
+    name = sa.Column(sa.String(256), nullable=False, unique=True)
+
+    value = sa.Column(sa.String(256), nullable=True)
+
+    @classmethod
+    def get(cls, dbsession, name: str) -> Optional[str]:
+        option = dbsession.query(cls).filter_by(name=name).one_or_none()
+        return option.value if option else None
+
+    @classmethod
+    def set(cls, dbsession, name: str, value: Optional[str]):
+        option = dbsession.query(cls).filter_by(name=name).one_or_none()
+        if not option:
+            option = cls(name=name)
+            dbsession.add(option)
+        option.value = value
@@ -4,23 +4,47 @@ The framework user may supply their own base class e.g. for the case of fine tun
 Here we supply implementations for the default command line application using SQLite.
 """
 
+from collections import namedtuple
+
 import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
 
 from .broadcastaccount import _BroadcastAccount, _PreparedTransaction
-from .tokenscan import _TokenScanStatus, _TokenHolderDelta, _TokenHolderAccount
+from .databaseoption import _DatabaseOption
+from .schemaversion import _SchemaVersion
+from .tokenscan import _TokenScanStatus, _TokenHolderDelta, _TokenHolderAccount, _BlockHeader, _TokenBalanceSnapshot, _TokenBalanceSnapshotEntry
+from .numeric import _NumericTokenScanStatus, _NumericTokenHolderAccount, _NumericTokenHolderDelta, _NumericTokenBalanceSnapshotEntry
 
 
 Base = declarative_base()
 
 
-class BroadcastAccount(_BroadcastAccount, Base):
+class DatabaseOption(_DatabaseOption, Base):
+    pass
+
+
+class SchemaVersion(_SchemaVersion, Base):
     pass
 
 
+class BroadcastAccount(_BroadcastAccount, Base):
+
+    __table_args__ = (
+        sa.Index("ix_broadcast_account_network_address", "network", "address", unique=True),
+        {"extend_existing": True},
+    )
+
+
 class PreparedTransaction(_PreparedTransaction, Base):
 
+    __table_args__ = (
+        sa.Index("ix_prepared_transaction_txid", "txid"),
+        sa.Index("ix_prepared_transaction_external_id_contract_address", "external_id", "contract_address"),
+        sa.Index("ix_prepared_transaction_pending_nonce", "broadcast_account_id", "broadcasted_at", "nonce"),
+        {"extend_existing": True},
+    )
+
     broadcast_account_id = sa.Column(sa.ForeignKey("broadcast_account.id"), nullable=True)
     broadcast_account = orm.relationship(BroadcastAccount,
                         backref=orm.backref("txs",
@@ -30,11 +54,28 @@ class PreparedTransaction(_PreparedTransaction, Base):
 
 
 class TokenScanStatus(_TokenScanStatus, Base):
-    pass
+
+    __table_args__ = (
+        sa.Index("ix_token_scan_status_network_address", "network", "address", unique=True),
+        {"extend_existing": True},
+    )
+
+
+class BlockHeader(_BlockHeader, Base):
+
+    __table_args__ = (
+        sa.Index("ix_block_header_network_block_num", "network", "block_num", unique=True),
+        {"extend_existing": True},
+    )
 
 
 class TokenHolderAccount(_TokenHolderAccount, Base):
 
+    __table_args__ = (
+        sa.Index("ix_token_holder_account_token_id_address", "token_id", "address", unique=True),
+        {"extend_existing": True},
+    )
+
     token_id = sa.Column(sa.ForeignKey("token_scan_status.id"), nullable=False)
     token = orm.relationship(TokenScanStatus,
                         backref=orm.backref("accounts",
@@ -45,6 +86,12 @@ class TokenHolderAccount(_TokenHolderAccount, Base):
 
 class TokenHolderDelta(_TokenHolderDelta, Base):
 
+    __table_args__ = (
+        sa.Index("ix_token_holder_delta_account_id_block_num_tx_internal_order", "account_id", "block_num", "tx_internal_order"),
+        sa.Index("ix_token_holder_delta_txid", "txid"),
+        {"extend_existing": True},
+    )
+
     account_id = sa.Column(sa.ForeignKey("token_holder_account.id"), nullable=False)
     account = orm.relationship(TokenHolderAccount,
                         backref=orm.backref("deltas",
@@ -53,3 +100,130 @@ class TokenHolderDelta(_TokenHolderDelta, Base):
                                         single_parent=True, ), )
 
 
+class TokenBalanceSnapshot(_TokenBalanceSnapshot, Base):
+
+    __table_args__ = (
+        sa.Index("ix_token_balance_snapshot_token_id_block_num", "token_id", "block_num", unique=True),
+        {"extend_existing": True},
+    )
+
+    token_id = sa.Column(sa.ForeignKey("token_scan_status.id"), nullable=False)
+    token = orm.relationship(TokenScanStatus,
+                        backref=orm.backref("snapshots",
+                                        lazy="dynamic",
+                                        cascade="all, delete-orphan",
+                                        single_parent=True, ), )
+
+
+class TokenBalanceSnapshotEntry(_TokenBalanceSnapshotEntry, Base):
+
+    __table_args__ = (
+        sa.Index("ix_token_balance_snapshot_entry_snapshot_id", "snapshot_id"),
+        {"extend_existing": True},
+    )
+
+    snapshot_id = sa.Column(sa.ForeignKey("token_balance_snapshot.id"), nullable=False)
+    snapshot = orm.relationship(TokenBalanceSnapshot,
+                        backref=orm.backref("entries",
+                                        lazy="dynamic",
+                                        cascade="all, delete-orphan",
+                                        single_parent=True, ), )
+
+    account_id = sa.Column(sa.ForeignKey("token_holder_account.id"), nullable=False)
+
+
+#: Token balance models using native NUMERIC(78, 0) uint256 columns, used with PostgreSQL.
+#: Table names are the same as above, so they live in their own metadata.
+#: Broadcast accounts, prepared transactions and block headers are shared with the default models.
+NumericBase = declarative_base()
+
+
+class NumericTokenScanStatus(_NumericTokenScanStatus, NumericBase):
+
+    __table_args__ = (
+        sa.Index("ix_token_scan_status_network_address", "network", "address", unique=True),
+        {"extend_existing": True},
+    )
+
+
+class NumericTokenHolderAccount(_NumericTokenHolderAccount, NumericBase):
+
+    __table_args__ = (
+        sa.Index("ix_token_holder_account_token_id_address", "token_id", "address", unique=True),
+        {"extend_existing": True},
+    )
+
+    token_id = sa.Column(sa.ForeignKey("token_scan_status.id"), nullable=False)
+    token = orm.relationship(NumericTokenScanStatus,
+                        backref=orm.backref("accounts",
+                                        lazy="dynamic",
+                                        cascade="all, delete-orphan",
+                                        single_parent=True, ), )
+
+
+class NumericTokenHolderDelta(_NumericTokenHolderDelta, NumericBase):
+
+    __table_args__ = (
+        sa.Index("ix_token_holder_delta_account_id_block_num_tx_internal_order", "account_id", "block_num", "tx_internal_order"),
+        sa.Index("ix_token_holder_delta_txid", "txid"),
+        {"extend_existing": True},
+    )
+
+    account_id = sa.Column(sa.ForeignKey("token_holder_account.id"), nullable=False)
+    account = orm.relationship(NumericTokenHolderAccount,
+                        backref=orm.backref("deltas",
+                                        lazy="dynamic",
+                                        cascade="all, delete-orphan",
+                                        single_parent=True, ), )
+
+
+class NumericTokenBalanceSnapshot(_TokenBalanceSnapshot, NumericBase):
+
+    __table_args__ = (
+        sa.Index("ix_token_balance_snapshot_token_id_block_num", "token_id", "block_num", unique=True),
+        {"extend_existing": True},
+    )
+
+    token_id = sa.Column(sa.ForeignKey("token_scan_status.id"), nullable=False)
+    token = orm.relationship(NumericTokenScanStatus,
+                        backref=orm.backref("snapshots",
+                                        lazy="dynamic",
+                                        cascade="all, delete-orphan",
+                                        single_parent=True, ), )
+
+
+class NumericTokenBalanceSnapshotEntry(_NumericTokenBalanceSnapshotEntry, NumericBase):
+
+    __table_args__ = (
+        sa.Index("ix_token_balance_snapshot_entry_snapshot_id", "snapshot_id"),
+        {"extend_existing": True},
+    )
+
+    snapshot_id = sa.Column(sa.ForeignKey("token_balance_snapshot.id"), nullable=False)
+    snapshot = orm.relationship(NumericTokenBalanceSnapshot,
+                        backref=orm.backref("entries",
+                                        lazy="dynamic",
+                                        cascade="all, delete-orphan",
+                                        single_parent=True, ), )
+
+    account_id = sa.Column(sa.ForeignKey("token_holder_account.id"), nullable=False)
+
+
+#: Token balance model classes to use with a database
+TokenModels = namedtuple("TokenModels", ["TokenScanStatus", "TokenHolderAccount", "TokenHolderDelta", "TokenBalanceSnapshot"])
+
+DEFAULT_TOKEN_MODELS = TokenModels(TokenScanStatus, TokenHolderAccount, TokenHolderDelta, TokenBalanceSnapshot)
+
+NUMERIC_TOKEN_MODELS = TokenModels(NumericTokenScanStatus, NumericTokenHolderAccount, NumericTokenHolderDelta, NumericTokenBalanceSnapshot)
+
+
+def uses_numeric_token_models(dialect_name: str) -> bool:
+    """Databases with native 256-bit decimals get the NUMERIC token models."""
+    return dialect_name == "postgresql"
+
+
+def get_token_models(dbsession) -> TokenModels:
+    """Get the token balance models matching the database behind a session."""
+    if uses_numeric_token_models(dbsession.get_bind().dialect.name):
+        return NUMERIC_TOKEN_MODELS
+    return DEFAULT_TOKEN_MODELS
@@ -0,0 +1,155 @@
+"""Token balance models using native 256-bit decimal columns.
+
+The default models in :py:mod:`sto.models.tokenscan` store uint256 values as 32 raw bytes plus a sign,
+because SQLite cannot do 256-bit arithmetics. On PostgreSQL ``NUMERIC(78, 0)`` holds any signed uint256 value exactly,
+so balances can be summed, sorted and filtered by the database.
+
+Values are stored signed in ``raw_balance`` and ``raw_delta``. The ``sign`` columns are kept up to date for compatibility.
+"""
+import datetime
+from decimal import Decimal
+from typing import Optional, Tuple, Iterable
+
+import sqlalchemy as sa
+from sqlalchemy.orm import object_session
+
+from sto.models.tokenscan import _TokenScanStatus, _TokenHolderAccount, _TokenHolderDelta, _TokenBalanceSnapshotEntry
+from sto.models.utils import now, expire_instances
+
+
+#: Enough digits for any uint256
+UINT256_NUMERIC = sa.Numeric(78, 0, asdecimal=True)
+
+
+class _NumericTokenScanStatus(_TokenScanStatus):
+    """Token scan status that calculates balances in the database."""
+
+    def update_denormalised_balances(self, bulk=True):
+        """Calculate new balance on all accounts that have been marked dirty since the last scan.
+
+        With ``bulk`` this is one UPDATE statement with correlated sums over new deltas, no rows travel to Python.
+        """
+
+        if not bulk:
+            return super().update_denormalised_balances(bulk=False)
+
+        session = object_session(self)
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+
+        session.flush()
+        session.execute(self.get_denormalised_balances_update())
+
+        expire_instances(session, TokenHolderAccount)
+
+    def get_denormalised_balances_update(self) -> sa.sql.Update:
+        """The UPDATE statement that calculates new balances of the dirty accounts of this token."""
+
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+        TokenHolderDelta = TokenHolderAccount.deltas.property.mapper.class_
+
+        # Deltas not yet included in the balance checkpoint of the account being updated
+        new_deltas = sa.and_(
+            TokenHolderDelta.account_id == TokenHolderAccount.id,
+            sa.or_(TokenHolderAccount.raw_balance == None, TokenHolderDelta.block_num > TokenHolderAccount.last_block_num))
+
+        delta_sum = sa.select([sa.func.coalesce(sa.func.sum(TokenHolderDelta.raw_delta), 0)]).where(new_deltas).as_scalar()
+        last_block_num = sa.select([sa.func.max(TokenHolderDelta.block_num)]).where(new_deltas).as_scalar()
+        last_block_at = sa.select([sa.func.max(TokenHolderDelta.block_timestamped_at)]).where(new_deltas).as_scalar()
+
+        balance = sa.func.coalesce(TokenHolderAccount.raw_balance, 0) + delta_sum
+
+        return sa.update(TokenHolderAccount.__table__).where(sa.and_(TokenHolderAccount.token_id == self.id, TokenHolderAccount.balance_calculated_at == None)).values({
+            TokenHolderAccount.raw_balance: balance,
+            TokenHolderAccount.sign: sa.case([(balance < 0, -1)], else_=1),
+            TokenHolderAccount.empty: balance == 0,
+            # Sorting uses raw_balance, see get_balance_columns
+            TokenHolderAccount.sortable_balance: None,
+            # Like the ORM path, 0 when a dropped checkpoint has no deltas left, so later deltas are still newer than it
+            TokenHolderAccount.last_block_num: sa.func.coalesce(last_block_num, TokenHolderAccount.last_block_num, 0),
+            TokenHolderAccount.last_block_updated_at: sa.func.coalesce(last_block_at, TokenHolderAccount.last_block_updated_at),
+            TokenHolderAccount.balance_calculated_at: now(),
+        })
+
+    def get_balance_totals(self, include_empty=False) -> Tuple[int, int, Optional[datetime.datetime]]:
+        """Aggregate the latest balances for the cap table summary with a single aggregate query."""
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+
+        positive = sa.case([(TokenHolderAccount.raw_balance > 0, TokenHolderAccount.raw_balance)], else_=0)
+        q = object_session(self).query(sa.func.count(TokenHolderAccount.id), sa.func.coalesce(sa.func.sum(positive), 0), sa.func.max(TokenHolderAccount.last_block_updated_at))
+        q = q.filter(TokenHolderAccount.token_id == self.id)
+        if not include_empty:
+            q = q.filter(TokenHolderAccount.empty == False)
+
+        holder_count, total_balance, last_updated_at = q.one()
+        return holder_count, int(total_balance), last_updated_at
+
+
+class _NumericTokenHolderAccount(_TokenHolderAccount):
+    """Token holder with a signed NUMERIC balance."""
+
+    EXACT_BALANCE_SORT = True
+
+    #: Denormalised signed balance
+    raw_balance = sa.Column(UINT256_NUMERIC, nullable=True)
+
+    @classmethod
+    def decode_balance(cls, raw_balance, sign: int) -> int:
+        return int(raw_balance)
+
+    @classmethod
+    def get_balance_columns(cls, val: int) -> dict:
+        columns = super().get_balance_columns(val)
+        columns["raw_balance"] = Decimal(val)
+        # Not needed as we sort by raw_balance, and whole tokens past 2**31 would overflow the INTEGER column
+        columns["sortable_balance"] = None
+        return columns
+
+    @classmethod
+    def get_balance_sort_column(cls):
+        return cls.raw_balance
+
+
+class _NumericTokenHolderDelta(_TokenHolderDelta):
+    """Balance change with a signed NUMERIC value."""
+
+    #: Signed transfer value
+    raw_delta = sa.Column(UINT256_NUMERIC, nullable=False)
+
+    @classmethod
+    def decode_delta(cls, raw_delta, sign: int) -> int:
+        return int(raw_delta)
+
+    @classmethod
+    def get_delta_columns(cls, val: int, sign: int) -> dict:
+        assert type(val) == int
+        return {"raw_delta": Decimal(val * sign), "sign": sign}
+
+    @classmethod
+    def iterate_range_sums(cls, status: _TokenScanStatus, from_block: Optional[int]=None, to_block: Optional[int]=None, batch_size=1000) -> Iterable[Tuple[int, int, datetime.datetime]]:
+        """Sum the deltas of each account of a token over a block range with GROUP BY."""
+        TokenHolderAccount = cls.account.property.mapper.class_
+
+        q = object_session(status).query(cls.account_id, sa.func.sum(cls.raw_delta), sa.func.max(cls.block_timestamped_at))
+        q = q.join(cls.account).filter(TokenHolderAccount.token_id == status.id)
+        if from_block is not None:
+            q = q.filter(cls.block_num >= from_block)
+        if to_block is not None:
+            q = q.filter(cls.block_num <= to_block)
+
+        for account_id, delta_sum, last_block_at in q.group_by(cls.account_id).yield_per(batch_size):
+            yield account_id, int(delta_sum), last_block_at
+
+
+class _NumericTokenBalanceSnapshotEntry(_TokenBalanceSnapshotEntry):
+    """Snapshot balance with a signed NUMERIC value."""
+
+    #: Signed balance
+    raw_balance = sa.Column(UINT256_NUMERIC, nullable=False)
+
+    @classmethod
+    def decode_balance(cls, raw_balance, sign: int) -> int:
+        return int(raw_balance)
+
+    @classmethod
+    def get_balance_columns(cls, val: int) -> dict:
+        return {"raw_balance": Decimal(val), "sign": -1 if val < 0 else 1}
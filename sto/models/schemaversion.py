@@ -0,0 +1,25 @@
+"""Track which schema migrations have been applied to a database."""
+import sqlalchemy as sa
+
+from sto.models.utils import TimeStampedBaseModel
+
+
+class _SchemaVersion(TimeStampedBaseModel):
+    """One row per applied migration, see :py:mod:`sto.migrations`."""
+
+    __tablename__ = "schema_version"
+
+    #: Migration number
+    version = sa.Column(sa.Integer, nullable=False, unique=True)
+
+    #: What the migration did, for diagnostics
+    description = sa.Column(sa.String(256), nullable=True)
+
+    @classmethod
+    def get_current(cls, dbsession) -> int:
+        """The latest applied migration or 0 for databases that predate migrations."""
+        return dbsession.query(sa.func.max(cls.version)).scalar() or 0
+
+    @classmethod
+    def record(cls, dbsession, version: int, description: str):
+        dbsession.add(cls(version=version, description=description))
@@ -14,7 +14,7 @@ Efficiency can be greatly increased by
 """
 import datetime
 from binascii import hexlify
-from typing import Optional, Tuple, Dict, Iterable
+from typing import Optional, Tuple, Dict, Iterable, List, Union
 
 import sqlalchemy as sa
 from decimal import Decimal
@@ -22,7 +22,11 @@ from decimal import Decimal
 from sqlalchemy.orm import Query, object_session
 from sqlalchemy.orm.attributes import flag_modified
 
-from sto.models.utils import TimeStampedBaseModel, UTCDateTime, now
+from sto.models.utils import TimeStampedBaseModel, UTCDateTime, now, chunked, expire_instances, Address, TransactionHash
+
+
+#: How many bound parameters we put in a single IN query - SQLite default limit is 999
+IN_QUERY_CHUNK_SIZE = 500
 
 
 class _TokenScanStatus(TimeStampedBaseModel):
@@ -61,6 +65,16 @@ class _TokenScanStatus(TimeStampedBaseModel):
     #: Total supply of this token as decimal serialised as string - for DB compatiblity issues
     total_supply = sa.Column(sa.String(256), nullable=True)
 
+    #: Scan chunk size controller state from the last scan, see :py:class:`sto.ethereum.chunksize.ChunkSizeController`
+    chunk_size_tuning = sa.Column(sa.JSON, nullable=True)
+
+    #: Hashes of the last blocks of scanned block ranges as seen by this token's scans, as [block num, block hash] pairs, oldest first.
+    #: Compared against the node to detect chain reorganisations, see :py:meth:`sto.ethereum.blocks.BlockHeaderResolver.find_fork_point`
+    scanned_block_hashes = sa.Column(sa.JSON, nullable=True)
+
+    #: How many scanned block hashes we keep, reorganisations deeper than this many scanned block ranges trigger a full rescan
+    MAX_SCANNED_BLOCK_HASHES = 100
+
     def get_accounts(self, include_empty=False) -> Query:
         q = self.accounts
         if include_empty:
@@ -73,22 +87,59 @@ class _TokenScanStatus(TimeStampedBaseModel):
         """How many addresses are/have been holding this token."""
         return self.get_accounts(include_empty).count()
 
-    def get_or_create_account(self, token_holder: str) -> "_TokenHolderAccount":
+    def get_balance_totals(self, include_empty=False) -> Tuple[int, int, Optional[datetime.datetime]]:
+        """Aggregate the latest balances for the cap table summary.
+
+        SQLite cannot sum uint256, so balance columns are streamed through in one query without creating ORM objects.
+
+        :return: Tuple (holder count, sum of positive raw balances, timestamp of the last balance change)
+        """
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+
+        q = object_session(self).query(TokenHolderAccount.raw_balance, TokenHolderAccount.sign, TokenHolderAccount.last_block_updated_at).filter(TokenHolderAccount.token_id == self.id)
+        if not include_empty:
+            q = q.filter(TokenHolderAccount.empty == False)
+
+        holder_count = total_balance = 0
+        last_updated_at = None
+        for raw_balance, sign, updated_at in q.yield_per(1000):
+            holder_count += 1
+            balance = TokenHolderAccount.decode_balance(raw_balance, sign)
+            if balance > 0:
+                total_balance += balance
+            if updated_at and (not last_updated_at or updated_at > last_updated_at):
+                last_updated_at = updated_at
+
+        return holder_count, total_balance, last_updated_at
+
+    def get_or_create_account(self, token_holder: str, account_ids: Optional[Dict[str, int]]=None) -> "_TokenHolderAccount":
         """Denormalize the token balance.
 
         Drop in a PostgreSQL implementation here using native databae types.
+
+        :param account_ids: Address -> account id map kept by the caller, see :py:meth:`get_or_create_accounts`
         """
         assert token_holder.startswith("0x")
 
         TokenHolderAccount = self.accounts.attr.target_mapper.class_
 
+        if account_ids is not None and token_holder in account_ids:
+            # Comes from the session identity map without SQL if the account has been loaded
+            return object_session(self).query(TokenHolderAccount).get(account_ids[token_holder])
+
         account = self.accounts.filter_by(address=token_holder).one_or_none()
         if not account:
             account = TokenHolderAccount(address=token_holder)
             self.accounts.append(account)
+
+        if account_ids is not None:
+            if account.id is None:
+                object_session(self).flush()
+            account_ids[token_holder] = account.id
+
         return account
 
-    def create_deltas(self, block_num: int, block_when: datetime, txid: str, idx: int, from_: str, to_: str, value: int, TokenHolderDelta: type):
+    def create_deltas(self, block_num: int, block_when: datetime, txid: str, idx: int, from_: str, to_: str, value: int, TokenHolderDelta: type, account_ids: Optional[Dict[str, int]]=None):
         """Creates token balance change events in the database.
 
         For each token transfer we create debit and credit events, so that we can nicely sum the total balance of the account.
@@ -100,6 +151,7 @@ class _TokenScanStatus(TimeStampedBaseModel):
         :param from_: Debit account
         :param to_: Credit account
         :param value: uint256 transfer value
+        :param account_ids: Address -> account id map kept by the caller, see :py:meth:`get_or_create_accounts`
         """
         assert txid.startswith("0x")
         assert from_.startswith("0x")
@@ -111,30 +163,517 @@ class _TokenScanStatus(TimeStampedBaseModel):
         if existing:
             raise RuntimeError("Had already existing imported event: {}".format(existing))
 
-        credit_account = self.get_or_create_account(to_)
+        credit_account = self.get_or_create_account(to_, account_ids)
         delta_credit = TokenHolderDelta(block_num=block_num, txid=txid, tx_internal_order=idx, block_timestamped_at=block_when)
         delta_credit.set_delta_uint(value, +1)
         credit_account.add_delta(delta_credit)
 
         if from_ != self.NULL_ADDRESS:
-            debit_account = self.get_or_create_account(from_)
+            debit_account = self.get_or_create_account(from_, account_ids)
             delta_debit = TokenHolderDelta(block_num=block_num, txid=txid, tx_internal_order=idx, block_timestamped_at=block_when)
             delta_debit.set_delta_uint(value, -1)
             debit_account.add_delta(delta_debit)
 
+    def get_or_create_accounts(self, addresses: Iterable[str], account_ids: Optional[Dict[str, int]]=None) -> Dict[str, int]:
+        """Resolve holder account ids for many addresses at once.
+
+        Existing accounts are looked up with IN queries and all missing accounts are created with a single bulk insert.
+
+        :param account_ids: Address -> account id map the caller keeps between calls, like a scanner does over a scan.
+            Addresses already in the map are not queried and resolved addresses are added to it.
+            Accounts are never deleted, so the ids stay valid as long as the transaction that created them is not rolled back.
+
+        :return: Address -> account id mapping
+        """
+        session = object_session(self)
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+
+        addresses = sorted(set(addresses))
+        for a in addresses:
+            assert a.startswith("0x")
+
+        def _lookup(wanted: List[str]) -> Dict[str, int]:
+            # Compact storage gives addresses back checksummed, so match them case insensitively
+            found = {}
+            for chunk in chunked(wanted, IN_QUERY_CHUNK_SIZE):
+                q = session.query(TokenHolderAccount.address, TokenHolderAccount.id).filter(TokenHolderAccount.token_id == self.id, TokenHolderAccount.address.in_(chunk))
+                found.update({address.lower(): id for address, id in q})
+            return {a: found[a.lower()] for a in wanted if a.lower() in found}
+
+        if account_ids is None:
+            account_ids = {}
+
+        account_ids.update(_lookup([a for a in addresses if a not in account_ids]))
+
+        missing = [a for a in addresses if a not in account_ids]
+        if missing:
+            session.bulk_insert_mappings(TokenHolderAccount, [{"token_id": self.id, "address": a, "empty": True, "balance_calculated_at": None} for a in missing])
+            account_ids.update(_lookup(missing))
+
+        return {a: account_ids[a] for a in addresses}
+
+    def bulk_create_deltas(self, events: List[tuple], TokenHolderDelta: type, account_ids: Optional[Dict[str, int]]=None):
+        """Creates token balance change events for a whole batch of transfers at once.
+
+        Bulk counterpart of :py:meth:`create_deltas`.
+        Holder accounts are resolved with :py:meth:`get_or_create_accounts`
+        and all deltas are written with a single ``executemany`` insert.
+
+        :param events: List of (block_num, block_when, txid, idx, from_, to_, value) tuples, same as :py:meth:`create_deltas` arguments
+        :param account_ids: Address -> account id map kept by the caller, see :py:meth:`get_or_create_accounts`
+        """
+
+        if not events:
+            return
+
+        session = object_session(self)
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+
+        # Make sure pending ORM objects have their ids before we bypass the unit of work
+        session.flush()
+
+        keys = set()
+        for block_num, block_when, txid, idx, from_, to_, value in events:
+            assert txid.startswith("0x")
+            assert from_.startswith("0x")
+            assert to_.startswith("0x")
+            key = (block_num, idx)
+            if key in keys:
+                raise RuntimeError("Had duplicate event in the import batch: block:{} idx:{}".format(block_num, idx))
+            keys.add(key)
+
+        first_block = min(e[0] for e in events)
+        last_block = max(e[0] for e in events)
+        existing = session.query(TokenHolderDelta.block_num, TokenHolderDelta.tx_internal_order).join(TokenHolderDelta.account).filter(TokenHolderAccount.token_id == self.id, TokenHolderDelta.block_num.between(first_block, last_block))
+        for block_num, idx in existing:
+            if (block_num, idx) in keys:
+                raise RuntimeError("Had already existing imported event: token:{} block:{} idx:{}".format(self.address, block_num, idx))
+
+        addresses = set()
+        for block_num, block_when, txid, idx, from_, to_, value in events:
+            addresses.add(to_)
+            if from_ != self.NULL_ADDRESS:
+                addresses.add(from_)
+
+        account_ids = self.get_or_create_accounts(addresses, account_ids)
+
+        rows = []
+        for block_num, block_when, txid, idx, from_, to_, value in events:
+            delta = dict(account_id=account_ids[to_], block_num=block_num, txid=txid, tx_internal_order=idx, block_timestamped_at=block_when)
+            delta.update(TokenHolderDelta.get_delta_columns(value, +1))
+            rows.append(delta)
+
+            if from_ != self.NULL_ADDRESS:
+                delta = dict(account_id=account_ids[from_], block_num=block_num, txid=txid, tx_internal_order=idx, block_timestamped_at=block_when)
+                delta.update(TokenHolderDelta.get_delta_columns(value, -1))
+                rows.append(delta)
+
+        session.bulk_insert_mappings(TokenHolderDelta, rows)
+
+        # Mark all touched accounts dirty
+        for chunk in chunked(list(account_ids.values()), IN_QUERY_CHUNK_SIZE):
+            session.query(TokenHolderAccount).filter(TokenHolderAccount.id.in_(chunk)).update({TokenHolderAccount.balance_calculated_at: None}, synchronize_session=False)
+
+        expire_instances(session, TokenHolderAccount)
+
     def get_raw_balance(self, address) -> int:
         """Get uint256 token balance of an address."""
         account = self.get_or_create_account(address)
         return account.get_balance_uint()
 
-    def get_raw_balances(self, addresses: Iterable[str]) -> Dict[str, int]:
-        """Get address -> balance mappings"""
-        return {a: self.get_raw_balance(a) for a in addresses}
+    def get_raw_balances(self, addresses: Iterable[str], account_ids: Optional[Dict[str, int]]=None) -> Dict[str, int]:
+        """Get address -> balance mappings
+
+        Balances are read with IN queries by account id.
+
+        :param account_ids: Address -> account id map kept by the caller, see :py:meth:`get_or_create_accounts`
+        """
+        session = object_session(self)
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+
+        session.flush()
+        account_ids = self.get_or_create_accounts(addresses, account_ids)
+
+        balances = {}
+        for chunk in chunked(list(set(account_ids.values())), IN_QUERY_CHUNK_SIZE):
+            q = session.query(TokenHolderAccount.id, TokenHolderAccount.raw_balance, TokenHolderAccount.sign, TokenHolderAccount.balance_calculated_at).filter(TokenHolderAccount.id.in_(chunk))
+            for account_id, raw_balance, sign, balance_calculated_at in q:
+                if balance_calculated_at is None:
+                    raise TypeError("You need to calculate denormalised balance first")
+                balances[account_id] = TokenHolderAccount.decode_balance(raw_balance, sign)
+
+        return {address: balances[account_id] for address, account_id in account_ids.items()}
+
+    def get_block_num_at(self, when: datetime.datetime) -> Optional[int]:
+        """Get the last block with token events at or before a point of time.
+
+        Balances only change in blocks that have events, so this block has the same balances as the point of time.
+
+        :return: Block number or None if the token had no events yet
+        """
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+        TokenHolderDelta = TokenHolderAccount.deltas.property.mapper.class_
+        q = object_session(self).query(sa.func.max(TokenHolderDelta.block_num)).join(TokenHolderDelta.account)
+        return q.filter(TokenHolderAccount.token_id == self.id, TokenHolderDelta.block_timestamped_at <= when).scalar()
+
+    def get_holdings_at(self, at: Union[int, datetime.datetime]) -> Dict[str, Tuple[int, datetime.datetime]]:
+        """Get token holders and their balances as they were in the past.
+
+        Starts from the nearest known balance table, either a balance snapshot or the denormalised balances,
+        and applies or undoes only the deltas between it and the asked block.
+        The lookups go through the (account_id, block_num) index of deltas.
+
+        :param at: Block number, balances at the end of this block, or a point of time
+        :return: Address -> (raw balance, timestamp of the last balance change) for all addresses with a non-zero balance
+        """
+
+        assert self.end_block is not None, "Token has not been scanned"
+
+        if isinstance(at, datetime.datetime):
+            block_num = self.get_block_num_at(at)
+            if block_num is None:
+                return {}
+        else:
+            block_num = at
+
+        assert block_num <= self.end_block, "Token scanned only up to block {}, asked balances at {}".format(self.end_block, block_num)
+
+        holdings = self.get_account_holdings_at(block_num)
+        return {address: (balance, updated_at) for address, balance, updated_at in holdings.values() if balance != 0}
+
+    def get_account_holdings_at(self, block_num: int) -> Dict[int, list]:
+        """Calculate balances at the end of a block for all accounts of this token.
+
+        :return: Account id -> [address, raw balance, timestamp of the last balance change] for all accounts known now
+        """
+        session = object_session(self)
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+        TokenHolderDelta = TokenHolderAccount.deltas.property.mapper.class_
+        TokenBalanceSnapshot = self.snapshots.attr.target_mapper.class_
+
+        # Make sure all checkpoints are current
+        self.update_denormalised_balances()
+
+        q = session.query(TokenHolderAccount.id, TokenHolderAccount.address, TokenHolderAccount.raw_balance, TokenHolderAccount.sign, TokenHolderAccount.last_block_updated_at)
+        q = q.filter(TokenHolderAccount.token_id == self.id)
+
+        # Pick the closest starting point, the denormalised balances count as a snapshot at the end block
+        snapshot = TokenBalanceSnapshot.get_nearest(self, block_num)
+        if snapshot and abs(snapshot.block_num - block_num) < self.end_block - block_num:
+            base_block = snapshot.block_num
+            holdings = {account_id: [address, 0, None] for account_id, address, raw_balance, sign, updated_at in q}
+            for account_id, balance, updated_at in snapshot.get_entries():
+                holdings[account_id][1:] = [balance, updated_at]
+        else:
+            base_block = self.end_block
+            holdings = {account_id: [address, TokenHolderAccount.decode_balance(raw_balance, sign), updated_at] for account_id, address, raw_balance, sign, updated_at in q}
+
+        if base_block < block_num:
+            # Apply later deltas
+            for account_id, delta_sum, last_block_at in TokenHolderDelta.iterate_range_sums(self, from_block=base_block + 1, to_block=block_num):
+                holdings[account_id][1] += delta_sum
+                holdings[account_id][2] = last_block_at
+        elif base_block > block_num:
+            # Undo later deltas
+            changed_later = []
+            for account_id, delta_sum, last_block_at in TokenHolderDelta.iterate_range_sums(self, from_block=block_num + 1, to_block=base_block):
+                holdings[account_id][1] -= delta_sum
+                holdings[account_id][2] = None
+                changed_later.append(account_id)
+
+            # Accounts whose last change happened after the block were last changed by an earlier delta
+            for chunk in chunked(changed_later, IN_QUERY_CHUNK_SIZE):
+                q = session.query(TokenHolderDelta.account_id, sa.func.max(TokenHolderDelta.block_timestamped_at))
+                q = q.filter(TokenHolderDelta.account_id.in_(chunk), TokenHolderDelta.block_num <= block_num).group_by(TokenHolderDelta.account_id)
+                for account_id, last_block_updated_at in q:
+                    holdings[account_id][2] = last_block_updated_at
+
+        return holdings
+
+    def create_balance_snapshot(self, block_num: int, pinned=False) -> "_TokenBalanceSnapshot":
+        """Materialise the balances of all holders at the end of a block.
+
+        Later historical queries near this block start from the snapshot instead of summing deltas.
+
+        :param pinned: Keep the snapshot when pruning old snapshots, e.g. for a record date of a dividend payout
+        """
+        TokenBalanceSnapshot = self.snapshots.attr.target_mapper.class_
+
+        existing = self.snapshots.filter_by(block_num=block_num).one_or_none()
+        if existing:
+            existing.pinned = existing.pinned or pinned
+            return existing
+
+        holdings = self.get_account_holdings_at(block_num)
+        return TokenBalanceSnapshot.create(self, block_num, pinned, holdings)
+
+    def create_periodic_balance_snapshots(self, interval: int, retention: Optional[int]=None) -> List["_TokenBalanceSnapshot"]:
+        """Make sure there is a snapshot for every ``interval`` blocks scanned so far.
+
+        :param retention: How many periodic snapshots to keep, older unpinned snapshots are deleted
+        :return: Newly created snapshots
+        """
+        assert interval > 0
+        TokenBalanceSnapshot = self.snapshots.attr.target_mapper.class_
+
+        created = []
+        latest = self.snapshots.filter_by(pinned=False).order_by(TokenBalanceSnapshot.block_num.desc()).first()
+        block_num = (latest.block_num if latest else 0) + interval
+        block_num -= block_num % interval
+
+        if retention is not None and self.end_block is not None:
+            # Do not create snapshots that the retention would delete right away
+            last_block_num = self.end_block - self.end_block % interval
+            block_num = max(block_num, last_block_num - (retention - 1) * interval)
+
+        while self.end_block is not None and block_num <= self.end_block:
+            if not self.start_block or block_num >= self.start_block:
+                created.append(self.create_balance_snapshot(block_num))
+            block_num += interval
+
+        if retention is not None:
+            self.prune_balance_snapshots(retention)
+
+        return created
+
+    def prune_balance_snapshots(self, retention: int):
+        """Delete all but the latest ``retention`` unpinned snapshots."""
+        TokenBalanceSnapshot = self.snapshots.attr.target_mapper.class_
+        q = self.snapshots.filter_by(pinned=False).order_by(TokenBalanceSnapshot.block_num.desc())
+        TokenBalanceSnapshot.delete_snapshots(self, [snapshot.id for snapshot in q.offset(retention)])
+
+    def record_scanned_block_hash(self, block_num: int, block_hash: str):
+        """Remember the hash of the last block of a scanned block range."""
+        hashes = [h for h in (self.scanned_block_hashes or []) if h[0] < block_num]
+        hashes.append([block_num, block_hash])
+        self.scanned_block_hashes = hashes[-self.MAX_SCANNED_BLOCK_HASHES:]
+
+    def delete_scanned_block_hashes_after(self, after_block: int):
+        """Forget hashes of blocks being rescanned."""
+        self.scanned_block_hashes = [h for h in (self.scanned_block_hashes or []) if h[0] < after_block]
+
+    def delete_balance_snapshots_after(self, after_block: int):
+        """Delete snapshots that include blocks being rescanned."""
+        TokenBalanceSnapshot = self.snapshots.attr.target_mapper.class_
+        q = self.snapshots.filter(TokenBalanceSnapshot.block_num >= after_block)
+        TokenBalanceSnapshot.delete_snapshots(self, [snapshot.id for snapshot in q])
+
+    def get_balances_at(self, at: Union[int, datetime.datetime]) -> Dict[str, int]:
+        """Get address -> raw balance mapping of all token holders at a block or a point of time.
+
+        See :py:meth:`get_holdings_at`.
+        """
+        return {address: balance for address, (balance, updated_at) in self.get_holdings_at(at).items()}
+
+    def update_denormalised_balances(self, bulk=True):
+        """Calculate new balance on all accounts that have been marked dirty since the last scan.
+
+        :param bulk: Calculate the sums of all dirty accounts in one grouped pass over the deltas of this token and write them back with one bulk UPDATE.
+            If False, fall back to loading ORM objects account by account.
+        """
+
+        if not bulk:
+            for account in self.accounts.filter_by(balance_calculated_at=None):
+                account.update_denormalised_balance()
+            return
+
+        session = object_session(self)
+        TokenHolderAccount = self.accounts.attr.target_mapper.class_
+        TokenHolderDelta = TokenHolderAccount.deltas.property.mapper.class_
+
+        session.flush()
+
+        # Start from the balance checkpoints of the dirty accounts
+        dirty = session.query(TokenHolderAccount.id, TokenHolderAccount.raw_balance, TokenHolderAccount.sign, TokenHolderAccount.last_block_num, TokenHolderAccount.last_block_updated_at)
+        dirty = dirty.filter(TokenHolderAccount.token_id == self.id, TokenHolderAccount.balance_calculated_at == None)
+        sums = {}
+        for account_id, raw_balance, sign, last_block_num, last_block_at in dirty:
+            if raw_balance is None:
+                sums[account_id] = (0, 0, None)
+            else:
+                sums[account_id] = (TokenHolderAccount.decode_balance(raw_balance, sign), last_block_num, last_block_at)
+
+        if not sums:
+            return
+
+        for account_id, delta_sum, last_block_num, last_block_at in TokenHolderDelta.iterate_account_sums(self):
+            raw_balance = sums[account_id][0] + delta_sum
+            sums[account_id] = (raw_balance, last_block_num, last_block_at)
+
+        calculated_at = now()
+        mappings = []
+        for account_id, (raw_balance, last_block_num, last_block_at) in sums.items():
+            mapping = dict(id=account_id, last_block_num=last_block_num, last_block_updated_at=last_block_at, balance_calculated_at=calculated_at)
+            mapping.update(TokenHolderAccount.get_balance_columns(raw_balance))
+            mappings.append(mapping)
+
+        session.bulk_update_mappings(TokenHolderAccount, mappings)
+        expire_instances(session, TokenHolderAccount)
+
+
+class _BlockHeader(TimeStampedBaseModel):
+    """Persistent cache of block hashes and timestamps.
+
+    Shared by scans of all tokens on the same network, so each header is downloaded from the node only once.
+    """
+
+    __tablename__ = "block_header"
+
+    #: Which network e.g. "ethereum", "kovan"
+    network = sa.Column(sa.String(256), nullable=False)
+
+    #: Block number
+    block_num = sa.Column(sa.Integer, nullable=False)
+
+    #: Block hash as 0x hex string. Tells if we have seen a block that later got forked away.
+    block_hash = sa.Column(sa.String(256), nullable=False)
+
+    #: When the block was timestamped
+    timestamp = sa.Column(UTCDateTime, nullable=False)
+
+    @classmethod
+    def get_headers(cls, dbsession, network: str, block_nums: Iterable[int]) -> Dict[int, Tuple[str, datetime.datetime]]:
+        """Look up stored headers.
+
+        :return: Block num -> (block hash, timestamp) for blocks we have
+        """
+        result = {}
+        for chunk in chunked(sorted(set(block_nums)), IN_QUERY_CHUNK_SIZE):
+            q = dbsession.query(cls.block_num, cls.block_hash, cls.timestamp).filter(cls.network == network, cls.block_num.in_(chunk))
+            result.update({block_num: (block_hash, timestamp) for block_num, block_hash, timestamp in q})
+        return result
+
+    @classmethod
+    def delete_headers_after(cls, dbsession, network: str, block_num: int):
+        """Drop headers of blocks that may have been forked away."""
+        dbsession.query(cls).filter(cls.network == network, cls.block_num > block_num).delete(synchronize_session=False)
+
+    @classmethod
+    def store_headers(cls, dbsession, network: str, headers: Iterable[Tuple[int, str, datetime.datetime]]):
+        """Bulk insert headers.
+
+        A block another scanner has stored meanwhile gets overwritten, as the stored header may be from a chain that has since been reorganised.
+
+        :param headers: Iterable of (block num, block hash, timestamp) tuples
+        """
+        rows = [dict(network=network, block_num=block_num, block_hash=block_hash, timestamp=timestamp) for block_num, block_hash, timestamp in headers]
+        if not rows:
+            return
+
+        dialect = dbsession.get_bind().dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(cls.__table__)
+            stmt = stmt.on_conflict_do_update(index_elements=[cls.network, cls.block_num], set_=dict(block_hash=stmt.excluded.block_hash, timestamp=stmt.excluded.timestamp))
+        elif dialect == "sqlite":
+            stmt = cls.__table__.insert().prefix_with("OR REPLACE")
+        else:
+            stmt = cls.__table__.insert()
+
+        dbsession.execute(stmt, rows)
+
+
+class _TokenBalanceSnapshot(TimeStampedBaseModel):
+    """Balances of all holders of a token materialised at a certain block.
+
+    Historical balance queries start from the nearest snapshot and only apply the deltas after it.
+    The balances themselves are in :py:class:`_TokenBalanceSnapshotEntry` rows.
+    """
+
+    __tablename__ = "token_balance_snapshot"
+
+    #: Balances at the end of this block
+    block_num = sa.Column(sa.Integer, nullable=False)
+
+    #: Pinned snapshots are never pruned, e.g. record dates of dividend payouts and votes
+    pinned = sa.Column(sa.Boolean, nullable=False, default=False)
+
+    #: Number of accounts with a non-zero balance
+    holder_count = sa.Column(sa.Integer, nullable=False, default=0)
+
+    def __str__(self):
+        return "<Snapshot:{} block:{} holders:{}>".format(self.token.address, self.block_num, self.holder_count)
+
+    @classmethod
+    def create(cls, status: _TokenScanStatus, block_num: int, pinned: bool, holdings: Dict[int, list]) -> "_TokenBalanceSnapshot":
+        """Write a snapshot with one bulk insert.
+
+        :param holdings: Account id -> [address, raw balance, last balance change timestamp], see :py:meth:`_TokenScanStatus.get_account_holdings_at`
+        """
+        session = object_session(status)
+        TokenBalanceSnapshotEntry = cls.entries.property.mapper.class_
+
+        # Accounts that came and went before the block need no rows
+        entries = {account_id: (balance, updated_at) for account_id, (address, balance, updated_at) in holdings.items() if updated_at is not None}
+
+        snapshot = cls(block_num=block_num, pinned=pinned, holder_count=sum(1 for balance, updated_at in entries.values() if balance != 0))
+        status.snapshots.append(snapshot)
+        session.flush()
+
+        rows = []
+        for account_id, (balance, updated_at) in entries.items():
+            row = TokenBalanceSnapshotEntry.get_balance_columns(balance)
+            row.update(dict(snapshot_id=snapshot.id, account_id=account_id, last_block_updated_at=updated_at))
+            rows.append(row)
+
+        session.bulk_insert_mappings(TokenBalanceSnapshotEntry, rows)
+        return snapshot
+
+    @classmethod
+    def get_nearest(cls, status: _TokenScanStatus, block_num: int) -> Optional["_TokenBalanceSnapshot"]:
+        """Find the snapshot closest to a block, before or after it."""
+        before = status.snapshots.filter(cls.block_num <= block_num).order_by(cls.block_num.desc()).first()
+        after = status.snapshots.filter(cls.block_num > block_num).order_by(cls.block_num.asc()).first()
+        candidates = [s for s in (before, after) if s]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda s: abs(s.block_num - block_num))
+
+    @classmethod
+    def delete_snapshots(cls, status: _TokenScanStatus, snapshot_ids: List[int]):
+        session = object_session(status)
+        TokenBalanceSnapshotEntry = cls.entries.property.mapper.class_
+        for chunk in chunked(snapshot_ids, IN_QUERY_CHUNK_SIZE):
+            session.query(TokenBalanceSnapshotEntry).filter(TokenBalanceSnapshotEntry.snapshot_id.in_(chunk)).delete(synchronize_session=False)
+            session.query(cls).filter(cls.id.in_(chunk)).delete(synchronize_session=False)
+        expire_instances(session, cls)
+
+    def get_entries(self) -> Iterable[Tuple[int, int, datetime.datetime]]:
+        """Stream the balances of this snapshot.
+
+        :return: Iterable of (account id, raw balance, last balance change timestamp)
+        """
+        TokenBalanceSnapshotEntry = self.entries.attr.target_mapper.class_
+        q = object_session(self).query(TokenBalanceSnapshotEntry.account_id, TokenBalanceSnapshotEntry.raw_balance, TokenBalanceSnapshotEntry.sign, TokenBalanceSnapshotEntry.last_block_updated_at)
+        for account_id, raw_balance, sign, updated_at in q.filter_by(snapshot_id=self.id).yield_per(1000):
+            yield account_id, TokenBalanceSnapshotEntry.decode_balance(raw_balance, sign), updated_at
+
+
+class _TokenBalanceSnapshotEntry(TimeStampedBaseModel):
+    """Balance of one account in a snapshot.
+
+    Uses the same raw uint256 plus sign encoding as the denormalised account balances.
+    """
+
+    __tablename__ = "token_balance_snapshot_entry"
+
+    #: Raw uint256 balance
+    raw_balance = sa.Column(sa.Binary(32), nullable=False)
+
+    #: +1 or -1
+    sign = sa.Column(sa.SmallInteger, nullable=False)
+
+    #: When the balance of the account last changed before the snapshot block
+    last_block_updated_at = sa.Column(UTCDateTime, nullable=True)
+
+    @classmethod
+    def decode_balance(cls, raw_balance, sign: int) -> int:
+        return _TokenHolderAccount.decode_balance(raw_balance, sign)
 
-    def update_denormalised_balances(self):
-        """Calculate new balance on all accounts that have been marked dirty since the last scan."""
-        for account in self.accounts.filter_by(balance_calculated_at=None):
-            account.update_denormalised_balance()
+    @classmethod
+    def get_balance_columns(cls, val: int) -> dict:
+        columns = _TokenHolderAccount.get_balance_columns(val)
+        return dict(raw_balance=columns["raw_balance"], sign=columns["sign"])
 
 
 class _TokenHolderDelta(TimeStampedBaseModel):
@@ -156,7 +695,7 @@ class _TokenHolderDelta(TimeStampedBaseModel):
     block_timestamped_at = sa.Column(UTCDateTime, nullable=True)
 
     #: Give us direct link to this transaction
-    txid = sa.Column(sa.String(256), nullable=True)
+    txid = sa.Column(TransactionHash(), nullable=True)
 
     #: Order of this event within the transaction, as one transaction may trigger multiple Transfer events within smart contracts
     tx_internal_order = sa.Column(sa.Integer, nullable=True)
@@ -172,29 +711,132 @@ class _TokenHolderDelta(TimeStampedBaseModel):
 
     def get_delta_uint(self):
         """Return the delta as Python unlimited integer."""
-        return int(hexlify(self.raw_delta), 16) * self.sign
+        return self.decode_delta(self.raw_delta, self.sign)
+
+    @classmethod
+    def decode_delta(cls, raw_delta, sign: int) -> int:
+        """Convert stored column values back to Python unlimited integer."""
+        return int(hexlify(raw_delta), 16) * sign
 
     def set_delta_uint(self, val: int, sign: int):
         """Return the delta as Python """
+        for key, value in self.get_delta_columns(val, sign).items():
+            setattr(self, key, value)
+
+    @classmethod
+    def get_delta_columns(cls, val: int, sign: int) -> dict:
+        """Column values for storing a delta, used for bulk inserts."""
         assert type(val) == int
         b = val.to_bytes(32, byteorder="big")
-        self.raw_delta = b
-        self.sign = sign
+        return {"raw_delta": b, "sign": sign}
 
     @classmethod
     def get_all_deltas(cls, status: _TokenScanStatus) -> Query:
         """Get all deltas related to this token."""
         return status.accounts.join(cls)
 
+    @classmethod
+    def iterate_account_sums(cls, status: _TokenScanStatus, batch_size=1000) -> Iterable[Tuple[int, int, int, datetime.datetime]]:
+        """Sum new deltas for all dirty accounts of a token in one pass.
+
+        Only deltas newer than the balance checkpoint of each account are included,
+        see :py:meth:`_TokenHolderAccount.update_denormalised_balance`.
+
+        SQLite cannot sum uint256, so we stream raw delta rows ordered by account
+        and keep only a running sum per account in memory instead of loading ORM objects.
+
+        :return: Iterable of (account_id, delta sum, last block num, last block timestamp) tuples
+        """
+        TokenHolderAccount = cls.account.property.mapper.class_
+
+        q = object_session(status).query(cls.account_id, cls.raw_delta, cls.sign, cls.block_num, cls.block_timestamped_at)
+        q = q.join(cls.account).filter(TokenHolderAccount.token_id == status.id, TokenHolderAccount.balance_calculated_at == None)
+        q = q.filter(sa.or_(TokenHolderAccount.raw_balance == None, cls.block_num > TokenHolderAccount.last_block_num))
+        q = q.order_by(cls.account_id, cls.block_num, cls.tx_internal_order).yield_per(batch_size)
+
+        current_id = None
+        total = last_block_num = 0
+        last_block_at = None
+        for account_id, raw_delta, sign, block_num, block_timestamped_at in q:
+            if account_id != current_id:
+                if current_id is not None:
+                    yield current_id, total, last_block_num, last_block_at
+                current_id = account_id
+                total = 0
+
+            total += cls.decode_delta(raw_delta, sign)
+            last_block_num = block_num
+            last_block_at = block_timestamped_at
+
+        if current_id is not None:
+            yield current_id, total, last_block_num, last_block_at
+
+    @classmethod
+    def iterate_range_sums(cls, status: _TokenScanStatus, from_block: Optional[int]=None, to_block: Optional[int]=None, batch_size=1000) -> Iterable[Tuple[int, int, datetime.datetime]]:
+        """Sum the deltas of each account of a token over a block range.
+
+        :param from_block: First block included, or from the beginning
+        :param to_block: Last block included, or until the end
+        :return: Iterable of (account_id, delta sum, last block timestamp) tuples for accounts that have deltas in the range
+        """
+        TokenHolderAccount = cls.account.property.mapper.class_
+
+        q = object_session(status).query(cls.account_id, cls.raw_delta, cls.sign, cls.block_timestamped_at)
+        q = q.join(cls.account).filter(TokenHolderAccount.token_id == status.id)
+        if from_block is not None:
+            q = q.filter(cls.block_num >= from_block)
+        if to_block is not None:
+            q = q.filter(cls.block_num <= to_block)
+        q = q.order_by(cls.account_id, cls.block_num).yield_per(batch_size)
+
+        current_id = None
+        total = 0
+        last_block_at = None
+        for account_id, raw_delta, sign, block_timestamped_at in q:
+            if account_id != current_id:
+                if current_id is not None:
+                    yield current_id, total, last_block_at
+                current_id = account_id
+                total = 0
+            total += cls.decode_delta(raw_delta, sign)
+            last_block_at = block_timestamped_at
+
+        if current_id is not None:
+            yield current_id, total, last_block_at
+
     @classmethod
     def delete_potentially_forked_block_data(cls, status: _TokenScanStatus, after_block: int):
-        """Get all deltas related to this token."""
+        """Purge all deltas of this token at or after the given block.
 
-        # TODO: Not sure how this can be offloaded 100% SQL
+        Runs as two set-based statements regardless of the number of holders.
+        Only accounts that actually lose deltas are marked dirty.
+        Their balance checkpoint is dropped if it includes any purged delta.
+        """
+        TokenHolderAccount = cls.account.property.mapper.class_
         session = object_session(status)
-        for acc in status.accounts:
-            acc.deltas.filter(cls.block_num >= after_block).delete()
-            acc.mark_dirty()
+        session.flush()
+
+        token_accounts = sa.select([TokenHolderAccount.id]).where(TokenHolderAccount.token_id == status.id)
+        forked_accounts = sa.select([cls.account_id]).where(cls.block_num >= after_block).distinct()
+
+        # Mark first, as after the delete we can no longer tell which accounts lost deltas
+        checkpoint_forked = TokenHolderAccount.last_block_num >= after_block
+
+        def reset(column):
+            return sa.case([(checkpoint_forked, sa.null())], else_=column)
+
+        session.query(TokenHolderAccount).filter(TokenHolderAccount.token_id == status.id, TokenHolderAccount.id.in_(forked_accounts)).update({
+            TokenHolderAccount.raw_balance: reset(TokenHolderAccount.raw_balance),
+            TokenHolderAccount.sign: reset(TokenHolderAccount.sign),
+            TokenHolderAccount.last_block_num: reset(TokenHolderAccount.last_block_num),
+            TokenHolderAccount.last_block_updated_at: reset(TokenHolderAccount.last_block_updated_at),
+            TokenHolderAccount.balance_calculated_at: None,
+        }, synchronize_session=False)
+
+        session.query(cls).filter(cls.block_num >= after_block, cls.account_id.in_(token_accounts)).delete(synchronize_session=False)
+
+        expire_instances(session, TokenHolderAccount)
+        expire_instances(session, cls)
 
 
 class _TokenHolderAccount(TimeStampedBaseModel):
@@ -208,8 +850,11 @@ class _TokenHolderAccount(TimeStampedBaseModel):
 
     __tablename__ = "token_holder_account"
 
+    #: Whether :py:meth:`get_balance_sort_column` orders balances exactly, so cap tables can be paged in SQL
+    EXACT_BALANCE_SORT = False
+
     #: Address of the token contract, as hex string 0x00000
-    address = sa.Column(sa.String(256), nullable=False)
+    address = sa.Column(Address(), nullable=False)
 
     #: Denormalised balance on this account - Raw uint256 data
     #: Calculated from account deltas.
@@ -245,6 +890,23 @@ class _TokenHolderAccount(TimeStampedBaseModel):
     def is_dirty(self):
         return self.balance_calculated_at is None
 
+    def reset_balance_checkpoint(self):
+        """Force the next balance calculation to sum all deltas from the scratch."""
+        self.raw_balance = None
+        self.sign = None
+        self.last_block_num = None
+        self.last_block_updated_at = None
+        self.mark_dirty()
+
+    def get_balance_checkpoint(self) -> Optional[Tuple[int, int, datetime.datetime]]:
+        """Get the last denormalised balance and up to which block it has been calculated.
+
+        :return: Tuple (raw balance, last block num, last block timestamp) or None if there is no checkpoint
+        """
+        if self.raw_balance is None:
+            return None
+        return self.decode_balance(self.raw_balance, self.sign), self.last_block_num, self.last_block_updated_at
+
     def add_delta(self, delta: _TokenHolderDelta):
         self.deltas.append(delta)
         self.mark_dirty()
@@ -255,35 +917,55 @@ class _TokenHolderAccount(TimeStampedBaseModel):
         if self.is_dirty():
             raise TypeError("You need to calculate denormalised balance first")
 
-        return int(hexlify(self.raw_balance), 16) * self.sign
+        return self.decode_balance(self.raw_balance, self.sign)
+
+    @classmethod
+    def decode_balance(cls, raw_balance, sign: int) -> int:
+        """Convert stored column values back to Python unlimited integer."""
+        return int(hexlify(raw_balance), 16) * sign
 
     def set_balance_uint(self, val: int):
         """Return the delta as Python """
+        for key, value in self.get_balance_columns(val).items():
+            setattr(self, key, value)
+
+    @classmethod
+    def get_balance_columns(cls, val: int) -> dict:
+        """Column values for storing a denormalised balance, used for bulk updates."""
 
         assert type(val) == int
         b = abs(val).to_bytes(32, byteorder="big")
 
-        self.raw_balance = b
-        self.sign = -1 if val < 0 else 1
+        return {
+            "raw_balance": b,
+            "sign": -1 if val < 0 else 1,
+            "empty": val == 0,
+            # A hack because SQLite does not support decimals or uint256
+            # TODO: Assuming 18 decimals always
+            "sortable_balance": int(Decimal(val) / Decimal(10 ** 18)),
+        }
 
-        if val != 0:
-            self.empty = False
-        else:
-            self.empty = True
+    @classmethod
+    def get_balance_sort_column(cls):
+        """Column to order accounts by balance in SQL.
+
+        See :py:attr:`EXACT_BALANCE_SORT` whether this gives the exact balance order.
 
-        # A hack because SQLite does not support decimals or uint256
-        # TODO: Assuming 18 decimals always
-        self.sortable_balance = int(Decimal(val) / Decimal(10 ** 18))
+        The lossy whole token amount, as SQLite cannot compare uint256.
+        """
+        return cls.sortable_balance
 
     def get_decimal_balance(self) -> Decimal:
         """Get balance in human readable decimal fractions."""
         raw_balance = self.get_balance_uint()
         return Decimal(raw_balance) / (Decimal(10) ** Decimal(self.token.decimals))
 
-    def calculate_sum_from_deltas(self) -> Tuple[int, int, datetime.datetime]:
+    def calculate_sum_from_deltas(self, after_block: Optional[int]=None) -> Tuple[int, int, datetime.datetime]:
         """Denormalize the token balance.
 
         Drop in a more efficient PostgreSQL implementation here using native database types.
+
+        :param after_block: Only sum deltas newer than this block
         """
         sum = last_block_num = 0
         last_updated_at = None
@@ -291,6 +973,9 @@ class _TokenHolderAccount(TimeStampedBaseModel):
         TokenHolderDelta = self.deltas.attr.target_mapper.class_
 
         deltas = self.deltas.order_by(TokenHolderDelta.block_num, TokenHolderDelta.tx_internal_order)
+        if after_block is not None:
+            deltas = deltas.filter(TokenHolderDelta.block_num > after_block)
+
         for d in deltas:
             sum += d.get_delta_uint()
             last_block_num = d.block_num
@@ -298,8 +983,23 @@ class _TokenHolderAccount(TimeStampedBaseModel):
         return sum, last_block_num, last_updated_at
 
     def update_denormalised_balance(self):
-        """Denormalise the balance for this account."""
-        raw_balance, last_block_num, last_block_at = self.calculate_sum_from_deltas()
+        """Denormalise the balance for this account.
+
+        The previously calculated balance acts as a checkpoint: we only add deltas newer than its last block.
+        Rescans that purge data before the checkpoint reset it with :py:meth:`reset_balance_checkpoint`,
+        forcing a full recalculation.
+        """
+        checkpoint = self.get_balance_checkpoint()
+        if checkpoint:
+            balance, checkpoint_block_num, checkpoint_block_at = checkpoint
+            delta_sum, last_block_num, last_block_at = self.calculate_sum_from_deltas(after_block=checkpoint_block_num)
+            raw_balance = balance + delta_sum
+            if not last_block_num:
+                # No new deltas
+                last_block_num, last_block_at = checkpoint_block_num, checkpoint_block_at
+        else:
+            raw_balance, last_block_num, last_block_at = self.calculate_sum_from_deltas()
+
         self.set_balance_uint(raw_balance)
         self.last_block_updated_at = last_block_at
         self.last_block_num = last_block_num
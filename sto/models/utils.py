@@ -1,9 +1,12 @@
 import datetime
+from typing import Optional
 
 import sqlalchemy as sa
 
+from eth_utils import to_checksum_address
 from sqlalchemy import DateTime, processors
 from sqlalchemy.dialects.sqlite import DATETIME as DATETIME_
+from sqlalchemy.types import TypeDecorator
 
 
 def now() -> datetime.datetime:
@@ -49,6 +52,71 @@ class UTCDateTime(DateTime):
             return super(UTCDateTime, self)._dialect_info(dialect)
 
 
+def is_compact_storage(dialect) -> bool:
+    """Does this database store addresses and hashes as raw bytes.
+
+    Set per engine by :py:func:`sto.db.setup_database` based on the database options.
+    """
+    return getattr(dialect, "sto_compact_storage", False)
+
+
+def hex_to_bytes(value: Optional[str]) -> Optional[bytes]:
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        # Already converted
+        return value
+    assert value.startswith("0x"), "Not a hex value: {}".format(value)
+    return bytes.fromhex(value[2:])
+
+
+class HexBinary(TypeDecorator):
+    """A 0x prefixed hex string, like an address or a transaction hash.
+
+    In compact storage databases the value is stored as raw bytes, 20 bytes for an address instead of 42 characters.
+    The conversion happens here at the model boundary, so Python code sees hex strings either way.
+    """
+
+    impl = sa.String(256)
+
+    def __init__(self, byte_length: int, checksum_address=False):
+        """
+        :param byte_length: Length of the value as raw bytes
+        :param checksum_address: Read values are returned as checksummed Ethereum addresses
+        """
+        super(HexBinary, self).__init__()
+        self.byte_length = byte_length
+        self.checksum_address = checksum_address
+
+    def load_dialect_impl(self, dialect):
+        if is_compact_storage(dialect):
+            return dialect.type_descriptor(sa.LargeBinary(self.byte_length))
+        return dialect.type_descriptor(sa.String(256))
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not is_compact_storage(dialect):
+            return value
+        return hex_to_bytes(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or not is_compact_storage(dialect):
+            return value
+        value = "0x" + bytes(value).hex()
+        if self.checksum_address:
+            return to_checksum_address(value)
+        return value
+
+
+def Address():
+    """Ethereum address column type."""
+    return HexBinary(20, checksum_address=True)
+
+
+def TransactionHash():
+    """Ethereum transaction hash column type."""
+    return HexBinary(32)
+
+
 class TimeStampedBaseModel:
     """
     Base model with UUID as PK and have create & update timestamps
@@ -60,3 +128,19 @@ class TimeStampedBaseModel:
     created_at = sa.Column(UTCDateTime, default=now)
     updated_at = sa.Column(UTCDateTime, onupdate=now)
 
+
+def chunked(items: list, size: int):
+    """Split a list to pieces, so that IN queries stay under database bound parameter limits."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def expire_instances(session, cls: type):
+    """Expire loaded ORM instances of a model after they were bypassed by bulk SQL statements.
+
+    Bulk inserts and updates do not touch the session identity map,
+    so any loaded object would otherwise keep serving stale attribute values.
+    """
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, cls):
+            session.expire(obj)
@@ -1,3 +1,4 @@
+import arrow
 from arrow import Arrow
 import datetime
 
@@ -7,3 +8,11 @@ def friendly_time(d: datetime.datetime) -> str:
     ad = Arrow.fromdatetime(d)
     other = Arrow.fromdatetime(datetime.datetime.utcnow())
     return ad.humanize(other)
+
+
+def parse_utc_time(s: str) -> datetime.datetime:
+    """Parse ISO 8601 style time string, defaulting to UTC if no timezone is given.
+
+    Times with other offsets are converted to UTC, as SQLite compares the stored wall clock values.
+    """
+    return arrow.get(s).to("utc").datetime
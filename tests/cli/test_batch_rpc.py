@@ -0,0 +1,60 @@
+"""JSON-RPC batch requests against HTTP nodes."""
+import json
+
+import pytest
+import requests
+from web3 import Web3, HTTPProvider
+
+from sto.ethereum.utils import batch_rpc_call, BatchRequestFailed
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+@pytest.fixture
+def http_web3():
+    return Web3(HTTPProvider("http://localhost:8545"))
+
+
+def fake_node(monkeypatch, reply):
+    """Make HTTP requests get a canned reply, built from the request payload."""
+
+    def _post(url, data, **kwargs):
+        return FakeResponse(reply(json.loads(data)))
+
+    monkeypatch.setattr(requests, "post", _post)
+
+
+def test_batch_rpc_call(monkeypatch, http_web3):
+    """Replies are matched to calls by id, even if the node sends them in another order."""
+    fake_node(monkeypatch, lambda payload: [{"id": call["id"], "result": call["params"][0]} for call in reversed(payload)])
+    replies = batch_rpc_call(http_web3, "eth_getBlockByNumber", [[n, False] for n in range(5)], batch_size=2)
+    assert [reply["result"] for reply in replies] == [hex(n) for n in range(5)]
+
+
+def test_batch_rpc_call_rejected(monkeypatch, http_web3):
+    """A single error object for the whole batch tells what the node said."""
+    fake_node(monkeypatch, lambda payload: {"jsonrpc": "2.0", "id": None, "error": {"code": -32005, "message": "rate limit exceeded"}})
+    with pytest.raises(BatchRequestFailed) as e:
+        batch_rpc_call(http_web3, "eth_getBlockByNumber", [[1, False], [2, False]])
+    assert "rate limit exceeded" in str(e.value)
+
+
+def test_batch_rpc_call_missing_reply(monkeypatch, http_web3):
+    """Calls the node did not reply to are an error."""
+    fake_node(monkeypatch, lambda payload: [{"id": call["id"], "result": None} for call in payload[1:]])
+    with pytest.raises(BatchRequestFailed):
+        batch_rpc_call(http_web3, "eth_getBlockByNumber", [[1, False], [2, False]])
+
+    fake_node(monkeypatch, lambda payload: [{"id": None, "error": {"message": "invalid request"}}])
+    with pytest.raises(BatchRequestFailed):
+        batch_rpc_call(http_web3, "eth_getBlockByNumber", [[1, False]])
@@ -1,13 +1,17 @@
+import datetime
+
+import arrow
 import pytest
 
 from sto.distribution import read_csv
 from sto.ethereum.issuance import contract_status
 from sto.ethereum.status import update_status
 from sto.ethereum.tokenscan import token_scan
-from sto.generic.captable import generate_cap_table, print_cap_table
+from sto.generic.captable import generate_cap_table, stream_cap_table, print_cap_table
 from sto.models.implementation import TokenScanStatus, TokenHolderAccount
 from sto.identityprovider import NullIdentityProvider
 from sto.cli.main import cli
+from sto.time import parse_utc_time
 
 
 @pytest.fixture(params=['unrestricted', 'restricted'])
@@ -232,6 +236,95 @@ def test_cap_table_printer(logger, dbsession, network, scanned_distribution, web
     print_cap_table(table, max_entries=1000, accuracy=2)
 
 
+def test_cap_table_paging(logger, dbsession, network, scanned_distribution, web3):
+    """Cap table pages match slices of the full cap table."""
+
+    identity_provider = NullIdentityProvider()
+
+    token_address = scanned_distribution
+    for sort_order in ["address", "name", "balance", "updated"]:
+        kwargs = dict(
+            order_by=sort_order,
+            identity_provider=identity_provider,
+            include_empty=False,
+            order_direction="desc",
+            TokenScanStatus=TokenScanStatus,
+            TokenHolderAccount=TokenHolderAccount,
+        )
+        full = generate_cap_table(logger, dbsession, token_address, **kwargs)
+        page = stream_cap_table(logger, dbsession, token_address, limit=2, offset=1, **kwargs)
+
+        assert page.holder_count == len(full.entries)
+        assert page.total_balance == full.total_balance
+        assert [e.balance for e in page.entries] == [e.balance for e in full.entries[1:3]]
+
+
+def test_historical_cap_table(logger, dbsession, network, scanned_distribution, web3):
+    """We get cap tables for past blocks without rescanning."""
+
+    identity_provider = NullIdentityProvider()
+
+    token_address = scanned_distribution
+    status = dbsession.query(TokenScanStatus).filter_by(address=token_address).one()
+    issuance_block = min(delta.block_num for account in status.accounts for delta in account.deltas)
+
+    def _generate(at):
+        return generate_cap_table(
+            logger,
+            dbsession,
+            token_address,
+            order_by="balance",
+            identity_provider=identity_provider,
+            include_empty=False,
+            order_direction="desc",
+            TokenScanStatus=TokenScanStatus,
+            TokenHolderAccount=TokenHolderAccount,
+            at=at,
+            )
+
+    # Only the issuer holds tokens right after the issuance
+    table = _generate(issuance_block)
+    assert len(table.entries) == 1
+    assert table.total_balance == 9999
+
+    # The latest block gives the same result as the denormalised balances
+    latest = _generate(None)
+    table = _generate(status.end_block)
+    assert [(e.address, e.balance) for e in table.entries] == [(e.address, e.balance) for e in latest.entries]
+
+    assert status.get_balances_at(status.end_block_timestamp) == status.get_balances_at(status.end_block)
+
+    # --at-time with a non-UTC offset points to the same moment
+    at = parse_utc_time(arrow.get(status.end_block_timestamp).to("-05:00").isoformat())
+    assert status.get_balances_at(at) == status.get_balances_at(status.end_block)
+
+
+def test_parse_utc_time():
+    """Times are converted to UTC."""
+    assert parse_utc_time("2019-01-31T12:00:00+02:00") == datetime.datetime(2019, 1, 31, 10, 0, tzinfo=datetime.timezone.utc)
+    assert parse_utc_time("2019-01-31T12:00:00").utcoffset() == datetime.timedelta(0)
+
+
+def test_balance_snapshots(logger, dbsession, network, scanned_distribution, web3):
+    """Historical balances are the same whether they come through snapshots or not."""
+
+    token_address = scanned_distribution
+    status = dbsession.query(TokenScanStatus).filter_by(address=token_address).one()
+
+    expected = {block_num: status.get_balances_at(block_num) for block_num in range(1, status.end_block + 1)}
+
+    # Only the snapshots kept by the retention get created
+    created = status.create_periodic_balance_snapshots(interval=2, retention=2)
+    last_block_num = status.end_block - status.end_block % 2
+    assert [s.block_num for s in created] == [last_block_num - 2, last_block_num]
+    assert status.snapshots.count() == 2
 
+    pinned = status.create_balance_snapshot(1, pinned=True)
+    assert pinned.pinned
 
+    for block_num, balances in expected.items():
+        assert status.get_balances_at(block_num) == balances
 
+    # Rescans drop snapshots of blocks that might have been forked
+    status.delete_balance_snapshots_after(2)
+    assert [s.block_num for s in status.snapshots] == [1]
@@ -0,0 +1,134 @@
+"""Chunk size tuning for eth_getLogs scans."""
+import logging
+
+import pytest
+import requests
+
+from sto.ethereum.chunksize import ChunkSizeController, AIMDChunkSizeController, is_range_overload_error
+from sto.ethereum.scanner import fetch_logs_splitting, iterate_log_ranges
+
+
+logger = logging.getLogger(__name__)
+
+
+def test_additive_increase():
+    """Light ranges grow the chunk size by a fixed step, but not past the log target."""
+    controller = AIMDChunkSizeController(initial_chunk_size=20, increase_step=100, target_logs=500)
+
+    controller.record_success(20, 0, 0.1)
+    assert controller.get_chunk_size() == 120
+
+    controller.record_success(120, 0, 0.1)
+    assert controller.get_chunk_size() == 220
+
+    # 100 logs in 220 blocks, the log target is hit at 1100 blocks
+    controller.record_success(220, 100, 0.1)
+    assert controller.get_chunk_size() == 320
+    controller.record_success(1050, 480, 0.1)
+    assert controller.get_chunk_size() == 1093
+
+    # A range cut short by the end of the scan tells nothing new
+    controller.record_success(5, 0, 0.1)
+    assert controller.get_chunk_size() == 1093
+
+
+def test_multiplicative_decrease():
+    """Too many logs, too slow replies and node failures cut the chunk size."""
+    controller = AIMDChunkSizeController(initial_chunk_size=1000, target_logs=500, latency_budget=10.0, decrease_factor=0.5)
+
+    controller.record_success(1000, 501, 0.1)
+    assert controller.get_chunk_size() == 500
+
+    controller.record_success(500, 10, 11.0)
+    assert controller.get_chunk_size() == 250
+
+    controller.record_failure(250)
+    assert controller.get_chunk_size() == 125
+
+
+def test_chunk_size_limits():
+    controller = AIMDChunkSizeController(min_chunk_size=10, max_chunk_size=1000, initial_chunk_size=900, increase_step=500)
+
+    controller.record_success(900, 0, 0.1)
+    assert controller.get_chunk_size() == 1000
+
+    for i in range(10):
+        controller.record_failure(controller.get_chunk_size())
+    assert controller.get_chunk_size() == 10
+
+
+def test_chunk_size_state():
+    """Tuning state survives through a plain dict, like the one stored in the scan status."""
+    controller = AIMDChunkSizeController(max_chunk_size=1000)
+    controller.chunk_size = 700
+    state = controller.get_state()
+    assert state == {"chunk_size": 700}
+
+    warm = AIMDChunkSizeController(max_chunk_size=500)
+    warm.load_state(state)
+    assert warm.get_chunk_size() == 500
+
+    # Nothing stored yet
+    cold = ChunkSizeController(initial_chunk_size=20)
+    cold.load_state(None)
+    assert cold.get_chunk_size() == 20
+
+
+def test_is_range_overload_error():
+    assert is_range_overload_error(ValueError({"code": -32005, "message": "query returned more than 10000 results"}))
+    assert is_range_overload_error(requests.exceptions.ReadTimeout())
+    assert not is_range_overload_error(ValueError("invalid argument 0: hex string has odd length"))
+    # Rate limiting is not helped by splitting the range into more requests
+    assert not is_range_overload_error(ValueError({"code": -32005, "message": "rate limit exceeded"}))
+
+
+def test_fetch_logs_splitting():
+    """Ranges the node refuses are halved until the node copes, logs stay in block order."""
+
+    def fetch_logs(start_block, end_block):
+        if end_block - start_block + 1 > 25:
+            raise ValueError("query returned more than 10000 results")
+        return list(range(start_block, end_block + 1))
+
+    logs, duration, failed_ranges = fetch_logs_splitting(logger, fetch_logs, 1, 100)
+    assert logs == list(range(1, 101))
+    assert failed_ranges == [100, 50, 50]
+
+
+def test_fetch_logs_splitting_single_block():
+    """A single block that still fails cannot be split further."""
+
+    def fetch_logs(start_block, end_block):
+        raise ValueError("query returned more than 10000 results")
+
+    with pytest.raises(ValueError):
+        fetch_logs_splitting(logger, fetch_logs, 7, 8)
+
+
+def test_fetch_logs_splitting_other_errors():
+    """Errors that are not about the range size are not retried."""
+    calls = []
+
+    def fetch_logs(start_block, end_block):
+        calls.append((start_block, end_block))
+        raise ValueError("invalid argument")
+
+    with pytest.raises(ValueError):
+        fetch_logs_splitting(logger, fetch_logs, 1, 100)
+    assert calls == [(1, 100)]
+
+
+def test_iterate_log_ranges_prefetch():
+    """Prefetched ranges come out in block order and cover the scan like sequential fetching."""
+
+    def fetch_logs(start_block, end_block):
+        return list(range(start_block, end_block + 1))
+
+    def _ranges(prefetch_depth):
+        controller = ChunkSizeController(min_chunk_size=1, initial_chunk_size=3)
+        return list(iterate_log_ranges(logger, fetch_logs, 1, 20, controller, prefetch_depth))
+
+    sequential = _ranges(0)
+    assert [(start, end) for start, end, logs in sequential][:2] == [(1, 3), (4, 6)]
+    assert sum((logs for start, end, logs in sequential), []) == list(range(1, 21))
+    assert _ranges(4) == sequential
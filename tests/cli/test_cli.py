@@ -4,7 +4,7 @@ from sto.distribution import read_csv
 from sto.ethereum.broadcast import broadcast
 from sto.ethereum.distribution import distribute_tokens
 from sto.ethereum.issuance import deploy_token_contracts, contract_status
-from sto.ethereum.status import update_status
+from sto.ethereum.status import update_status, watch_status
 from sto.cli.main import cli
 from sto.ethereum.utils import get_abi, priv_key_to_address
 
@@ -328,6 +328,144 @@ def test_distribute(logger, dbsession, web3, private_key_hex, sample_csv_file):
     assert old_distributes == 2
 
 
+def test_distribute_tokens_bulk(logger, dbsession, web3, private_key_hex):
+    """Bulk distribution encodes the same calldata as web3 and allocates nonces as one range."""
+    from sto.ethereum.txservice import EthereumStoredTXService
+    from sto.models.implementation import BroadcastAccount, PreparedTransaction
+
+    txs = deploy_token_contracts(
+       logger, dbsession, "testing", web3,
+       ethereum_abi_file=None,
+       ethereum_private_key=private_key_hex,
+       ethereum_gas_limit=99999999,
+       ethereum_gas_price=None,
+       name="Moo Corp",
+       symbol="MOO",
+       url="https://tokenmarket.net",
+       amount=9999,
+       transfer_restriction="unrestricted"
+    )
+    token_address = txs[0].contract_address
+
+    def _broadcast():
+        broadcast(
+            logger,
+            dbsession,
+            "testing",
+            web3,
+            ethereum_private_key=private_key_hex,
+            ethereum_gas_limit=None,
+            ethereum_gas_price=None,
+        )
+
+    _broadcast()
+
+    abi = get_abi(None)
+    service = EthereumStoredTXService("testing", dbsession, web3, private_key_hex, None, None, BroadcastAccount, PreparedTransaction)
+    transfers = [(str(i), receiver, (i + 1) * 10**18, "Test {}".format(i)) for i, receiver in enumerate(web3.eth.accounts[1:6])]
+
+    first_nonce = service.get_next_nonce()
+    assert service.distribute_tokens_bulk(transfers, token_address, abi) == len(transfers)
+    assert service.get_next_nonce() == first_nonce + len(transfers)
+
+    prepared = dbsession.query(PreparedTransaction).filter(PreparedTransaction.external_id.in_([t[0] for t in transfers])).order_by(PreparedTransaction.nonce).all()
+    assert [tx.nonce for tx in prepared] == list(range(first_nonce, first_nonce + len(transfers)))
+
+    contract = service.get_contract_proxy("ERC20", abi, token_address)
+    for tx, (external_id, receiver, raw_amount, note) in zip(prepared, transfers):
+        expected = contract.functions.transfer(receiver, raw_amount).buildTransaction(service.generate_tx_data(tx.nonce))
+        assert tx.unsigned_payload["data"] == expected["data"]
+        assert tx.unsigned_payload["to"] == expected["to"]
+        assert tx.unsigned_payload["nonce"] == tx.nonce
+        assert (tx.external_id, tx.receiver, tx.human_readable_description) == (external_id, receiver, note)
+
+    # Ids already distributed and duplicate ids within a batch are refused
+    with pytest.raises(RuntimeError):
+        service.distribute_tokens_bulk(transfers[:1], token_address, abi)
+    with pytest.raises(RuntimeError):
+        service.distribute_tokens_bulk([("dupe", transfers[0][1], 1, "Dupe"), ("dupe", transfers[1][1], 1, "Dupe")], token_address, abi)
+
+    # The transactions move the tokens on the chain
+    _broadcast()
+    for external_id, receiver, raw_amount, note in transfers:
+        assert contract.functions.balanceOf(receiver).call() == raw_amount
+
+
+def test_bulk_broadcast(logger, dbsession, web3, private_key_hex):
+    """Broadcast pending transactions with pre-signing and JSON-RPC batches."""
+
+    txs = deploy_token_contracts(
+       logger, dbsession, "testing", web3,
+       ethereum_abi_file=None,
+       ethereum_private_key=private_key_hex,
+       ethereum_gas_limit=99999999,
+       ethereum_gas_price=None,
+       name="Moo Corp",
+       symbol="MOO",
+       url="https://tokenmarket.net",
+       amount=9999,
+       transfer_restriction="unrestricted"
+    )
+
+    txs = broadcast(
+        logger,
+        dbsession,
+        "testing",
+        web3,
+        ethereum_private_key=private_key_hex,
+        ethereum_gas_limit=None,
+        ethereum_gas_price=None,
+        bulk=True,
+        batch_size=2,
+    )
+    assert len(txs) == 4
+    for tx in txs:
+        assert tx.txid
+        assert tx.broadcasted_at
+        assert not tx.broadcast_error
+
+    txs = update_status(
+        logger,
+        dbsession,
+        "testing",
+        web3,
+        ethereum_private_key=private_key_hex,
+        ethereum_gas_limit=None,
+        ethereum_gas_price=None,
+    )
+    for tx in txs:  # type: PreparedTransaction
+        assert tx.result_transaction_success
+
+
+def test_sign_many_parallel(logger, dbsession, web3, private_key_hex):
+    """Signing in worker processes gives the same raw transactions and txids as signing one by one."""
+    from sto.ethereum.txservice import EthereumStoredTXService
+    from sto.models.implementation import BroadcastAccount, PreparedTransaction
+
+    txs = deploy_token_contracts(
+       logger, dbsession, "testing", web3,
+       ethereum_abi_file=None,
+       ethereum_private_key=private_key_hex,
+       ethereum_gas_limit=99999999,
+       ethereum_gas_price=None,
+       name="Moo Corp",
+       symbol="MOO",
+       url="https://tokenmarket.net",
+       amount=9999,
+       transfer_restriction="unrestricted"
+    )
+
+    service = EthereumStoredTXService("testing", dbsession, web3, private_key_hex, None, None, BroadcastAccount, PreparedTransaction)
+
+    serial = service.sign_many(txs, workers=1)
+    serial_txids = [tx.txid for tx in txs]
+
+    pooled = service.sign_many(txs, workers=2, min_parallel_batch=1)
+    assert pooled == serial
+    assert [tx.txid for tx in txs] == serial_txids
+    assert len(set(serial_txids)) == len(txs)
+
+
 def test_kyc_deploy(
         dbsession,
         private_key_hex,
@@ -616,3 +754,187 @@ def test_payout_dividends(
     # # 0x0000000000000000000000000000000000000064 is the default address 100
     # assert payout_contract.functions.balanceOf('0x0000000000000000000000000000000000000064').call() == 123
     # assert test_token_contract.call().balanceOf(priv_key_to_address(customer_private_key)) > initial_balance
+
+
+def test_db_upgrade(logger, dbsession, click_runner, db_path):
+    """Database created without migration records gets all migrations applied once."""
+    from sto.migrations import MIGRATIONS, get_schema_version
+
+    engine = dbsession.get_bind()
+    assert get_schema_version(engine) == 0
+
+    result = click_runner.invoke(cli, ['--database-file', db_path, 'db-upgrade'])
+    assert result.exit_code == 0
+    assert get_schema_version(engine) == MIGRATIONS[-1].version
+
+    result = click_runner.invoke(cli, ['--database-file', db_path, 'db-upgrade'])
+    assert result.exit_code == 0
+    assert get_schema_version(engine) == MIGRATIONS[-1].version
+
+
+def test_watch_status(logger, dbsession, web3, private_key_hex):
+    """Follow blocks until broadcasted transactions are confirmed."""
+
+    deploy_token_contracts(
+       logger, dbsession, "testing", web3,
+       ethereum_abi_file=None,
+       ethereum_private_key=private_key_hex,
+       ethereum_gas_limit=99999999,
+       ethereum_gas_price=None,
+       name="Moo Corp",
+       symbol="MOO",
+       url="https://tokenmarket.net",
+       amount=9999,
+       transfer_restriction="unrestricted"
+    )
+
+    broadcast(
+        logger,
+        dbsession,
+        "testing",
+        web3,
+        ethereum_private_key=private_key_hex,
+        ethereum_gas_limit=None,
+        ethereum_gas_price=None,
+    )
+
+    txs = watch_status(
+        logger,
+        dbsession,
+        "testing",
+        web3,
+        ethereum_private_key=private_key_hex,
+        ethereum_gas_limit=None,
+        ethereum_gas_price=None,
+        confirmations=1,
+        poll_interval=0,
+        max_polls=3,
+    )
+    assert len(txs) == 4
+    for tx in txs:  # type: PreparedTransaction
+        assert tx.result_transaction_success
+        assert tx.result_confirmations >= 1
+
+
+def test_watch_status_reorg(logger, dbsession, web3, web3_test_provider, private_key_hex):
+    """Transactions mined in blocks that replaced already watched blocks are found."""
+    from sto.models.implementation import BroadcastAccount
+
+    deploy_token_contracts(
+       logger, dbsession, "testing", web3,
+       ethereum_abi_file=None,
+       ethereum_private_key=private_key_hex,
+       ethereum_gas_limit=99999999,
+       ethereum_gas_price=None,
+       name="Moo Corp",
+       symbol="MOO",
+       url="https://tokenmarket.net",
+       amount=9999,
+       transfer_restriction="unrestricted"
+    )
+
+    def _watch():
+        return watch_status(
+            logger,
+            dbsession,
+            "testing",
+            web3,
+            ethereum_private_key=private_key_hex,
+            ethereum_gas_limit=None,
+            ethereum_gas_price=None,
+            confirmations=1,
+            poll_interval=0,
+            max_polls=3,
+        )
+
+    # Watch blocks without our transactions, which are then forked away
+    snapshot = web3_test_provider.ethereum_tester.take_snapshot()
+    _watch()
+    accounts = web3_test_provider.ethereum_tester.get_accounts()
+    for i in range(2):
+        web3.eth.sendTransaction({"from": accounts[1], "to": accounts[2], "value": 1})
+    _watch()
+    account = dbsession.query(BroadcastAccount).one()
+    watched_block_num = account.watched_block_num
+    assert watched_block_num == web3.eth.blockNumber
+
+    # On the new chain our transactions are in the blocks we already watched
+    web3_test_provider.ethereum_tester.revert_to_snapshot(snapshot)
+    broadcast(
+        logger,
+        dbsession,
+        "testing",
+        web3,
+        ethereum_private_key=private_key_hex,
+        ethereum_gas_limit=None,
+        ethereum_gas_price=None,
+    )
+    assert min(web3.eth.getTransactionReceipt(tx.txid).blockNumber for tx in account.txs) <= watched_block_num
+
+    txs = _watch()
+    assert len(txs) == 4
+    for tx in txs:  # type: PreparedTransaction
+        assert tx.result_transaction_success
+    assert account.watched_block_hashes[-1] == [web3.eth.blockNumber, web3.eth.getBlock(web3.eth.blockNumber).hash.hex()]
+
+
+def test_update_status_batched(logger, dbsession, web3, private_key_hex, monkeypatch):
+    """Receipts are polled in batches and transactions waiting for earlier nonces are not polled."""
+    from sto.ethereum import txservice
+
+    def _deploy(name):
+        return deploy_token_contracts(
+           logger, dbsession, "testing", web3,
+           ethereum_abi_file=None,
+           ethereum_private_key=private_key_hex,
+           ethereum_gas_limit=99999999,
+           ethereum_gas_price=None,
+           name=name,
+           symbol="MOO",
+           url="https://tokenmarket.net",
+           amount=9999,
+           transfer_restriction="unrestricted"
+        )
+
+    broadcasted = _deploy("Moo Corp")
+    broadcast(
+        logger,
+        dbsession,
+        "testing",
+        web3,
+        ethereum_private_key=private_key_hex,
+        ethereum_gas_limit=None,
+        ethereum_gas_price=None,
+    )
+
+    # Not broadcasted, so their nonces are above the mined transaction count
+    waiting = _deploy("Boo Corp")
+
+    calls = []
+    batch_rpc_call = txservice.batch_rpc_call
+
+    def _batch_rpc_call(web3, method, params_list, batch_size=100):
+        calls.append((method, len(params_list), batch_size))
+        return batch_rpc_call(web3, method, params_list, batch_size)
+
+    monkeypatch.setattr(txservice, "batch_rpc_call", _batch_rpc_call)
+
+    txs = update_status(
+        logger,
+        dbsession,
+        "testing",
+        web3,
+        ethereum_private_key=private_key_hex,
+        ethereum_gas_limit=None,
+        ethereum_gas_price=None,
+        batch_size=3,
+    )
+    assert len(txs) == len(broadcasted) + len(waiting)
+    assert calls == [("eth_getTransactionReceipt", len(broadcasted), 3)]
+
+    for tx in broadcasted:
+        assert tx.result_transaction_success
+        assert tx.result_block_num is not None
+    for tx in waiting:
+        assert tx.result_fetched_at is None
+        assert tx.result_block_num is None
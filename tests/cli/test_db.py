@@ -0,0 +1,207 @@
+"""Database setup and schema migrations."""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+
+from sto.db import setup_database, read_compact_storage_option
+from sto.migrations import MIGRATIONS, get_schema_version, upgrade_database, compact_sqlite_database, update_in_batches
+from sto.models.implementation import Base, NumericBase, NumericTokenScanStatus, NumericTokenHolderDelta, BroadcastAccount, PreparedTransaction, TokenScanStatus, TokenHolderAccount
+from sto.models.utils import hex_to_bytes
+
+
+#: Columns added to existing tables after the first release, as (table name, column name)
+NEW_COLUMNS = (
+    ("token_scan_status", "chunk_size_tuning"),
+    ("token_scan_status", "scanned_block_hashes"),
+    ("broadcast_account", "watched_block_num"),
+    ("broadcast_account", "watched_block_hashes"),
+    ("prepared_transaction", "result_confirmations"),
+)
+
+#: Sample values in the forms the code gets them
+TXID = "0x973eb270e311c23dd6173a9092c9ad4ee8f3fe24627b43c7ad75dc2dadfcbdf9"
+CHECKSUM_ADDRESS = "0xDE5bC059aA433D72F25846bdFfe96434b406FA85"
+LOWERCASE_ADDRESS = CHECKSUM_ADDRESS.lower()
+
+#: Tables added after the first release
+NEW_TABLES = ("block_header", "database_option", "schema_version", "token_balance_snapshot", "token_balance_snapshot_entry")
+
+
+def create_old_database(url: str):
+    """Create a database looking like one from the first release, before migrations."""
+    metadata = sa.MetaData()
+    for table in Base.metadata.sorted_tables:
+        if table.name in NEW_TABLES:
+            continue
+        sa.Table(table.name, metadata, *[c.copy() for c in table.columns if (table.name, c.name) not in NEW_COLUMNS])
+    engine = sa.create_engine(url)
+    metadata.create_all(engine)
+    return engine
+
+
+def get_column_names(engine, table_name):
+    return set(c["name"] for c in sa.inspect(engine).get_columns(table_name))
+
+
+def test_open_old_database(logger, db_path):
+    """Opening an existing database does not change its schema."""
+
+    engine = create_old_database("sqlite+pysqlite:///" + db_path)
+
+    dbsession, new = setup_database(logger, db_path)
+    assert not new
+
+    assert not engine.has_table("block_header")
+    for table_name, column_name in NEW_COLUMNS:
+        assert column_name not in get_column_names(engine, table_name)
+
+
+def test_upgrade_old_database(logger, db_path):
+    """Migrations add their own tables and columns to an old database."""
+
+    engine = create_old_database("sqlite+pysqlite:///" + db_path)
+    assert get_schema_version(engine) == 0
+
+    assert upgrade_database(logger, engine) == len(MIGRATIONS)
+    assert get_schema_version(engine) == MIGRATIONS[-1].version
+
+    for table_name in NEW_TABLES:
+        assert engine.has_table(table_name)
+    for table_name, column_name in NEW_COLUMNS:
+        assert column_name in get_column_names(engine, table_name)
+
+    # Nothing left to do
+    assert upgrade_database(logger, engine) == 0
+
+
+def test_numeric_models_postgresql_sql():
+    """NUMERIC token models compile for PostgreSQL and the balance UPDATE keeps the sort column in sync."""
+
+    for table in NumericBase.metadata.sorted_tables:
+        ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+        if table.name in ("token_holder_account", "token_holder_delta", "token_balance_snapshot_entry"):
+            assert "NUMERIC(78, 0)" in ddl
+
+    status = NumericTokenScanStatus(id=1)
+    sql = str(status.get_denormalised_balances_update().compile(dialect=postgresql.dialect()))
+    assert sql.startswith("UPDATE token_holder_account SET")
+    for column in ("raw_balance=", "sign=", "empty=", "sortable_balance=", "last_block_num=", "balance_calculated_at="):
+        assert column in sql
+    assert "div(" not in sql
+
+
+def add_sample_rows(dbsession):
+    """A transaction and a token holder with hex string columns."""
+    account = BroadcastAccount(network="testing", address=CHECKSUM_ADDRESS)
+    dbsession.add(account)
+    tx = PreparedTransaction(human_readable_description="Test", unsigned_payload={}, txid=TXID, receiver=LOWERCASE_ADDRESS, contract_address=CHECKSUM_ADDRESS)
+    account.txs.append(tx)
+
+    status = TokenScanStatus(network="testing", address=CHECKSUM_ADDRESS)
+    dbsession.add(status)
+    dbsession.flush()
+    account_ids = status.get_or_create_accounts([CHECKSUM_ADDRESS])
+    dbsession.commit()
+    return account_ids[CHECKSUM_ADDRESS]
+
+
+def check_compact_rows(dbsession, account_id):
+    """Hex columns are raw bytes in the database and hex strings in Python."""
+    raw_txid, raw_receiver = dbsession.execute("SELECT txid, receiver FROM prepared_transaction").first()
+    assert raw_txid == bytes.fromhex(TXID[2:])
+    assert raw_receiver == bytes.fromhex(LOWERCASE_ADDRESS[2:])
+
+    tx = dbsession.query(PreparedTransaction).one()
+    assert tx.txid == TXID
+    assert tx.receiver == CHECKSUM_ADDRESS
+    assert tx.contract_address == CHECKSUM_ADDRESS
+
+    # Lookups match whatever case the address is given in
+    assert dbsession.query(PreparedTransaction).filter_by(receiver=CHECKSUM_ADDRESS).count() == 1
+    status = dbsession.query(TokenScanStatus).one()
+    assert status.get_or_create_accounts([LOWERCASE_ADDRESS]) == {LOWERCASE_ADDRESS: account_id}
+    assert status.get_or_create_account(LOWERCASE_ADDRESS).id == account_id
+    assert dbsession.query(TokenHolderAccount).count() == 1
+
+
+def test_compact_storage(logger, db_path):
+    """New databases can store addresses and transaction hashes as raw bytes."""
+
+    dbsession, new = setup_database(logger, db_path, compact_storage=True)
+    assert new
+    account_id = add_sample_rows(dbsession)
+    check_compact_rows(dbsession, account_id)
+
+    # Reopening keeps the storage format
+    dbsession, new = setup_database(logger, db_path)
+    assert not new
+    check_compact_rows(dbsession, account_id)
+
+
+def test_compact_existing_database(logger, db_path):
+    """A database with hex string columns is converted in place."""
+
+    dbsession, new = setup_database(logger, db_path)
+    account_id = add_sample_rows(dbsession)
+    assert dbsession.execute("SELECT txid FROM prepared_transaction").scalar() == TXID
+    engine = dbsession.get_bind()
+    dbsession.close()
+
+    compact_sqlite_database(logger, engine, batch_size=1)
+    assert read_compact_storage_option(engine)
+
+    dbsession, new = setup_database(logger, db_path)
+    check_compact_rows(dbsession, account_id)
+
+
+def test_numeric_balance_after_fork(logger, db_path):
+    """NUMERIC balances keep updating after a fork purged every delta of an account."""
+
+    engine = sa.create_engine("sqlite+pysqlite:///" + db_path)
+    NumericBase.metadata.create_all(engine)
+    dbsession = sessionmaker(bind=engine)()
+
+    status = NumericTokenScanStatus(network="testing", address=CHECKSUM_ADDRESS)
+    dbsession.add(status)
+    dbsession.flush()
+    account = status.get_or_create_account(LOWERCASE_ADDRESS)
+
+    def add_delta(block_num, val):
+        delta = NumericTokenHolderDelta(account=account, block_num=block_num, **NumericTokenHolderDelta.get_delta_columns(val, 1))
+        dbsession.add(delta)
+        account.mark_dirty()
+        status.update_denormalised_balances()
+
+    add_delta(10, 500)
+    assert account.get_balance_uint() == 500
+
+    # All deltas of the account were in the forked blocks
+    NumericTokenHolderDelta.delete_potentially_forked_block_data(status, 10)
+    status.update_denormalised_balances()
+    assert account.get_balance_uint() == 0
+    assert account.last_block_num == 0
+
+    add_delta(11, 300)
+    assert account.get_balance_uint() == 300
+    assert account.last_block_num == 11
+
+
+def test_compact_partially_converted_database(logger, db_path):
+    """Converting again after an interrupted conversion leaves the already converted values alone."""
+
+    dbsession, new = setup_database(logger, db_path)
+    account_id = add_sample_rows(dbsession)
+    engine = dbsession.get_bind()
+    dbsession.close()
+
+    # Rows converted before a crash, without the compact storage option
+    with engine.begin() as conn:
+        update_in_batches(logger, conn, "prepared_transaction", ["txid", "receiver"], hex_to_bytes, batch_size=1)
+    assert not read_compact_storage_option(engine)
+
+    compact_sqlite_database(logger, engine)
+    assert read_compact_storage_option(engine)
+
+    dbsession, new = setup_database(logger, db_path)
+    check_compact_rows(dbsession, account_id)
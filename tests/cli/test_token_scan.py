@@ -4,17 +4,22 @@ import os
 import pytest
 from decimal import Decimal
 
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
 from web3.contract import Contract
 
 from sto.distribution import read_csv
+from sto.ethereum.blocks import BlockHeaderResolver
 from sto.ethereum.broadcast import broadcast
+from sto.ethereum.chunksize import ChunkSizeController
 from sto.ethereum.distribution import distribute_tokens, distribute_single
 from sto.ethereum.issuance import deploy_token_contracts, contract_status
+from sto.ethereum.scanner import TokenScanner
 from sto.ethereum.status import update_status
-from sto.ethereum.tokenscan import token_scan
+from sto.ethereum.tokenscan import token_scan, multi_token_scan
 from sto.ethereum.utils import get_abi
 from sto.models.broadcastaccount import _PreparedTransaction
-from sto.models.implementation import TokenScanStatus
+from sto.models.implementation import TokenScanStatus, BlockHeader, get_token_models
 
 
 @pytest.fixture
@@ -325,17 +330,223 @@ def test_token_scan_incremental(logger, dbsession, network, private_key_hex, sam
     assert balances == correct_result
 
 
+def test_multi_token_scan(logger, dbsession, network, private_key_hex, sample_distribution, web3):
+    """Scan two tokens with a single pass and see we get the same results as scanning them one by one."""
 
+    txs = deploy_token_contracts(
+        logger,
+        dbsession,
+        "testing",
+        web3,
+        ethereum_abi_file=None,
+        ethereum_private_key=private_key_hex,
+        ethereum_gas_limit=9999999,
+        ethereum_gas_price=None,
+        name="Boo Corp",
+        symbol="BOO",
+        url="https://tokenmarket.net",
+        amount=8888,
+        transfer_restriction="unrestricted"
+    )
 
+    broadcast(logger,
+              dbsession,
+              "testing",
+              web3,
+              ethereum_private_key=private_key_hex,
+              ethereum_gas_limit=None,
+              ethereum_gas_price=None,
+              )
 
+    token_address_1 = sample_distribution
+    token_address_2 = txs[0].contract_address
 
+    all_balances = multi_token_scan(logger, dbsession, network, web3, None, [token_address_1, token_address_2])
 
+    assert all_balances[token_address_1.lower()] == {
+        '0x0bdcc26C4B8077374ba9DB82164B77d6885b92a6': 300 * 10**18,
+        '0xDE5bC059aA433D72F25846bdFfe96434b406FA85': 9199 * 10**18,
+        '0xE738f7A6Eb317b8B286c27296cD982445c9D8cd2': 500 * 10**18
+    }
 
+    assert all_balances[token_address_2.lower()] == {
+        '0xDE5bC059aA433D72F25846bdFfe96434b406FA85': 8888 * 10**18,
+    }
 
+    end_block = web3.eth.blockNumber
+    for token_address in (token_address_1, token_address_2):
+        status = dbsession.query(TokenScanStatus).filter_by(address=token_address).one()
+        assert status.end_block == end_block
 
+    # Both tokens are up to date, nothing to rescan
+    assert multi_token_scan(logger, dbsession, network, web3, None, [token_address_1, token_address_2]) == {}
 
 
+def test_token_scan_reorg(logger, dbsession, network, private_key_hex, sample_token, web3, web3_test_provider, test_account_1, test_account_2, test_account_3, token_contract):
+    """Incremental scan notices a chain reorganisation even if another scan has cached the new block header."""
 
+    token_address = sample_token
+    send_issuer_tokens(logger, dbsession, web3, private_key_hex, token_address, test_account_1, Decimal(100))
+    token_scan(logger, dbsession, network, web3, None, token_address)
+
+    # Account 1 sends tokens to account 2 in a block that is going to be forked away
+    snapshot = web3_test_provider.ethereum_tester.take_snapshot()
+    token_contract.functions.transfer(test_account_2, 10*10**18).transact({"from": test_account_1})
+    balances = token_scan(logger, dbsession, network, web3, None, token_address)
+    assert balances == {
+        test_account_1: 90 * 10**18,
+        test_account_2: 10 * 10**18,
+    }
 
+    # On the new chain the same block sends tokens to account 3 instead
+    web3_test_provider.ethereum_tester.revert_to_snapshot(snapshot)
+    token_contract.functions.transfer(test_account_3, 20*10**18).transact({"from": test_account_1})
+    forked_block = web3.eth.blockNumber
+
+    # A scan of another token stores the header of the new block in the shared cache
+    resolver = BlockHeaderResolver(web3, dbsession=dbsession, network=network, BlockHeaderModel=BlockHeader)
+    new_header = resolver.fetch_headers_from_node([forked_block])[forked_block]
+    BlockHeader.store_headers(dbsession, network, [new_header])
+    assert BlockHeader.get_headers(dbsession, network, [forked_block])[forked_block][0] == new_header.block_hash
+
+    balances = token_scan(logger, dbsession, network, web3, None, token_address)
+    assert balances == {
+        test_account_1: 80 * 10**18,
+        test_account_3: 20 * 10**18,
+    }
+
+    token_status = dbsession.query(TokenScanStatus).filter_by(address=token_address).one()
+    account_2 = token_status.get_accounts(include_empty=True).filter_by(address=test_account_2).one()
+    assert account_2.get_balance_uint() == 0
+    assert token_status.scanned_block_hashes[-1] == [forked_block, new_header.block_hash]
 
 
+def test_token_scan_prefetch(logger, dbsession, network, sample_distribution, web3):
+    """Fetching log ranges ahead in worker threads gives the same results as a sequential scan."""
+
+    token_address = sample_distribution
+    end_block = web3.eth.blockNumber
+    abi = get_abi(None)
+    models = get_token_models(dbsession)
+
+    def _scan(prefetch_depth):
+        # Small fixed chunks so that there are several ranges in flight
+        controller = ChunkSizeController(min_chunk_size=1, initial_chunk_size=2)
+        scanner = TokenScanner(logger, network, dbsession, web3, abi, token_address, models.TokenScanStatus, models.TokenHolderDelta, models.TokenHolderAccount, BlockHeader, chunk_size_controller=controller)
+        balances = scanner.scan(1, end_block, prefetch_depth=prefetch_depth)
+        status = scanner.get_or_create_status()
+        accounts = {a.address: (a.get_balance_uint(), a.last_block_num) for a in status.get_accounts(include_empty=True)}
+        return balances, accounts, status.start_block, status.end_block, status.scanned_block_hashes
+
+    sequential = _scan(prefetch_depth=0)
+    prefetched = _scan(prefetch_depth=3)
+    assert prefetched == sequential
+    assert len(sequential[4]) == (end_block + 1) // 2
+
+
+def test_token_scan_interrupted(logger, dbsession, network, sample_distribution, web3):
+    """Scanned ranges are committed in block order and an interrupted scan continues after them."""
+
+    token_address = sample_distribution
+    end_block = web3.eth.blockNumber
+    abi = get_abi(None)
+    models = get_token_models(dbsession)
+    engine = dbsession.get_bind()
+
+    class Interrupted(Exception):
+        pass
+
+    def _interrupt(start, end, current, chunk_size):
+        if current + chunk_size - 1 >= 4:
+            raise Interrupted()
+
+    controller = ChunkSizeController(min_chunk_size=1, initial_chunk_size=2)
+    scanner = TokenScanner(logger, network, dbsession, web3, abi, token_address, models.TokenScanStatus, models.TokenHolderDelta, models.TokenHolderAccount, BlockHeader, chunk_size_controller=controller)
+    with pytest.raises(Interrupted):
+        scanner.scan(1, end_block, progress_callback=_interrupt)
+    dbsession.close()
+
+    # A new session sees the scan status, tuning state and block headers up to the interrupted range
+    dbsession = sessionmaker(bind=engine)()
+    status = dbsession.query(models.TokenScanStatus).filter_by(address=token_address).one()
+    assert status.start_block == 1
+    assert status.end_block == 4
+    assert status.chunk_size_tuning == {"chunk_size": 2}
+    assert [block_num for block_num, block_hash in status.scanned_block_hashes] == [2, 4]
+    assert {2, 4} <= set(block_num for block_num, in dbsession.query(BlockHeader.block_num).filter_by(network=network))
+
+    scanner = TokenScanner(logger, network, dbsession, web3, abi, token_address, models.TokenScanStatus, models.TokenHolderDelta, models.TokenHolderAccount, BlockHeader)
+    start_block = scanner.get_suggested_scan_start_block()
+    assert start_block == 5
+    scanner.scan(start_block, end_block)
+
+    status = scanner.get_or_create_status()
+    assert status.end_block == end_block
+    assert {a.address: a.get_balance_uint() for a in status.get_accounts()} == {
+        '0x0bdcc26C4B8077374ba9DB82164B77d6885b92a6': 300 * 10**18,
+        '0xDE5bC059aA433D72F25846bdFfe96434b406FA85': 9199 * 10**18,
+        '0xE738f7A6Eb317b8B286c27296cD982445c9D8cd2': 500 * 10**18
+    }
+
+
+def test_token_scan_orm_ingest(logger, dbsession, network, sample_distribution, web3):
+    """Ingesting events through ORM objects one by one gives the same deltas and balances as bulk inserts."""
+
+    token_address = sample_distribution
+    end_block = web3.eth.blockNumber
+    abi = get_abi(None)
+    models = get_token_models(dbsession)
+
+    def _scan(bulk_ingest):
+        scanner = TokenScanner(logger, network, dbsession, web3, abi, token_address, models.TokenScanStatus, models.TokenHolderDelta, models.TokenHolderAccount, BlockHeader)
+        scanner.bulk_ingest = bulk_ingest
+        balances = scanner.scan(1, end_block)
+        status = scanner.get_or_create_status()
+        deltas = dbsession.query(models.TokenHolderDelta).join(models.TokenHolderDelta.account).filter(models.TokenHolderAccount.token_id == status.id)
+        deltas = sorted((d.account.address, d.block_num, d.tx_internal_order, d.txid, d.get_delta_uint()) for d in deltas)
+        return balances, deltas
+
+    bulk = _scan(bulk_ingest=True)
+    orm = _scan(bulk_ingest=False)
+    assert orm == bulk
+    assert bulk[1]
+
+
+def test_token_scan_account_id_map(logger, dbsession, network, private_key_hex, sample_token, web3, test_account_1, test_account_2, token_contract):
+    """A scanner remembers holder account ids and only looks up addresses it has not met before."""
+
+    token_address = sample_token
+    abi = get_abi(None)
+    models = get_token_models(dbsession)
+    scanner = TokenScanner(logger, network, dbsession, web3, abi, token_address, models.TokenScanStatus, models.TokenHolderDelta, models.TokenHolderAccount, BlockHeader)
+
+    send_issuer_tokens(logger, dbsession, web3, private_key_hex, token_address, test_account_1, Decimal(100))
+    scanner.scan(scanner.get_suggested_scan_start_block(), web3.eth.blockNumber)
+
+    status = scanner.get_or_create_status()
+    account_ids = {a.address.lower(): a.id for a in status.get_accounts(include_empty=True)}
+    assert {address.lower(): id for address, id in scanner.account_ids.items()} == account_ids
+    assert test_account_1.lower() in account_ids
+
+    # Record which holder addresses the next scan resolves from the database
+    looked_up = []
+
+    def _record_lookup(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT token_holder_account.address"):
+            looked_up.extend(p.lower() for p in parameters if isinstance(p, str) and p.startswith("0x"))
+
+    engine = dbsession.get_bind()
+    event.listen(engine, "before_cursor_execute", _record_lookup)
+    try:
+        token_contract.functions.transfer(test_account_2, 10*10**18).transact({"from": test_account_1})
+        balances = scanner.scan(scanner.get_suggested_scan_start_block(), web3.eth.blockNumber)
+    finally:
+        event.remove(engine, "before_cursor_execute", _record_lookup)
+
+    assert balances == {
+        test_account_1: 90 * 10**18,
+        test_account_2: 10 * 10**18,
+    }
+    assert test_account_2.lower() in looked_up
+    assert test_account_1.lower() not in looked_up
+    assert scanner.account_ids[test_account_1] == account_ids[test_account_1.lower()]